@@ -0,0 +1,118 @@
+import collections
+import copy
+
+class ActionCoalescer(object):
+    """Folds the button actions sent to the same lights within a short window before they are queued on the action executor.
+
+    The first action for a selector is queued straight away and opens a window. Actions arriving for the same selector
+    while the window is open are held back and folded with each other, and whatever is left is queued when the window
+    closes, which opens a new window. Folding:
+        - a Toggle cancels a pending identical Toggle, since the two would end where they started.
+        - a SetState or SetStates replaces a pending SetState or SetStates, only the last state matters.
+        - an ActivateScene drops the pending SetState and SetStates actions of every selector, as well as a pending
+          activation of the same scene.
+
+    Actions are matched by the text of their selector, so actions on overlapping but different selectors are neither
+    folded together nor ordered with each other.
+
+    All methods must be called from the thread that handles the flicd events, which also runs the window timers.
+    """
+
+    state_action_types = ['SetState', 'SetStates']
+
+    def __init__(self, client, action_executor, window=0.3):
+        """Inits ActionCoalescer.
+
+        Args:
+            client: FlicClient whose timers close the windows.
+            action_executor: ActionExecutor to queue the actions on.
+            window: seconds during which the actions on the same selector are folded, 0 to queue every action straight away.
+        """
+        self.client = client
+        self.action_executor = action_executor
+        self.window = window
+        # selector key -> actions held back until the window closes, there is an entry while the window is open
+        self._pending = {}
+        self.counters = collections.Counter()
+
+    def submit(self, action):
+        """Queues an action on the action executor, or holds it back to fold it with the next actions on the same lights.
+
+        Args:
+            action: the CompiledAction to run.
+        """
+        if action.action_type == 'ActivateScene':
+            self._drop_pending_states(self._pending.values())
+
+        pending = self._pending.get(action.key)
+        if pending is None:
+            self.counters['passed'] += 1
+            self.action_executor.submit(action.key, action.function, *action.args)
+            if self.window > 0:
+                self._open_window(action.key)
+        else:
+            self._fold(pending, action)
+
+    def submit_burst(self, actions):
+        """Folds a burst of actions down to their net effect in one pass, whatever the window, then queues what is left.
+
+        Args:
+            actions: the CompiledActions to run, oldest first.
+        """
+        # The same action can appear several times in a burst, copies tell them apart once folded
+        actions = [copy.copy(x) for x in actions]
+        burst = {}
+        for action in actions:
+            if action.action_type == 'ActivateScene':
+                self._drop_pending_states(burst.values())
+            self._fold(burst.setdefault(action.key, []), action)
+
+        # Queue what is left in the order the actions happened
+        remaining = set(id(x) for pending in burst.values() for x in pending)
+        for action in actions:
+            if id(action) in remaining:
+                self.submit(action)
+
+    def _fold(self, pending, action):
+        # Folds an action into the actions held back for its selector
+        if len(pending) > 0:
+            last = pending[-1]
+            if action.action_type == 'Toggle' and last.action_type == 'Toggle' and last.args == action.args:
+                pending.pop()
+                self.counters['toggles_cancelled'] += 2
+                return
+            if action.action_type in ActionCoalescer.state_action_types and last.action_type in ActionCoalescer.state_action_types:
+                pending[-1] = action
+                self.counters['states_replaced'] += 1
+                return
+            if action.action_type == 'ActivateScene' and last.action_type == 'ActivateScene':
+                pending[-1] = action
+                self.counters['scenes_replaced'] += 1
+                return
+        pending.append(action)
+
+    def get_metrics(self):
+        """Returns the number of actions passed straight through, flushed at the end of a window and folded away, as a dictionary."""
+        metrics = dict.fromkeys(['passed', 'flushed', 'toggles_cancelled', 'states_replaced', 'scenes_replaced', 'superseded_by_scene'], 0)
+        metrics.update(self.counters)
+        metrics['pending'] = sum(len(x) for x in self._pending.values())
+        return metrics
+
+    def _open_window(self, key):
+        self._pending[key] = []
+        self.client.set_timer(self.window * 1000, lambda: self._close_window(key))
+
+    def _close_window(self, key):
+        pending = self._pending.pop(key)
+        for action in pending:
+            self.counters['flushed'] += 1
+            self.action_executor.submit(action.key, action.function, *action.args)
+        # Keep folding while the button is being mashed
+        if len(pending) > 0:
+            self._open_window(key)
+
+    def _drop_pending_states(self, pending_lists):
+        for pending in pending_lists:
+            nb_pending = len(pending)
+            pending[:] = [x for x in pending if x.action_type not in ActionCoalescer.state_action_types]
+            self.counters['superseded_by_scene'] += nb_pending - len(pending)
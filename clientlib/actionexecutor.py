@@ -0,0 +1,161 @@
+import collections
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+class ActionExecutor(object):
+    """Runs light actions on a pool of worker threads so that the flicd event thread never waits for the light backend.
+
+    Every action is submitted with a key, normally the selector of the lights it changes. Actions with the same key
+    always go to the same worker and run in the order they were submitted, while actions with different keys run in
+    parallel on the other workers. Each worker has a bounded queue: when it is full the action is dropped instead of
+    blocking the caller.
+
+    The ordering only holds for identical keys. Actions on overlapping but different selectors, such as "all" and
+    "group:Kitchen", can run on different workers and finish in any order on the lights they share.
+
+    Attributes:
+        wait_time_samples: number of recent queue wait times kept to compute the wait time percentiles.
+    """
+
+    wait_time_samples = 1024
+
+    def __init__(self, nb_workers=4, max_queue_size=32):
+        """Inits ActionExecutor and starts its worker threads.
+
+        Args:
+            nb_workers: number of worker threads, i.e. how many selectors can be updated in parallel.
+            max_queue_size: maximum number of actions waiting in the queue of each worker.
+        """
+        if nb_workers < 1:
+            raise ValueError("An action executor needs at least one worker")
+
+        self.nb_workers = nb_workers
+        self.max_queue_size = max_queue_size
+        self._queues = [queue.Queue(max_queue_size) for _ in range(nb_workers)]
+        self._full = [False] * nb_workers
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._max_queue_depth = 0
+        self._wait_times = collections.deque(maxlen=ActionExecutor.wait_time_samples)
+        self._max_wait_time = 0.0
+        self._stopped = False
+
+        self._workers = []
+        for i in range(nb_workers):
+            worker = threading.Thread(target=self._run_worker, args=(self._queues[i],), name="action-worker-%d" % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key, function, *args):
+        """Queues an action to run on the worker owning the key.
+
+        Args:
+            key: string identifying what the action changes, usually a selector. Actions with the same key run in order.
+            function: the function to call.
+            *args: arguments to call the function with.
+
+        Returns:
+            True if the action was queued, False if it was dropped because the worker queue is full or the executor is stopped.
+        """
+        if self._stopped:
+            return False
+        worker = zlib.crc32(key.encode()) % self.nb_workers
+        action_queue = self._queues[worker]
+        try:
+            action_queue.put_nowait((time.monotonic(), function, args))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+                # Only report the first action dropped until the queue has drained to half its size
+                if not self._full[worker]:
+                    self._full[worker] = True
+                    print("Action queue full, dropping actions for %s" % key)
+            return False
+
+        depth = action_queue.qsize()
+        with self._lock:
+            if depth <= self.max_queue_size // 2:
+                self._full[worker] = False
+            self._submitted += 1
+            if depth > self._max_queue_depth:
+                self._max_queue_depth = depth
+        return True
+
+    def stop(self, timeout=5):
+        """Stops the workers once the actions already queued have run, or drops them if a worker queue is full.
+
+        A full queue means the backend can't keep up, so its actions are dropped rather than making the shutdown wait
+        for all of them.
+
+        Args:
+            timeout: seconds to wait for all the workers to finish, or None to wait for as long as it takes.
+        """
+        self._stopped = True
+        for action_queue in self._queues:
+            try:
+                action_queue.put_nowait(None)
+            except queue.Full:
+                self._drain(action_queue)
+                action_queue.put_nowait(None)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()) if deadline is not None else None)
+
+    def _drain(self, action_queue):
+        # Only called once submit refuses new actions, so the queue stays empty
+        while True:
+            try:
+                action_queue.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._dropped += 1
+
+    def get_metrics(self):
+        """Returns the current queue depths, counters and queue wait times (in milliseconds) as a dictionary."""
+        queue_depths = [x.qsize() for x in self._queues]
+        with self._lock:
+            wait_times = sorted(self._wait_times)
+            metrics = {
+                "queue_depth": sum(queue_depths),
+                "queue_depths": queue_depths,
+                "max_queue_depth": self._max_queue_depth,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "dropped": self._dropped,
+                "max_wait_ms": self._max_wait_time * 1000.0
+            }
+        for name, p in [("p50_wait_ms", 0.5), ("p95_wait_ms", 0.95), ("p99_wait_ms", 0.99)]:
+            metrics[name] = wait_times[min(len(wait_times) - 1, int(p * len(wait_times)))] * 1000.0 if wait_times else None
+        return metrics
+
+    def _run_worker(self, action_queue):
+        while True:
+            item = action_queue.get()
+            if item is None:
+                return
+            submit_time, function, args = item
+            wait_time = time.monotonic() - submit_time
+
+            failed = False
+            try:
+                function(*args)
+            except Exception:
+                failed = True
+                traceback.print_exc()
+
+            with self._lock:
+                self._wait_times.append(wait_time)
+                if wait_time > self._max_wait_time:
+                    self._max_wait_time = wait_time
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
@@ -0,0 +1,339 @@
+"""asyncio based Flic client library for python
+
+Requires python 3.7 or higher.
+
+AsyncFlicClient speaks the same protocol as fliclib.FlicClient and shares its wire tables, decoders and
+ButtonScanner/ScanWizard/ButtonConnectionChannel objects, but runs on an asyncio event loop instead of a
+blocking select loop. Requests that have a response (get_info and get_button_uuid) return awaitables, and
+button events can be consumed with an async iterator.
+
+Usage:
+client = await AsyncFlicClient.connect("localhost")
+info = await client.get_info()
+for bd_addr in info["bd_addr_of_verified_buttons"]:
+	client.add_connection_channel(fliclib.ButtonConnectionChannel(bd_addr))
+async for event in client.button_events():
+	print(event.channel.bd_addr, event.click_type)
+
+All methods must be called from the thread running the event loop.
+"""
+
+import asyncio
+import collections
+import threading
+
+from fliclib import FlicClient
+
+ButtonEvent = collections.namedtuple("ButtonEvent", "channel click_type was_queued time_diff")
+
+class _ButtonEventIterator:
+	"""Async iterator over the button events of one event family, see AsyncFlicClient.button_events()."""
+	
+	def __init__(self, client, event_family):
+		self._client = client
+		self._event_family = event_family
+		self._queue = asyncio.Queue()
+		client._button_event_queues[event_family].add(self._queue)
+	
+	def __aiter__(self):
+		return self
+	
+	async def __anext__(self):
+		# An iterator created after the connection was lost would otherwise never get the end of iteration
+		if self._client._closed and self._queue.empty():
+			self.close()
+			raise StopAsyncIteration
+		event = await self._queue.get()
+		if event is None:
+			self.close()
+			raise StopAsyncIteration
+		return event
+	
+	def close(self):
+		"""Stop receiving events on this iterator."""
+		self._client._button_event_queues[self._event_family].discard(self._queue)
+
+class AsyncFlicClient(asyncio.Protocol):
+	"""AsyncFlicClient class.
+	
+	Create a connected client with "await AsyncFlicClient.connect(host, port)".
+	Commands are written to the transport directly and events are dispatched on the event loop as they arrive,
+	so there is no handle_events() method to call.
+	
+	The callback properties of FlicClient (on_new_verified_button, on_no_space_for_new_connection,
+	on_got_space_for_new_connection, on_bluetooth_controller_state_change) are available with the same parameters,
+	as are the callbacks of the scanner, scan wizard and connection channel objects.
+	An exception raised by a callback is passed to the event loop's exception handler and the connection is kept.
+	"""
+	
+	# Names of the ButtonConnectionChannel callback properties, one per button event family
+	BUTTON_EVENT_FAMILIES = (
+		"on_button_up_or_down",
+		"on_button_click_or_hold",
+		"on_button_single_or_double_click",
+		"on_button_single_or_double_click_or_hold"
+	)
+	
+	def __init__(self, loop = None):
+		self._loop = loop if loop is not None else asyncio.get_event_loop()
+		self._transport = None
+		self._lock = threading.RLock()
+		self._scanners = {}
+		self._scan_wizards = {}
+		self._connection_channels = {}
+		self._get_info_response_queue = collections.deque()
+		self._get_button_uuid_queue = collections.deque()
+		self._button_event_queues = dict((x, set()) for x in AsyncFlicClient.BUTTON_EVENT_FAMILIES)
+		self._recv_buffer = bytearray()
+		self._closed = False
+		self._connection_lost_future = self._loop.create_future()
+		
+		self.on_new_verified_button = lambda bd_addr: None
+		self.on_no_space_for_new_connection = lambda max_concurrently_connected_buttons: None
+		self.on_got_space_for_new_connection = lambda max_concurrently_connected_buttons: None
+		self.on_bluetooth_controller_state_change = lambda state: None
+	
+	@classmethod
+	async def connect(cls, host, port = 5551):
+		"""Connect to flicd and return the connected AsyncFlicClient."""
+		loop = asyncio.get_running_loop()
+		transport, client = await loop.create_connection(lambda: cls(loop), host, port)
+		return client
+	
+	def connection_made(self, transport):
+		self._transport = transport
+	
+	def connection_lost(self, exc):
+		self._closed = True
+		
+		error = exc if exc is not None else ConnectionError("Connection to flicd closed")
+		for future in self._get_info_response_queue:
+			if not future.done():
+				future.set_exception(error)
+		self._get_info_response_queue.clear()
+		for future in self._get_button_uuid_queue:
+			if not future.done():
+				future.set_exception(error)
+		self._get_button_uuid_queue.clear()
+		
+		for queues in self._button_event_queues.values():
+			for queue in queues:
+				queue.put_nowait(None)
+		
+		if not self._connection_lost_future.done():
+			self._connection_lost_future.set_result(None)
+	
+	def data_received(self, data):
+		buffer = self._recv_buffer
+		buffer += data
+		
+		view = memoryview(buffer)
+		start = 0
+		end = len(buffer)
+		try:
+			while end - start >= 2:
+				packet_len = view[start] | (view[start + 1] << 8)
+				if end - start - 2 < packet_len:
+					break
+				packet_start = start + 2
+				# Consume the frame before dispatching it, so that a handler that raises doesn't get it again
+				start = packet_start + packet_len
+				try:
+					self._dispatch_event(view[packet_start : start])
+				except Exception as e:
+					# Letting it reach the transport would close the connection, so it is only reported
+					self._loop.call_exception_handler({
+						"message": "Exception in a flicd event handler",
+						"exception": e,
+						"protocol": self
+					})
+		finally:
+			view.release()
+			try:
+				del buffer[:start]
+			except BufferError:
+				# The traceback of a handler that raised can still hold a view on the buffer, which can't be resized then
+				self._recv_buffer = buffer[start:]
+	
+	def close(self):
+		"""Closes the client. Use wait_closed() to wait until the connection is closed."""
+		if self._closed:
+			return
+		self._closed = True
+		self._transport.close()
+	
+	async def wait_closed(self):
+		"""Wait until the connection to flicd is closed."""
+		await self._connection_lost_future
+	
+	def add_scanner(self, scanner):
+		"""Add a ButtonScanner object.
+		
+		The scan will start directly once the scanner is added.
+		"""
+		if scanner._scan_id in self._scanners:
+			return
+		
+		self._scanners[scanner._scan_id] = scanner
+		self._send_command("CmdCreateScanner", {"scan_id": scanner._scan_id})
+	
+	def remove_scanner(self, scanner):
+		"""Remove a ButtonScanner object.
+		
+		You will no longer receive advertisement packets.
+		"""
+		if scanner._scan_id not in self._scanners:
+			return
+		
+		del self._scanners[scanner._scan_id]
+		self._send_command("CmdRemoveScanner", {"scan_id": scanner._scan_id})
+	
+	def add_scan_wizard(self, scan_wizard):
+		"""Add a ScanWizard object.
+		
+		The scan wizard will start directly once the scan wizard is added.
+		"""
+		if scan_wizard._scan_wizard_id in self._scan_wizards:
+			return
+		
+		self._scan_wizards[scan_wizard._scan_wizard_id] = scan_wizard
+		self._send_command("CmdCreateScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id})
+	
+	def cancel_scan_wizard(self, scan_wizard):
+		"""Cancel a ScanWizard.
+		
+		Note: The effect of this command will take place at the time the on_completed event arrives on the scan wizard object.
+		"""
+		if scan_wizard._scan_wizard_id not in self._scan_wizards:
+			return
+		
+		self._send_command("CmdCancelScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id})
+	
+	def add_connection_channel(self, channel):
+		"""Adds a connection channel to a specific Flic button.
+		
+		See FlicClient.add_connection_channel.
+		"""
+		if channel._conn_id in self._connection_channels:
+			return
+		
+		channel._client = self
+		
+		self._connection_channels[channel._conn_id] = channel
+		self._write(channel._create_connection_channel_command())
+	
+	def add_connection_channels(self, channels):
+		"""Adds several connection channels at once, with a single write to the transport."""
+		data = bytearray()
+		for channel in channels:
+			if channel._conn_id in self._connection_channels:
+				continue
+			
+			channel._client = self
+			
+			self._connection_channels[channel._conn_id] = channel
+			data += channel._create_connection_channel_command()
+		self._write(data)
+	
+	def remove_connection_channel(self, channel):
+		"""Remove a connection channel.
+		
+		Note: The effect of this command will take place at the time the on_removed event arrives on the connection channel object.
+		"""
+		if channel._conn_id not in self._connection_channels:
+			return
+		
+		self._send_command("CmdRemoveConnectionChannel", {"conn_id": channel._conn_id})
+	
+	def force_disconnect(self, bd_addr):
+		"""Force disconnection or cancel pending connection of a specific Flic button."""
+		self._send_command("CmdForceDisconnect", {"bd_addr": bd_addr})
+	
+	def get_info(self):
+		"""Get info about the current state of the server.
+		
+		Returns an awaitable resolving to the same info dictionary FlicClient.get_info passes to its callback.
+		"""
+		future = self._loop.create_future()
+		self._get_info_response_queue.append(future)
+		self._send_command("CmdGetInfo", {})
+		return future
+	
+	def get_button_uuid(self, bd_addr):
+		"""Get button uuid for a verified button.
+		
+		Returns an awaitable resolving to the uuid (hex string of 32 characters), or None if the button isn't verified.
+		"""
+		future = self._loop.create_future()
+		self._get_button_uuid_queue.append(future)
+		self._send_command("CmdGetButtonUUID", {"bd_addr": bd_addr})
+		return future
+	
+	def button_events(self, event_family = "on_button_single_or_double_click_or_hold"):
+		"""Returns an async iterator over the button events of all connection channels.
+		
+		event_family is the name of the ButtonConnectionChannel callback property whose events should be delivered,
+		see BUTTON_EVENT_FAMILIES. Each item is a ButtonEvent (channel, click_type, was_queued, time_diff).
+		The iteration stops when the connection to flicd is closed.
+		"""
+		if event_family not in self._button_event_queues:
+			raise ValueError("Unknown button event family: %s" % event_family)
+		return _ButtonEventIterator(self, event_family)
+	
+	def _send_command(self, name, items):
+		self._write(FlicClient._pack_command(name, items))
+	
+	def _write(self, data):
+		if not self._closed and len(data) > 0:
+			self._transport.write(data)
+	
+	def _publish_button_event(self, event_family, channel, click_type, was_queued, time_diff):
+		queues = self._button_event_queues[event_family]
+		if queues:
+			event = ButtonEvent(channel, click_type, was_queued, time_diff)
+			for queue in queues:
+				queue.put_nowait(event)
+	
+	def _handle_button_up_or_down(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_up_or_down(channel, click_type, was_queued, time_diff)
+		self._publish_button_event("on_button_up_or_down", channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_click_or_hold(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_click_or_hold(channel, click_type, was_queued, time_diff)
+		self._publish_button_event("on_button_click_or_hold", channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_single_or_double_click(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_single_or_double_click(channel, click_type, was_queued, time_diff)
+		self._publish_button_event("on_button_single_or_double_click", channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_single_or_double_click_or_hold(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_single_or_double_click_or_hold(channel, click_type, was_queued, time_diff)
+		self._publish_button_event("on_button_single_or_double_click_or_hold", channel, click_type, was_queued, time_diff)
+	
+	def _handle_get_info_response(self, items):
+		future = self._get_info_response_queue.popleft()
+		if not future.done():
+			future.set_result(items)
+	
+	def _handle_get_button_uuid_response(self, bd_addr, uuid):
+		future = self._get_button_uuid_queue.popleft()
+		if not future.done():
+			future.set_result(uuid)
+	
+	def _dispatch_event(self, data):
+		if len(data) == 0:
+			return
+		opcode = data[0]
+		
+		if opcode >= len(AsyncFlicClient._EVENT_DISPATCH):
+			return
+		
+		decoder, handler = AsyncFlicClient._EVENT_DISPATCH[opcode]
+		handler(self, *decoder(data))
+
+# Same decoders as FlicClient, with the handlers overridden above taking precedence over the FlicClient ones
+AsyncFlicClient._EVENT_DISPATCH = list(map(lambda x: (x[0], AsyncFlicClient.__dict__.get(x[1].__name__, x[1])), FlicClient._EVENT_DISPATCH))
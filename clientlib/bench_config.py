@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Config loading benchmark.
+#
+# Generates button_actions.cfg files of growing size and times how long ConfigFileParser.parse_config takes to load
+# them, with a full parse (no cache) and from the parsed config cache.
+
+import argparse
+import os
+import tempfile
+import time
+
+import config_file_parser
+
+def write_config(file_name, nb_buttons, nb_actions):
+    """Writes a config with nb_buttons buttons using nb_actions actions of every kind, and one state per action."""
+    with open(file_name, "w") as f:
+        for i in range(nb_actions):
+            f.write("[STATE State %d]\npower: on\ncolor: red\nbrightness: 0.5\nduration: 1.0\nselector: group:Room %d\n\n" % (i, i % 20))
+            if i % 4 == 0:
+                f.write("[ACTION Action %d]\nToggle: group:Room %d\nDuration: 1.0\n\n" % (i, i % 20))
+            elif i % 4 == 1:
+                f.write("[ACTION Action %d]\nSet state: State %d\nSelector: group:Room %d\n\n" % (i, i, i % 20))
+            elif i % 4 == 2:
+                f.write("[ACTION Action %d]\nSet states: State %d, State %d\nDefault: State %d\n\n" % (i, i, i - 1, i - 2))
+            else:
+                f.write("[ACTION Action %d]\nActivate Scene: b93f98d6-d175-419a-befa-%012x\n\n" % (i, i))
+        for i in range(nb_buttons):
+            f.write("[BUTTON 80:e4:da:%02x:%02x:%02x]\nSingleClick: Action %d\nDoubleClick: Action %d\nHold: Action %d\n\n" % (
+                i >> 16, (i >> 8) & 0xff, i & 0xff, i % nb_actions, (i + 1) % nb_actions, (i + 2) % nb_actions))
+
+def time_parse(rounds, use_cache):
+    """Returns the best time of rounds calls to parse_config, in milliseconds."""
+    cache_file_name = config_file_parser.ConfigFileParser.config_file_name + config_file_parser.ConfigFileParser.cache_suffix
+    best = None
+    for _ in range(rounds):
+        if not use_cache and os.path.exists(cache_file_name):
+            os.remove(cache_file_name)
+        start = time.perf_counter()
+        config_file_parser.ConfigFileParser().parse_config()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Config loading benchmark")
+    parser.add_argument("--sizes", default="10,100,500,1000", help="comma separated numbers of buttons, with 10 actions per button")
+    parser.add_argument("--rounds", type=int, default=5, help="number of timed rounds, the best one is reported")
+    args = parser.parse_args()
+
+    config_dir = tempfile.mkdtemp()
+    config_file_name = os.path.join(config_dir, "button_actions.cfg")
+    config_file_parser.ConfigFileParser.config_file_name = config_file_name
+
+    print("%8s %8s %10s %14s %14s" % ("buttons", "actions", "size (kB)", "full parse ms", "cached ms"))
+    try:
+        for nb_buttons in [int(x) for x in args.sizes.split(",")]:
+            nb_actions = nb_buttons * 10
+            write_config(config_file_name, nb_buttons, nb_actions)
+            full = time_parse(args.rounds, False)
+            # Write the cache, then time loading from it
+            config_file_parser.ConfigFileParser().parse_config()
+            cached = time_parse(args.rounds, True)
+            print("%8d %8d %10.0f %14.2f %14.2f" % (nb_buttons, nb_actions, os.path.getsize(config_file_name) / 1024.0, full, cached))
+    finally:
+        for name in os.listdir(config_dir):
+            os.remove(os.path.join(config_dir, name))
+        os.rmdir(config_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for the flicd event decoding path.
+#
+# Replays a button-event stream through FlicClient._dispatch_event and reports events/sec.
+# The stream mirrors what flicd sends for a single click on each connected button:
+# up/down, click/hold, single/double and single/double/hold events for every channel.
+
+import argparse
+import socket
+import struct
+import time
+import tracemalloc
+
+import fliclib
+
+def button_event_stream(nb_buttons, nb_clicks):
+	"""Builds a list of raw event packets (without the length prefix) as flicd would send them."""
+	button_event = struct.Struct("<BIBBI")
+	opcodes = dict((x[0], i) for i, x in enumerate(fliclib.FlicClient._EVENTS))
+
+	click = [
+		("EvtButtonUpOrDown", fliclib.ClickType.ButtonDown),
+		("EvtButtonUpOrDown", fliclib.ClickType.ButtonUp),
+		("EvtButtonClickOrHold", fliclib.ClickType.ButtonClick),
+		("EvtButtonSingleOrDoubleClick", fliclib.ClickType.ButtonSingleClick),
+		("EvtButtonSingleOrDoubleClickOrHold", fliclib.ClickType.ButtonSingleClick)
+	]
+
+	packets = []
+	for i in range(nb_clicks):
+		conn_id = i % nb_buttons
+		for event_name, click_type in click:
+			packets.append(button_event.pack(opcodes[event_name], conn_id, click_type.value, 0, 0))
+	return packets
+
+def advertisement_stream(nb_buttons, nb_packets):
+	"""Builds a list of EvtAdvertisementPacket packets from a fixed set of buttons, as seen while scanning."""
+	advertisement = struct.Struct("<BI6s17pb??")
+	packets = []
+	for i in range(nb_packets):
+		button = i % nb_buttons
+		packets.append(advertisement.pack(0, 0, bytes([button & 0xff, button >> 8, 0x71, 0xda, 0xe4, 0x80]), b"F023", -60, False, True))
+	return packets
+
+def get_info_packet(nb_buttons):
+	"""Builds an EvtGetInfoResponse packet listing nb_buttons verified buttons."""
+	packet = struct.pack("<BB6sBBhBBH", 9, 2, bytes(6), 0, 3, 10, 0, 0, nb_buttons)
+	for i in range(nb_buttons):
+		packet += bytes([i & 0xff, i >> 8, 0x71, 0xda, 0xe4, 0x80])
+	return packet
+
+def make_client(nb_buttons):
+	"""Creates a FlicClient connected to a throwaway local listener, with one channel per button."""
+	listener = socket.socket()
+	listener.bind(("127.0.0.1", 0))
+	listener.listen(1)
+	client = fliclib.FlicClient("127.0.0.1", listener.getsockname()[1])
+	server_side = listener.accept()[0]
+	listener.close()
+
+	for i in range(nb_buttons):
+		channel = fliclib.ButtonConnectionChannel("80:e4:da:71:%02x:%02x" % (i >> 8, i & 0xff))
+		channel._conn_id = i
+		channel.on_button_single_or_double_click_or_hold = lambda channel, click_type, was_queued, time_diff: None
+		client._connection_channels[i] = channel
+
+	return client, server_side
+
+def run(packets, client, rounds):
+	dispatch = client._dispatch_event
+	best = None
+	for _ in range(rounds):
+		start = time.perf_counter()
+		for data in packets:
+			dispatch(data)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return len(packets) / best
+
+def count_allocations(client, nb_buttons, nb_events):
+	"""Dispatches nb_events advertisement packets and get info responses while keeping every decoded value alive.
+	
+	Returns the number of memory blocks and bytes still allocated afterwards, i.e. what the decoded events cost.
+	"""
+	kept = []
+	scanner = fliclib.ButtonScanner()
+	scanner._scan_id = 0
+	scanner.on_advertisement_packet = lambda scanner, bd_addr, name, rssi, is_private, already_verified: kept.append((bd_addr, name))
+	client._scanners[0] = scanner
+	
+	adverts = advertisement_stream(nb_buttons, nb_events)
+	info = get_info_packet(nb_buttons)
+	
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	for data in adverts:
+		client._dispatch_event(data)
+	for i in range(nb_events // 100):
+		client._get_info_response_queue.put(kept.append)
+		client._dispatch_event(info)
+	after = tracemalloc.take_snapshot()
+	tracemalloc.stop()
+	
+	stats = after.compare_to(before, "filename")
+	return sum(x.count_diff for x in stats), sum(x.size_diff for x in stats)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--buttons", type=int, default=12, help="number of connected buttons")
+	parser.add_argument("--clicks", type=int, default=20000, help="number of clicks in the stream")
+	parser.add_argument("--rounds", type=int, default=5, help="number of timed rounds, the best one is reported")
+	parser.add_argument("--tracemalloc", action="store_true", help="also count the allocations made per 10k decoded advertisement packets")
+	args = parser.parse_args()
+
+	packets = button_event_stream(args.buttons, args.clicks)
+	client, server_side = make_client(args.buttons)
+
+	events_per_sec = run(packets, client, args.rounds)
+	print("%d events, %d buttons: %.0f events/sec" % (len(packets), args.buttons, events_per_sec))
+	
+	if args.tracemalloc:
+		blocks, size = count_allocations(client, args.buttons, 10000)
+		print("10000 advertisement packets + 100 get info responses: %d blocks, %d bytes retained" % (blocks, size))
+
+	server_side.close()
+	client.close()
+
+if __name__ == "__main__":
+	main()
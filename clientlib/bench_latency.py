@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# End-to-end click-to-light latency benchmark.
+#
+# Runs the real ButtonHandler pipeline against fakeflicd.FakeFlicd and a stubbed light service, and times each click
+# through the stages below. The clicks of a button reach its channel in the order they were sent, so the stages are
+# matched up with a queue of the clicks sent to every button.
+#
+#   socket_read  fake flicd send -> FlicClient._dispatch_event of the event that triggers the action
+#   dispatch     _dispatch_event -> ButtonHandler channel callback
+#   lookup       channel callback -> compiled action found in the action table
+#   queue        _do_button_action -> action picked up by an ActionExecutor worker
+#   backend      worker -> light service call issued
+#   total        fake flicd send -> light service call issued
+#
+# The queued_flush scenario sends queued clicks as a reconnecting button would, half of them older than the queued max
+# age, the last click of every button being a double click that sets a state. The fresh ones are replayed in bursts
+# folded down to their net effect, the toggles cancelling each other out, so only the states reach the backend. The
+# stages of the replayed actions are timed from the click that ended the burst.
+#
+# Results are printed and written as JSON (--output) so runs can be compared.
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+import buttonhandler
+import config_file_parser
+import fakeflicd
+import fliclib
+
+STAGES = ["socket_read", "dispatch", "lookup", "queue", "backend", "total"]
+
+# Opcodes of the button events, whichever event family ButtonHandler listens to
+_BUTTON_EVENTS = set(i for i, x in enumerate(fakeflicd.FlicClient._EVENTS) if x[0].startswith("EvtButton"))
+
+class StubLightService(object):
+    """Light service that records when each call is issued instead of talking to any lights.
+
+    Attributes:
+        delay: seconds each call blocks for, to simulate a slow backend.
+    """
+
+    def __init__(self, tracer, delay=0):
+        self.tracer = tracer
+        self.delay = delay
+
+    def _call(self):
+        self.tracer.mark("backend_call")
+        if self.delay > 0:
+            time.sleep(self.delay)
+        self.tracer.completed()
+
+    def toggle(self, selector, duration):
+        self._call()
+
+    def set_state(self, state, selector):
+        self._call()
+
+    def set_states(self, states, default):
+        self._call()
+
+    def compile_set_state(self, state, selector):
+        return self._call
+
+    def compile_set_states(self, states, default):
+        return self._call
+
+    def activate_scene(self, uuid, duration):
+        self._call()
+
+class Tracer(object):
+    """Collects the stage timestamps of each click.
+
+    The click being processed is the oldest click sent to the button of the event being handled that the ButtonHandler
+    has not seen yet, and is tracked per thread so the ActionExecutor workers can carry it on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.marks = {}
+        self.local = threading.local()
+        # button address -> ids of the clicks sent to the button that its channel callback has not been called for yet
+        self.unseen = collections.defaultdict(collections.deque)
+        self.nb_completed = 0
+        self.nb_dropped = 0
+        self.nb_submitted = 0
+        self.nb_replayed = 0
+
+    @property
+    def current(self):
+        return getattr(self.local, "current", None)
+
+    @current.setter
+    def current(self, click_id):
+        self.local.current = click_id
+
+    def sent(self, click_id, bd_addr):
+        with self.lock:
+            self.marks[click_id] = {"sent": time.perf_counter()}
+        self.unseen[bd_addr].append(click_id)
+
+    def begin(self, click_id, name):
+        self.current = click_id
+        self.mark(name)
+
+    def clicked(self, bd_addr):
+        # The channel callback of a button is called once per click
+        unseen = self.unseen[bd_addr]
+        self.begin(unseen.popleft() if unseen else None, "callback")
+
+    def dispatched(self, bd_addr):
+        # A click is reported in several events; keep the dispatch time of the last one before the ButtonHandler callback
+        unseen = self.unseen[bd_addr]
+        marks = self.marks.get(unseen[0]) if unseen else None
+        if marks is not None:
+            marks["dispatch"] = time.perf_counter()
+
+    def submitted(self):
+        with self.lock:
+            self.nb_submitted += 1
+
+    def replayed(self, count):
+        with self.lock:
+            self.nb_replayed += count
+            self.lock.notify_all()
+
+    def mark(self, name):
+        marks = self.marks.get(self.current)
+        if marks is not None:
+            marks[name] = time.perf_counter()
+
+    def completed(self):
+        with self.lock:
+            self.nb_completed += 1
+            self.lock.notify_all()
+
+    def dropped(self):
+        with self.lock:
+            self.nb_dropped += 1
+            self.lock.notify_all()
+
+    def wait_completed(self, count, timeout):
+        with self.lock:
+            return self.lock.wait_for(lambda: self.nb_completed + self.nb_dropped >= count, timeout)
+
+    def wait_flushed(self, policy, count, timeout):
+        """Waits for count queued clicks to be replayed or dropped as stale, and for the actions replayed to complete."""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.nb_replayed + policy.get_metrics()['stale'] >= count and self.nb_completed + self.nb_dropped >= self.nb_submitted, timeout)
+
+def write_config(file_name, buttons):
+    """Writes a config mapping the click types of every button to actions on a group of its own.
+
+    Actions are routed to the workers by selector, so one group per button spreads the clicks over all the workers like
+    buttons in different rooms would.
+    """
+    with open(file_name, "w") as f:
+        f.write("[STATE Bench State]\npower: on\n\n")
+        for i, bd_addr in enumerate(buttons):
+            f.write("[ACTION Toggle %d]\nToggle: group:Bench %d\n\n" % (i, i))
+            f.write("[ACTION Set State %d]\nSet state: Bench State\nSelector: group:Bench %d\n\n" % (i, i))
+            f.write("[BUTTON %s]\nSingleClick: Toggle %d\nDoubleClick: Set State %d\nHold: Toggle %d\n\n" % (bd_addr, i, i, i))
+
+def instrument(handler, tracer):
+    """Wraps the ButtonHandler and FlicClient methods on the click path to record stage timestamps."""
+    client = handler.client
+    dispatch_event = client._dispatch_event
+    def traced_dispatch_event(data):
+        if len(data) > 0 and data[0] in _BUTTON_EVENTS:
+            channel = client._connection_channels.get(int.from_bytes(data[1:5], "little"))
+            if channel is not None:
+                tracer.dispatched(channel.bd_addr)
+        dispatch_event(data)
+    client._dispatch_event = traced_dispatch_event
+
+    on_click = handler._on_button_event
+    def traced_on_click(channel, click_type, was_queued, time_diff):
+        if click_type != fliclib.ClickType.ButtonUp:
+            tracer.clicked(channel.bd_addr)
+        on_click(channel, click_type, was_queued, time_diff)
+    handler._on_button_event = traced_on_click
+
+    do_button_action = handler._do_button_action
+    def traced_do_button_action(button_action):
+        tracer.mark("do_button_action")
+        do_button_action(button_action)
+    handler._do_button_action = traced_do_button_action
+
+    policy = handler.queued_event_policy
+    end_burst = policy._end_burst
+    def traced_end_burst():
+        count = len(policy._burst)
+        end_burst()
+        tracer.replayed(count)
+    policy._end_burst = traced_end_burst
+
+    submit = handler.action_executor.submit
+    def traced_submit(key, function, *args):
+        click_id = tracer.current
+        tracer.submitted()
+        def traced_function(*args):
+            tracer.begin(click_id, "worker")
+            function(*args)
+        if not submit(key, traced_function, *args):
+            tracer.dropped()
+            return False
+        return True
+    handler.action_executor.submit = traced_submit
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if len(values) == 0:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+def summarize(tracer, nb_clicks, elapsed):
+    stage_marks = [
+        ("socket_read", "sent", "dispatch"),
+        ("dispatch", "dispatch", "callback"),
+        ("lookup", "callback", "do_button_action"),
+        ("queue", "do_button_action", "worker"),
+        ("backend", "worker", "backend_call"),
+        ("total", "sent", "backend_call")
+    ]
+    durations = dict((x, []) for x in STAGES)
+    for marks in tracer.marks.values():
+        for stage, start, end in stage_marks:
+            if start in marks and end in marks:
+                durations[stage].append((marks[end] - marks[start]) * 1000.0)
+
+    result = {
+        "clicks": nb_clicks,
+        "completed": tracer.nb_completed,
+        "dropped": tracer.nb_dropped,
+        "elapsed_s": elapsed,
+        "throughput_per_s": tracer.nb_completed / elapsed if elapsed > 0 else None,
+        "stages_ms": {}
+    }
+    for stage in STAGES:
+        values = sorted(durations[stage])
+        result["stages_ms"][stage] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99)
+        }
+    return result
+
+def run_scenario(name, nb_buttons, nb_clicks, rate, backend_delay=0, was_queued=False, queued_max_age=10, timeout=30):
+    """Runs one scenario against a fresh fake flicd and ButtonHandler and returns its summary.
+
+    Queued clicks are sent oldest first, with ages going down from twice queued_max_age seconds to 0, and the last
+    queued click of every button is a double click.
+    """
+    buttons = ["80:e4:da:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(nb_buttons)]
+    fake = fakeflicd.FakeFlicd("127.0.0.1", 0, buttons)
+    fake.start()
+
+    config_dir = tempfile.mkdtemp()
+    config_file_name = os.path.join(config_dir, "button_actions.cfg")
+    write_config(config_file_name, buttons)
+    config_file_parser.ConfigFileParser.config_file_name = config_file_name
+
+    tracer = Tracer()
+    # Every live click must reach the backend to be timed, so don't let the coalescer fold any
+    handler = buttonhandler.ButtonHandler({}, *fake.server_address, coalesce_window=0, queued_max_age=queued_max_age, watch_config=False)
+    instrument(handler, tracer)
+    thread = threading.Thread(target=handler.start, args=(StubLightService(tracer, backend_delay),), daemon=True)
+    thread.start()
+    fake.wait_for_channels(timeout=timeout)
+
+    start = time.perf_counter()
+    interval = 1.0 / rate if rate > 0 else 0
+    for i in range(nb_clicks):
+        if interval > 0:
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        age = (nb_clicks - 1 - i) * 2 * queued_max_age // nb_clicks if was_queued else 0
+        click_type = "double" if was_queued and i >= nb_clicks - nb_buttons else "single"
+        tracer.sent(i, buttons[i % nb_buttons])
+        fake.click(buttons[i % nb_buttons], click_type, was_queued, age)
+
+    if was_queued:
+        # Folded and stale clicks never reach the backend
+        tracer.wait_flushed(handler.queued_event_policy, nb_clicks, timeout)
+    else:
+        tracer.wait_completed(nb_clicks, timeout)
+    elapsed = time.perf_counter() - start
+
+    handler.client.close()
+    thread.join(timeout)
+    fake.stop()
+    shutil.rmtree(config_dir)
+
+    result = summarize(tracer, nb_clicks, elapsed)
+    result["scenario"] = name
+    result["buttons"] = nb_buttons
+    result["rate_per_s"] = rate
+    result["backend_delay_s"] = backend_delay
+    result["was_queued"] = was_queued
+    if was_queued:
+        result["queued_max_age_s"] = queued_max_age
+        result["queued"] = handler.queued_event_policy.get_metrics()
+        result["folded"] = handler.action_coalescer.get_metrics()
+    return result
+
+SCENARIOS = {
+    "single_button": dict(nb_buttons=1, nb_clicks=500, rate=200),
+    "fifty_buttons": dict(nb_buttons=50, nb_clicks=5000, rate=0),
+    "queued_flush": dict(nb_buttons=10, nb_clicks=1000, rate=0, was_queued=True, queued_max_age=10),
+    "slow_backend": dict(nb_buttons=5, nb_clicks=200, rate=100, backend_delay=0.02)
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Click-to-light latency benchmark")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--output", default="bench_latency.json", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    results = []
+    for name in (args.scenario or sorted(SCENARIOS)):
+        result = run_scenario(name, **SCENARIOS[name])
+        results.append(result)
+        print("\n%s: %d/%d clicks reached the backend (%d dropped), %.0f clicks/s" % (name, result["completed"], result["clicks"], result["dropped"], result["throughput_per_s"]))
+        if result["was_queued"]:
+            print("    %d queued clicks replayed in %d burst(s), %d stale, %d toggles cancelled, %d states replaced" % (
+                result["queued"]["replayed"], result["queued"]["bursts"], result["queued"]["stale"], result["folded"]["toggles_cancelled"], result["folded"]["states_replaced"]))
+        for stage in STAGES:
+            stats = result["stages_ms"][stage]
+            if stats["count"] > 0:
+                print("    %-12s p50 %8.3f ms   p95 %8.3f ms   p99 %8.3f ms" % (stage, stats["p50"], stats["p95"], stats["p99"]))
+
+    with open(args.output, "w") as f:
+        json.dump({"time": time.time(), "python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
+    print("\nResults written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 import sys
+import types
 import fliclib
 import config_file_parser
+import actionexecutor
+import actioncoalescer
+import queuedeventpolicy
+import configwatcher
 from enum import Enum
 
 class ConfigButtonHandler(object):
@@ -25,7 +30,7 @@ class ConfigButtonHandler(object):
         if not was_queued:
             print("Button pressed: " + channel.bd_addr)
         
-    def _got_button(self, bd_addr):
+    def _create_channel(self, bd_addr):
         """Creates a button connection channel and assigns the handler function for button presses for a particular button.
     
         Args:
@@ -33,16 +38,23 @@ class ConfigButtonHandler(object):
         """
         cc = fliclib.ButtonConnectionChannel(bd_addr)
         cc.on_button_single_or_double_click_or_hold = self._on_button_single_or_double_click_or_hold
-        self.client.add_connection_channel(cc)
+        return cc
+        
+    def _got_button(self, bd_addr):
+        """Creates and adds a button connection channel for a particular button.
+    
+        Args:
+            bd_addr: button address.
+        """
+        self.client.add_connection_channel(self._create_channel(bd_addr))
         
     def _got_info(self, items):
-        """Handler for getting info from the button server. Calls got_button for each button address it receives from the server.
+        """Handler for getting info from the button server. Adds a connection channel for each button address it receives from the server in one batch.
     
         Args:
             items: information retrieved from the server. We only care about the button addresses of verified buttons.
         """
-        for bd_addr in items["bd_addr_of_verified_buttons"]:
-            self._got_button(bd_addr)
+        self.client.add_connection_channels([self._create_channel(bd_addr) for bd_addr in items["bd_addr_of_verified_buttons"]])
         
     def start(self):     
         """Initializes the ButtonConnectionChannels and starts listening for button events.
@@ -57,6 +69,28 @@ class ConfigButtonHandler(object):
         self.client.handle_events()
         
         
+class CompiledAction(object):
+    """A button action resolved against the config and the light service, ready to be queued on the action executor.
+    
+    Attributes:
+        action_name: name of the action in the config file.
+        action_type: type of the action.
+        key: action executor key, i.e. the selector of the lights the action changes. Actions on the same key run in
+            the order of the clicks, actions on overlapping but different selectors are not ordered with each other.
+        function: light service function to call.
+        args: arguments to call the function with.
+    """
+    
+    __slots__ = ('action_name', 'action_type', 'key', 'function', 'args')
+    
+    def __init__(self, action_name, action_type, key, function, args):
+        self.action_name = action_name
+        self.action_type = action_type
+        self.key = key
+        self.function = function
+        self.args = args
+        
+        
 class ButtonHandler(object):
     """Handles button presses by calling the appropriate function for the button action that occurred.
     """
@@ -66,22 +100,53 @@ class ButtonHandler(object):
         Button = 'BUTTON'
         State = 'STATE'
     
-    def __init__(self, light_data):
-        """Inits ButtonHandler by starting up a FlicClient to listen for button presses. Also creates a dictionary mapping click types to functions to handle them.
+    # Actions that leave the lights in the same state however many times they run
+    idempotent_action_types = ['SetState', 'SetStates', 'ActivateScene']
+    
+    # Button config attribute holding the action of each click type.
+    # ButtonDown and ButtonClick are only reported to buttons listening on a faster event family, see _create_channel
+    click_type_actions = {
+        fliclib.ClickType.ButtonSingleClick: 'single_click_action',
+        fliclib.ClickType.ButtonDoubleClick: 'double_click_action',
+        fliclib.ClickType.ButtonHold: 'hold_action',
+        fliclib.ClickType.ButtonDown: 'single_click_action',
+        fliclib.ClickType.ButtonClick: 'single_click_action'
+    }
+    
+    def __init__(self, light_data, host="localhost", port=5551, action_executor=None, metrics_interval=0, coalesce_window=0.3, queued_max_age=10, watch_config=True, config_file_name=None):
+        """Inits ButtonHandler by starting up a FlicClient to listen for button presses.
         
         Args:
             light_data: light information retrieved from the lightservice.
+            host: address of the flicd server.
+            port: port of the flicd server.
+            action_executor: ActionExecutor running the light actions, a default one is created if None.
+            metrics_interval: seconds between two prints of the action executor metrics, 0 to never print them.
+            coalesce_window: seconds during which the actions on the same lights are folded together, 0 to run every action.
+            queued_max_age: seconds after which a click queued by a disconnected button is too old to be replayed, 0 to ignore queued clicks.
+            watch_config: whether to reload the config file when it changes.
+            config_file_name: the config file to load, ConfigFileParser.config_file_name if None.
         """
-        self.client = fliclib.FlicClient("localhost")
+        self.client = fliclib.FlicClient(host, port)
         self.data = light_data
-        self.click_functions = {
-            'ClickType.ButtonSingleClick': self._on_single_click,
-            'ClickType.ButtonDoubleClick': self._on_double_click,
-            'ClickType.ButtonHold': self._on_hold
-        }
+        self.action_executor = action_executor if action_executor is not None else actionexecutor.ActionExecutor()
+        self.action_coalescer = actioncoalescer.ActionCoalescer(self.client, self.action_executor, coalesce_window)
+        self.queued_event_policy = queuedeventpolicy.QueuedEventPolicy(self.client, self.action_coalescer, queued_max_age)
+        self.metrics_interval = metrics_interval
         self.buttons = {}
         self.actions = {}
         self.states = {}
+        # (button address, click type) -> CompiledAction, built by _load_config
+        self.action_table = types.MappingProxyType({})
+        # button address -> (ButtonConnectionChannel, event families it listens to), for the configured buttons only
+        self.channels = {}
+        # addresses of the buttons verified by the server, configured or not
+        self.verified_buttons = set()
+        self.watch_config = watch_config
+        self.config_watcher = None
+        self.config_parser = config_file_parser.ConfigFileParser(config_file_name)
+        # Config and action table as last compiled, ahead of the ones in use until the event thread swaps them in
+        self._compiled_config = None
         
         self.light_service = None
     
@@ -95,105 +160,341 @@ class ButtonHandler(object):
         """
         pass
         
-    def _on_button_single_or_double_click_or_hold(self, channel, click_type, was_queued, time_diff):
-        """Function to execute whenever a connected button is pressed. Executes the appropriate click_type handler function.
+    def _on_button_event(self, channel, click_type, was_queued, time_diff):
+        """Function to execute whenever a connected button is pressed. Runs the action configured for the button and click type.
     
         Args:
             channel: the button channel the click event occurred on.
             click_type: the click type that occurred.
             was_queued: bool indicating whether this was a queued click event.
-            time_diff: ???
+            time_diff: if queued, seconds since the click happened.
         """
-        # Execute the appropriate click function with the button address as the argument
-        if not was_queued:
-            self.click_functions[str(click_type)](channel.bd_addr)
+        # Click types without an action (ButtonUp, unconfigured buttons or click types) are ignored.
+        action = self.action_table.get((channel.bd_addr, click_type))
+        if action is None:
+            return
+        if was_queued:
+            self.queued_event_policy.add(action, time_diff)
+        else:
+            # Queued clicks happened before this one, so they must not run after it
+            self.queued_event_policy.flush()
+            self._do_button_action(action)
+    
+    def _on_double_click_correction(self, channel, click_type, was_queued, time_diff):
+        """Function to execute on the single or double click events of a button in fire on press mode. Its single click action has already run, so only double clicks are handled.
+    
+        Args:
+            channel: the button channel the click event occurred on.
+            click_type: the click type that occurred.
+            was_queued: bool indicating whether this was a queued click event.
+            time_diff: if queued, seconds since the click happened.
+        """
+        if click_type == fliclib.ClickType.ButtonDoubleClick:
+            self._on_button_event(channel, click_type, was_queued, time_diff)
             
-    def _on_single_click(self, button_addr):
-        """Function to handle single clicks for a certain button.
+    def _do_button_action(self, action):
+        """Queues a compiled button action on the action executor, through the action coalescer.
         
         Args:
-            button_addr: address of the button that was clicked.
+            action: the CompiledAction to run.
         """
-        button_action_name = self.buttons[button_addr].single_click_action
-        button_action = self.actions[button_action_name]
-        self._do_button_action(button_action)
-            
-    def _on_double_click(self, button_addr):
-        """Function to handle double clicks for a certain button.
+        self.action_coalescer.submit(action)
+    
+    def _compile_action(self, action_name, config_data):
+        """Resolves an action of the config into a CompiledAction, preparing its light service requests once.
         
         Args:
-            button_addr: address of the button that was clicked.
+            action_name: name of the action in the config file.
+            config_data: the actions, buttons and states of the config, see ConfigFileParser.get_config.
+        
+        Returns:
+            The CompiledAction, or None if the action can't be resolved.
+            A list of the problems found in the action config.
         """
-        button_action_name = self.buttons[button_addr].double_click_action
-        button_action = self.actions[button_action_name]
-        self._do_button_action(button_action)
+        states = config_data['states']
+        action = config_data['actions'].get(action_name)
+        if action is None:
+            return None, ["Action %s is not defined" % action_name]
+        
+        state_names = []
+        if action.action_type == 'SetState':
+            state_names = [action.state]
+        elif action.action_type == 'SetStates':
+            state_names = action.states + ([action.default] if action.default is not None else [])
+        problems = ["Action %s: state %s is not defined" % (action_name, x) for x in state_names if x not in states]
+        if problems:
+            return None, problems
         
-    def _on_hold(self, button_addr):
-        """Function to handle a button hold for a certain button.
+        if action.action_type in ['Toggle', 'ActivateScene']:
+            try:
+                duration = float(action.duration) if action.duration is not None else None
+            except ValueError:
+                return None, ["Action %s: duration %s is not a number" % (action_name, action.duration)]
+            if duration is not None and duration < 0:
+                return None, ["Action %s: duration %s is negative" % (action_name, action.duration)]
+        
+        if action.action_type == 'Toggle':
+            return CompiledAction(action_name, action.action_type, str(action.selector), self.light_service.toggle, (action.selector, duration)), []
+        elif action.action_type == 'ActivateScene':
+            return CompiledAction(action_name, action.action_type, 'scene:' + str(action.uuid), self.light_service.activate_scene, (action.uuid, duration)), []
+        elif action.action_type == 'SetState':
+            try:
+                request = self.light_service.compile_set_state(states[action.state], action.selector)
+            except ValueError as e:
+                return None, ["Action %s: %s" % (action_name, e)]
+            return CompiledAction(action_name, action.action_type, str(action.selector), request, ()), []
+        elif action.action_type == 'SetStates':
+            action_states = [states[state_name] for state_name in action.states]
+            default = states[action.default] if action.default is not None else None
+            try:
+                request = self.light_service.compile_set_states(action_states, default)
+            except ValueError as e:
+                return None, ["Action %s: %s" % (action_name, e)]
+            selectors = ','.join(sorted(set(str(state.selector) for state in action_states)))
+            return CompiledAction(action_name, action.action_type, selectors, request, ()), []
+        elif action.action_type is None:
+            return None, ["Action %s has no action type" % action_name]
+        return None, ["Action %s: %s actions are not supported" % (action_name, action.action_type)]
+    
+    def _compile_action_table(self, config_data, button_addrs=None, previous_table=None):
+        """Compiles a config into the table of actions to run for each button and click type.
         
         Args:
-            button_addr: address of the button that was clicked.
+            config_data: the actions, buttons and states of the config, see ConfigFileParser.get_config.
+            button_addrs: the buttons to compile, all the buttons of the config if None.
+            previous_table: action table to take the entries of the other buttons of the config from.
+        
+        Returns:
+            A read-only dictionary mapping (button address, ClickType) to a CompiledAction.
+            A list of the problems found in the config.
         """
-        button_action_name = self.buttons[button_addr].hold_action
-        button_action = self.actions[button_action_name]
-        self._do_button_action(button_action)
-            
-    def _do_button_action(self, button_action):
-        if button_action.action_type == 'Toggle':
-            self.light_service.toggle(button_action.selector, button_action.duration)
-        elif button_action.action_type == 'ActivateScene':
-            self.light_service.activate_scene(button_action.uuid, button_action.duration)
-        elif button_action.action_type == 'SetState':
-            state = self.states[button_action.state]
-            self.light_service.set_state(state, button_action.selector)
-        elif button_action.action_type == 'SetStates':
-            states = []
-            for state_name in button_action.states:
-                states.append(self.states[state_name])
-            self.light_service.set_states(states, self.states[button_action.default])
+        compiled_actions = {}
+        table = {}
+        problems = []
+        buttons = config_data['buttons']
+        if button_addrs is not None:
+            table.update((key, action) for key, action in previous_table.items() if key[0] in buttons and key[0] not in button_addrs)
+            buttons = dict((x, buttons[x]) for x in button_addrs if x in buttons)
+        for button_addr, button in buttons.items():
+            for click_type, attribute in ButtonHandler.click_type_actions.items():
+                action_name = getattr(button, attribute)
+                if action_name is None:
+                    continue
+                if action_name not in compiled_actions:
+                    compiled_actions[action_name], action_problems = self._compile_action(action_name, config_data)
+                    problems += ["Button %s: %s" % (button_addr, x) for x in action_problems]
+                if compiled_actions[action_name] is not None:
+                    table[(button_addr, click_type)] = compiled_actions[action_name]
+        return types.MappingProxyType(table), problems
+    
+    def _print_metrics(self):
+        """Prints the queued click, action coalescer, action executor and light latency metrics and schedules the next print.
+        """
+        coalescer = self.action_coalescer.get_metrics()
+        print("Coalescing: %d passed, %d flushed, %d pending, %d toggles cancelled, %d states replaced, %d scenes replaced, %d states superseded by a scene" % (
+            coalescer['passed'], coalescer['flushed'], coalescer['pending'], coalescer['toggles_cancelled'], coalescer['states_replaced'], coalescer['scenes_replaced'], coalescer['superseded_by_scene']))
+        queued = self.queued_event_policy.get_metrics()
+        print("Queued clicks: %d replayed in %d bursts, %d stale" % (queued['replayed'], queued['bursts'], queued['stale']))
+        executor = self.action_executor.get_metrics()
+        print("Actions: %d queued, %d done, %d failed, %d dropped, queue depth %d (max %d), wait p50 %s ms, p95 %s ms, max %.1f ms" % (
+            executor['submitted'], executor['completed'], executor['failed'], executor['dropped'], executor['queue_depth'], executor['max_queue_depth'],
+            '%.1f' % executor['p50_wait_ms'] if executor['p50_wait_ms'] is not None else '-',
+            '%.1f' % executor['p95_wait_ms'] if executor['p95_wait_ms'] is not None else '-',
+            executor['max_wait_ms']))
+        if hasattr(self.light_service, 'get_light_latencies'):
+            slowest = list(self.light_service.get_light_latencies().items())[:3]
+            print("Slowest lights: %s" % ", ".join("%s p50 %s ms, max %s ms, %d timeouts" % (
+                mac,
+                '%.1f' % light['p50_ms'] if light['p50_ms'] is not None else '-',
+                '%.1f' % light['max_ms'] if light['max_ms'] is not None else '-',
+                light['timeouts']) for mac, light in slowest))
+        self.client.set_timer(self.metrics_interval * 1000, self._print_metrics)
         
-    def _got_button(self, bd_addr):
-        """Creates a button connection channel and assigns the handler function for button presses for a particular button.
+    def _create_channel(self, bd_addr):
+        """Creates a button connection channel and assigns the handler functions for a particular button.
     
         Args:
             bd_addr: button address.
         """
         cc = fliclib.ButtonConnectionChannel(bd_addr)
         cc.on_connection_status_changed = self._on_connection_status_changed
-        cc.on_button_single_or_double_click_or_hold = self._on_button_single_or_double_click_or_hold
-        self.client.add_connection_channel(cc)
+        event_families = self._get_event_families(bd_addr)
+        for event_family, callback in event_families:
+            setattr(cc, event_family, callback)
+        self.channels[bd_addr] = (cc, event_families)
+        return cc
+    
+    def _get_event_families(self, bd_addr):
+        """Picks the fastest event families that can still tell the configured click types of a button apart.
+        The single or double click families wait for the double click window to pass before reporting a single click.
+    
+        Args:
+            bd_addr: button address.
+        
+        Returns:
+            A list of (ButtonConnectionChannel callback property, handler function) pairs.
+        """
+        button = self.buttons.get(bd_addr)
+        if button is None or button.double_click_action is not None and not self._can_fire_on_press(button):
+            return [('on_button_single_or_double_click_or_hold', self._on_button_event)]
+        elif button.double_click_action is not None:
+            # Fire the single click action on every click and run the double click action on top of it when one is detected
+            return [('on_button_click_or_hold', self._on_button_event), ('on_button_single_or_double_click', self._on_double_click_correction)]
+        elif button.hold_action is not None:
+            return [('on_button_click_or_hold', self._on_button_event)]
+        else:
+            return [('on_button_up_or_down', self._on_button_event)]
+    
+    def _can_fire_on_press(self, button):
+        """Checks whether a button with a double click action can run its single click action before the double click window has passed.
+        
+        Args:
+            button: the button config.
+        
+        Returns:
+            True if the button is configured to fire on press and its single and double click actions are idempotent.
+        """
+        if not button.fire_on_press:
+            return False
+        for action_name in [button.single_click_action, button.double_click_action]:
+            action = self.actions.get(action_name)
+            if action is not None and action.action_type not in ButtonHandler.idempotent_action_types:
+                print("Button %s: %s is not idempotent, ignoring FireOnPress." % (button.button_address, action_name))
+                return False
+        return True
+        
+    def _got_button(self, bd_addr):
+        """Creates and adds a button connection channel for a particular button, if it is in the config.
+    
+        Args:
+            bd_addr: button address.
+        """
+        self.verified_buttons.add(bd_addr)
+        if bd_addr in self.buttons:
+            self.client.add_connection_channel(self._create_channel(bd_addr))
         
     def _got_info(self, items):
-        """Handler for getting info from the button server. Calls _got_button for each button address it receives from the server.
+        """Handler for getting info from the button server. Adds a connection channel for each configured button address it receives from the server in one batch.
     
         Args:
             items: information retrieved from the server. We only care about the button addresses of verified buttons.
         """
-        for bd_addr in items["bd_addr_of_verified_buttons"]:
-            self._got_button(bd_addr)
+        self.verified_buttons.update(items["bd_addr_of_verified_buttons"])
+        self.client.add_connection_channels([self._create_channel(bd_addr) for bd_addr in items["bd_addr_of_verified_buttons"] if bd_addr in self.buttons])
     
     def _load_config(self):
-        """Loads the button config from the config file. Essentially maps button click types to light actions.
+        """Loads the button config from the config file and compiles it into the action table mapping button click types to light actions.
         """
-        config = config_file_parser.ConfigFileParser()
-        config_data = config.get_config()
+        config_data = self.config_parser.get_config()
         self.buttons = config_data['buttons']
         self.actions = config_data['actions']
         self.states = config_data['states']
         
+        self.action_table, problems = self._compile_action_table(config_data)
+        if problems:
+            for problem in problems:
+                print(problem)
+            print("Please fix the config file before running the client.")
+            sys.exit()
+        self._compiled_config = (config_data, self.action_table)
+        
+    def _get_changed_buttons(self, previous_config_data, config_data):
+        """Finds the buttons whose compiled actions may differ between two configs, i.e. the buttons that were added or changed and the buttons using an action or state that was added, changed or removed.
+        The config parser returns the same objects for the files that didn't change, so changes are found by identity.
+        
+        Args:
+            previous_config_data: the config the current action table was compiled from.
+            config_data: the new config.
+        
+        Returns:
+            The set of button addresses to compile again.
+        """
+        changed = {}
+        for key in ['buttons', 'actions', 'states']:
+            previous, current = previous_config_data[key], config_data[key]
+            changed[key] = set(x for x in set(previous) | set(current) if previous.get(x) is not current.get(x))
+        return (changed['buttons'] & set(config_data['buttons'])) | self.config_parser.index.buttons_using(changed['actions'], changed['states'])
+        
+    def _reload_config(self):
+        """Parses the changed config files on the config watcher thread and compiles the entries of the buttons they affect, then swaps the new config in on the thread handling the button events.
+        Keeps the current config if the new one has problems.
+        """
+        print("Config file changed, reloading...")
+        # Anything raised here would end the config watcher thread, and the config would never be reloaded again
+        try:
+            config_data = self.config_parser.parse_config()
+            previous_config_data, previous_table = self._compiled_config
+            changed_buttons = self._get_changed_buttons(previous_config_data, config_data)
+            action_table, problems = self._compile_action_table(config_data, changed_buttons, previous_table)
+        except config_file_parser.ConfigError as e:
+            print(e)
+            print("Keeping the previous config.")
+            return
+        except Exception as e:
+            print("Could not reload the config: %s" % e)
+            print("Keeping the previous config.")
+            return
+        
+        if problems:
+            for problem in problems:
+                print(problem)
+            print("Keeping the previous config.")
+            return
+        
+        self._compiled_config = (config_data, action_table)
+        print("Recompiled the actions of %d of %d buttons." % (len(changed_buttons), len(config_data['buttons'])))
+        self.client.run_on_handle_events_thread(lambda: self._swap_config(config_data, action_table))
+        
+    def _swap_config(self, config_data, action_table):
+        """Replaces the config and action table in one go, and adds, removes or recreates the connection channels of the buttons added to, removed from or changed in the config.
+        
+        Args:
+            config_data: the new actions, buttons and states.
+            action_table: the new action table compiled from config_data.
+        """
+        self.buttons = config_data['buttons']
+        self.actions = config_data['actions']
+        self.states = config_data['states']
+        self.action_table = action_table
+        
+        removed = [(bd_addr, cc) for bd_addr, (cc, event_families) in self.channels.items() if bd_addr not in self.buttons]
+        changed = [(bd_addr, cc) for bd_addr, (cc, event_families) in self.channels.items() if bd_addr in self.buttons and self._get_event_families(bd_addr) != event_families]
+        added = [bd_addr for bd_addr in self.buttons if bd_addr in self.verified_buttons and bd_addr not in self.channels]
+        for bd_addr, cc in removed:
+            del self.channels[bd_addr]
+            self.client.remove_connection_channel(cc)
+        if changed or added:
+            self.client.add_connection_channels([self._create_channel(bd_addr) for bd_addr in [x for x, cc in changed] + added])
+            for bd_addr, cc in changed:
+                self.client.remove_connection_channel(cc)
+        print("Config reloaded: %d buttons, %d actions, %d states, %d connection channels added, %d removed, %d updated" % (
+            len(self.buttons), len(self.actions), len(self.states), len(added), len(removed), len(changed)))
+        
     def start(self, light_service):
         """Loads the button config, initializes the ButtonConnectionChannels, and starts listening for button events.
         """
-        self._load_config()
         self.light_service = light_service
+        self._load_config()
             
         # Get button information
         self.client.get_info(self._got_info)
         self.client.on_new_verified_button = self._got_button
         
+        if self.metrics_interval > 0:
+            self.client.set_timer(self.metrics_interval * 1000, self._print_metrics)
+        
+        if self.watch_config:
+            self.config_watcher = configwatcher.ConfigWatcher(self.config_parser.get_config_files, self._reload_config, self.config_parser.get_config_directories)
+            self.config_watcher.start()
+        
         # Handle button events
         print("\nClient is now listening for button events. Press a Flic button to test it out!")
-        self.client.handle_events()
+        try:
+            self.client.handle_events()
+        finally:
+            if self.config_watcher is not None:
+                self.config_watcher.stop()
+            self.action_executor.stop()
 
 
     
@@ -2,6 +2,7 @@
 
 import lightlanservice
 import buttonhandler
+import actionexecutor
 import sys
 import argparse
 
@@ -12,6 +13,16 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("light_type", help="lifx or hue", choices=['lifx', 'hue'], type = str.lower)
     parser.add_argument("-c", "--config_mode", action='store_true', help="runs the client in config mode which prints out the light data")
+    parser.add_argument("--device_cache", default="lifx_devices.json", help="file the LIFX lights found on the LAN are kept in, so that they can be used straight away on the next start")
+    parser.add_argument("--rediscovery_interval", type=float, default=300, help="seconds between two discoveries of the LIFX lights on the LAN")
+    parser.add_argument("--state_ttl", type=float, default=60, help="seconds after which the cached power and color of a LIFX light are asked again")
+    parser.add_argument("--workers", type=int, default=4, help="number of threads running light actions in parallel")
+    parser.add_argument("--queue_size", type=int, default=32, help="maximum number of light actions waiting per worker, further actions are dropped")
+    parser.add_argument("--coalesce_window", type=float, default=0.3, help="seconds during which repeated actions on the same lights are folded together, 0 to disable")
+    parser.add_argument("--queued_max_age", type=float, default=10, help="seconds after which a click queued by a disconnected button is too old to be replayed, 0 to ignore queued clicks")
+    parser.add_argument("--config", default="button_actions.cfg", help="button config file, which can include other config files")
+    parser.add_argument("--no_config_reload", action='store_true', help="don't reload the button config when the config file changes")
+    parser.add_argument("--metrics_interval", type=float, default=0, help="seconds between two prints of the light action metrics, 0 to disable")
 
     args = parser.parse_args()
 
@@ -23,7 +34,7 @@ def main():
     # Only LIFX is supported at this point in time
     light_service = None
     if light_type == 'lifx':
-        light_service = lightlanservice.LIFXLightLanService("https://api.lifx.com/v1/")
+        light_service = lightlanservice.LIFXLightLanService("https://api.lifx.com/v1/", args.device_cache, args.rediscovery_interval, args.state_ttl)
 
     data = light_service.refresh_light_data(config_mode)
 
@@ -32,7 +43,8 @@ def main():
         button_handler = buttonhandler.ConfigButtonHandler()
         button_handler.start()
     else:
-        button_handler = buttonhandler.ButtonHandler(data)
+        action_executor = actionexecutor.ActionExecutor(args.workers, args.queue_size)
+        button_handler = buttonhandler.ButtonHandler(data, action_executor=action_executor, metrics_interval=args.metrics_interval, coalesce_window=args.coalesce_window, queued_max_age=args.queued_max_age, watch_config=not args.no_config_reload, config_file_name=args.config)
         button_handler.start(light_service)
 
 
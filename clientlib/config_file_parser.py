@@ -1,9 +1,17 @@
 import configparser
+import glob
+import hashlib
+import json
 import os
 import re
 from enum import Enum
 import sys
 
+class ConfigError(Exception):
+    """Raised when the config file is missing or can't be parsed.
+    """
+    pass
+    
 class Selector(Enum):
     """Different selectors we can use for the LIFX Api.
     """
@@ -48,10 +56,13 @@ class Action(object):
         self.duration = None
         self.state = None
         self.states = None
+        self.default = None
         self.uuid = None
 
 class Button(object):
     """Representation of a button which has 3 button click types: single click, double click, and hold with actions for each event.
+    
+    With fire_on_press set, the single click action runs as soon as the button is clicked instead of after the double click window, and the double click action runs on top of it when a double click is detected.
     """
     
     def __init__(self, button_address):
@@ -60,7 +71,8 @@ class Button(object):
         self.button_address = button_address
         self.single_click_action = None
         self.double_click_action = None
-        self.hold_action = None    
+        self.hold_action = None
+        self.fire_on_press = False
         
 class State(object):
     """Representation of a state in the config file.
@@ -77,28 +89,113 @@ class State(object):
         self.selector = None
         
 
+class ConfigIndex(object):
+    """Index of a config made of several files: which file defines each button, action and state, and which actions and states each button uses.
+    
+    Attributes:
+        sources: dictionary mapping (section type, name) to the file defining the section.
+        button_actions: dictionary mapping each button address to the set of action names it uses.
+        action_states: dictionary mapping each action name to the set of state names it uses.
+    """
+    
+    def __init__(self):
+        self.sources = {}
+        self.button_actions = {}
+        self.action_states = {}
+        
+    def add_file(self, file_name, config_data):
+        """Adds the buttons, actions and states of a file to the index.
+        
+        Returns:
+            A list of the buttons, actions and states also defined by a file added before.
+        """
+        conflicts = []
+        for section_type, key in [('BUTTON', 'buttons'), ('ACTION', 'actions'), ('STATE', 'states')]:
+            for name in config_data[key]:
+                source = self.sources.setdefault((section_type, name), file_name)
+                if source != file_name:
+                    conflicts.append("%s %s is defined in both %s and %s" % (section_type, name, source, file_name))
+        
+        for button_address, button in config_data['buttons'].items():
+            self.button_actions[button_address] = set(x for x in [button.single_click_action, button.double_click_action, button.hold_action] if x is not None)
+        for action_name, action in config_data['actions'].items():
+            self.action_states[action_name] = set(x for x in [action.state, action.default] + (action.states or []) if x is not None)
+        return conflicts
+        
+    def buttons_using(self, action_names, state_names):
+        """Returns the set of buttons using any of the given actions, directly or through one of the given states.
+        """
+        action_names = set(action_names) | set(x for x, states in self.action_states.items() if not states.isdisjoint(state_names))
+        return set(x for x, actions in self.button_actions.items() if not actions.isdisjoint(action_names))
+        
+# Parsed objects of each section of the config, and the argument their constructor takes
+_CACHED_SECTIONS = { 'actions': (Action, 'action_name'), 'buttons': (Button, 'button_address'), 'states': (State, 'state_name') }
+
+def _config_to_cache(config_data):
+    """Returns the parsed config of a file as plain dictionaries and lists, to be written to the cache as JSON.
+    """
+    cached = { 'includes': config_data['includes'] }
+    for section, (cls, name_attribute) in _CACHED_SECTIONS.items():
+        cached[section] = dict((name, vars(x)) for name, x in config_data[section].items())
+    return cached
+
+def _config_from_cache(cached):
+    """Rebuilds the parsed config of a file from _config_to_cache, keeping only the attributes the parsed objects have.
+    """
+    config_data = { 'includes': list(cached['includes']) }
+    for section, (cls, name_attribute) in _CACHED_SECTIONS.items():
+        objects = {}
+        for name, values in cached[section].items():
+            x = cls(values[name_attribute])
+            for attribute in vars(x):
+                setattr(x, attribute, values[attribute])
+            objects[name] = x
+        config_data[section] = objects
+    return config_data
+
 class ConfigFileParser(object):
     """Loads up the configuration from the config file.
+    
+    The config file can include other config files, e.g. one per room, with an INCLUDE section listing file names or glob patterns relative to the config file:
+    [INCLUDE]
+    Files: conf.d/*.cfg
+    Buttons, actions and states can be defined in any of the files, but only once.
+    
     Attributes:
-        config_file_name: name of the config file to load config settings from.
+        config_file_name: name of the default config file to load config settings from.
         valid_section_names: section names we process.
+        cache_suffix: suffix added to the config file name to get the name of the parsed config cache.
+        cache_version: version of the cache format, to bump whenever the parsed objects change.
     """
     
     config_file_name = "button_actions.cfg"
     
     valid_section_names = ['ACTION', 'BUTTON', 'STATE']
     
+    cache_suffix = ".cache"
+    cache_version = 3
     
-    def __init__(self):
-        """Inits ConfigFileParser by initiating a ConfigParser object.
+    section_type_regex = re.compile(r"^[A-Z]+\b")
+    section_name_regexes = dict((x, re.compile(r"^%s\s(.+)" % x)) for x in valid_section_names)
+    
+    
+    def __init__(self, config_file_name=None):
+        """Inits ConfigFileParser.
+        
+        Args:
+            config_file_name: the config file to load, ConfigFileParser.config_file_name if None.
         """
+        self.config_file_name = config_file_name if config_file_name is not None else ConfigFileParser.config_file_name
         self.config = configparser.ConfigParser()
+        # Index of the config loaded by the last parse_config call
+        self.index = None
+        # file name -> (content hash, parsed config) of the files loaded by the last parse_config call
+        self._files = {}
         
     def _get_section_name(self, section, section_type):
         """Function to get the section name for a section in the config file.
         """
-        section_name_regex = re.compile("^%s\s(.+)" % section_type)
-        match = section_name_regex.match(section)
+        match = ConfigFileParser.section_name_regexes[section_type].match(section)
         if match is None:
             print("%s not a valid section header (TYPE <section name>), skipping." % section)
             return None
@@ -108,8 +205,7 @@ class ConfigFileParser(object):
     def _get_section_type(self, section):
         """Function to the section type for a section in the config file.
         """
-        section_type_regex = re.compile("^[A-Z]+\\b")
-        match = section_type_regex.match(section)
+        match = ConfigFileParser.section_type_regex.match(section)
         if match is None or match.group() not in ConfigFileParser.valid_section_names:
             print("%s not a valid section type, skipping." % section)
             return None
@@ -157,6 +253,11 @@ class ConfigFileParser(object):
                 button.double_click_action = self.config[section][key]  
             elif key == 'hold':
                 button.hold_action = self.config[section][key]
+            elif key == 'fireonpress':
+                try:
+                    button.fire_on_press = self.config[section].getboolean(key)
+                except ValueError:
+                    raise ConfigError("%s: FireOnPress must be yes or no" % section)
         return button
         
     def _get_state_info(self, state, section):
@@ -176,7 +277,7 @@ class ConfigFileParser(object):
         return state       
         
     def get_config(self):
-        """Function to get the configuration from the config file.
+        """Function to get the configuration from the config file. Exits if the config file is missing or can't be parsed.
         
         Returns:
             A dictionary of actions, buttons and states.
@@ -187,46 +288,202 @@ class ConfigFileParser(object):
                 'states' : {StateData}
             }
         """
+        try:
+            return self.parse_config()
+        except ConfigError as e:
+            print(e)
+            sys.exit()
+            
+    def parse_config(self):
+        """Function to parse the configuration from the config file and the files it includes.
+        
+        The parsed configuration of each file is cached next to it, and loaded from there instead of parsing the file again as long as its content doesn't change.
+        Files that haven't changed since the last call return the same objects, so callers can tell what changed by identity.
+        
+        Returns:
+            A dictionary of actions, buttons and states, see get_config.
+        
+        Raises:
+            ConfigError: a config file is missing or can't be parsed, or several files define the same button, action or state.
+        """
+        if not os.path.exists(self.config_file_name):
+            raise ConfigError("No existing config found for button actions\n"
+                              "Please run  in config mode to view light data and create a config file")
+        
+        files = self._load_files([self.config_file_name])
+        main_config = files[self.config_file_name][1]
+        included_files = self._get_included_files(main_config['includes'])
+        files.update(self._load_files(included_files))
+        
+        index = ConfigIndex()
+        conflicts = []
+        merged = { 'actions': {}, 'buttons': {}, 'states': {}}
+        for file_name in [self.config_file_name] + included_files:
+            config_data = files[file_name][1]
+            if file_name != self.config_file_name and config_data['includes']:
+                print("%s: only the main config file can include other files, ignoring its INCLUDE section." % file_name)
+            conflicts += index.add_file(file_name, config_data)
+            for key in merged:
+                merged[key].update(config_data[key])
+        if conflicts:
+            raise ConfigError("\n".join(conflicts))
         
+        self._files = files
+        self.index = index
+        return merged
+        
+    def get_config_files(self):
+        """Returns the name of the config file followed by the files currently matching the INCLUDE section loaded by the last parse_config call.
+        """
+        file_names = [self.config_file_name]
+        main_file = self._files.get(self.config_file_name)
+        if main_file is not None:
+            for pattern in main_file[1]['includes']:
+                file_names += [x for x in sorted(glob.glob(self._get_include_path(pattern))) if x not in file_names]
+        return file_names
+
+    def get_config_directories(self):
+        """Returns the directories holding the config file and the files it may include.
+        """
+        directories = set([os.path.dirname(os.path.abspath(self.config_file_name))])
+        main_file = self._files.get(self.config_file_name)
+        if main_file is not None:
+            for pattern in main_file[1]['includes']:
+                directory = os.path.dirname(self._get_include_path(pattern))
+                if glob.escape(directory) == directory and os.path.isdir(directory):
+                    directories.add(directory)
+        return sorted(directories)
+        
+    def _get_include_path(self, pattern):
+        return os.path.join(os.path.dirname(os.path.abspath(self.config_file_name)), pattern)
+        
+    def _get_included_files(self, patterns):
+        """Function to expand the file names and glob patterns of an INCLUDE section.
+        
+        Returns:
+            The sorted list of included files.
+        """
+        file_names = []
+        for pattern in patterns:
+            path = self._get_include_path(pattern)
+            matches = sorted(glob.glob(path))
+            if not matches and glob.escape(path) == path:
+                raise ConfigError("Included config file %s not found" % path)
+            file_names += [x for x in matches if x not in file_names and os.path.abspath(x) != os.path.abspath(self.config_file_name)]
+        return file_names
+        
+    def _load_files(self, file_names):
+        """Function to load config files, from memory or the cache when they didn't change, parsing the others.
+        
+        Returns:
+            A dictionary mapping each file name to its content hash and parsed config.
+        """
+        files = {}
+        to_parse = []
+        for file_name in file_names:
+            try:
+                with open(file_name, 'rb') as config_file:
+                    content = config_file.read()
+            except OSError as e:
+                raise ConfigError("Could not read %s: %s" % (file_name, e))
+            
+            content_hash = hashlib.sha256(content).hexdigest()
+            loaded = self._files.get(file_name)
+            if loaded is not None and loaded[0] == content_hash:
+                files[file_name] = loaded
+                continue
+            config_data = self._load_cache(file_name, content_hash)
+            if config_data is not None:
+                files[file_name] = (content_hash, config_data)
+            else:
+                to_parse.append((file_name, content, content_hash))
+        
+        # Parsed one after the other, a process pool would cost more than a few small files and forking the
+        # multithreaded client is not safe
+        for file_name, content, content_hash in to_parse:
+            config_data = self._parse_content(content, file_name)
+            self._save_cache(file_name, content_hash, config_data)
+            files[file_name] = (content_hash, config_data)
+        return files
+        
+    def _load_cache(self, file_name, content_hash):
+        """Function to load the parsed configuration of a config file from the cache.
+        
+        Returns:
+            The cached dictionary of actions, buttons and states, or None if there is no cache for this config file content.
+        """
+        # The cache is JSON rather than pickle, so that a stale or tampered cache can't run any code when it is loaded
+        try:
+            with open(file_name + ConfigFileParser.cache_suffix, 'r', encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+            if not isinstance(cache, dict) or cache.get('version') != ConfigFileParser.cache_version or cache.get('hash') != content_hash:
+                return None
+            return _config_from_cache(cache['config'])
+        except Exception:
+            # Missing, unreadable or outdated cache, the config file will be parsed
+            return None
+        
+    def _save_cache(self, file_name, content_hash, config_data):
+        """Function to write the parsed configuration of a config file to the cache. The cache is only an optimization, so failing to write it is not an error.
+        """
+        cache_file_name = file_name + ConfigFileParser.cache_suffix
+        try:
+            with open(cache_file_name + '.tmp', 'w', encoding='utf-8') as cache_file:
+                json.dump({'version': ConfigFileParser.cache_version, 'hash': content_hash, 'config': _config_to_cache(config_data)}, cache_file)
+            os.replace(cache_file_name + '.tmp', cache_file_name)
+        except OSError as e:
+            print("Could not write the config cache %s: %s" % (cache_file_name, e))
+        
+    def _parse_content(self, content, file_name=None):
+        """Function to parse the content of a config file.
+        
+        Returns:
+            A dictionary of actions, buttons and states, see get_config, and the file patterns of its INCLUDE section under 'includes'.
+        """
+        file_name = file_name if file_name is not None else self.config_file_name
         actions = {}
         buttons = {}
         states = {}
+        includes = []
         
-        if os.path.exists(ConfigFileParser.config_file_name):
-            self.config.read_file(open(ConfigFileParser.config_file_name))
-            config_sections = self.config.sections()
-            
-            if not len(config_sections):
-                print("No sections declared in the config file...")
-                print("Please add some sections to the config file before running the client.")
-                sys.exit()
-            else:                
-                for section in config_sections:
-                    section_type = self._get_section_type(section)
-                    if section_type == "ACTION":
-                        action_name = self._get_section_name(section, section_type)
-                        action = Action(action_name)
-                        action = self._get_action_info(action, section)
-                        actions[action.action_name] = action
-                        
-                    elif section_type == "BUTTON":
-                        button_address = self._get_section_name(section, section_type)
-                        button = Button(button_address)
-                        button = self._get_button_info(button, section)
-                        buttons[button.button_address] = button
-                        
-                    elif section_type == "STATE":
-                        state_name = self._get_section_name(section, section_type)
-                        state = State(state_name)
-                        state = self._get_state_info(state, section)
-                        states[state.state_name] = state
-                        
-                    else:
-                        print("%s not a valid section type, skipping." % section_type)
-                        continue
-            return { 'actions': actions, 'buttons': buttons, 'states': states}
+        self.config = configparser.ConfigParser()
+        try:
+            self.config.read_string(content.decode('utf-8'), file_name)
+        except (UnicodeDecodeError, configparser.Error) as e:
+            raise ConfigError("Could not read %s: %s" % (file_name, e))
+        config_sections = self.config.sections()
+        
+        if not len(config_sections):
+            raise ConfigError("No sections declared in the config file %s...\n"
+                              "Please add some sections to the config file before running the client." % file_name)
+        
+        for section in config_sections:
+            if section == "INCLUDE":
+                for key in self.config[section]:
+                    if key == 'files':
+                        includes += [x.strip() for x in re.split(r"[,\n]", self.config[section][key]) if x.strip()]
+                continue
             
-        else:
-            print("No existing config found for button actions")
-            print("Please run  in config mode to view light data and create a config file")
-            sys.exit()
+            section_type = self._get_section_type(section)
+            if section_type == "ACTION":
+                action_name = self._get_section_name(section, section_type)
+                action = Action(action_name)
+                action = self._get_action_info(action, section)
+                actions[action.action_name] = action
+                
+            elif section_type == "BUTTON":
+                button_address = self._get_section_name(section, section_type)
+                button = Button(button_address)
+                button = self._get_button_info(button, section)
+                buttons[button.button_address] = button
+                
+            elif section_type == "STATE":
+                state_name = self._get_section_name(section, section_type)
+                state = State(state_name)
+                state = self._get_state_info(state, section)
+                states[state.state_name] = state
+                
+            else:
+                print("%s not a valid section type, skipping." % section_type)
+                continue
+        return { 'actions': actions, 'buttons': buttons, 'states': states, 'includes': includes}
@@ -0,0 +1,132 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+
+# inotify constants, see <sys/inotify.h>
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+
+def _load_inotify():
+    """Returns the C library if it provides inotify, None otherwise."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class ConfigWatcher(object):
+    """Watches config files and calls a function on a background thread whenever their content may have changed.
+
+    Uses inotify on the directories of the files when available, so that editors replacing a file and new files
+    matching an include pattern are noticed too, and falls back to polling the modification times otherwise.
+
+    Attributes:
+        poll_interval: seconds between two checks of the files when polling.
+        settle_time: seconds to wait after a change before calling the function, so that files written in several
+            steps are only reported once.
+    """
+
+    poll_interval = 1.0
+    settle_time = 0.2
+
+    def __init__(self, get_file_names, on_change, get_directories=None):
+        """Inits ConfigWatcher. Call start() to start watching.
+
+        Args:
+            get_file_names: function returning the list of files to watch, called again after every change.
+            on_change: function without arguments to call when the files have changed.
+            get_directories: function returning the list of directories where files may appear, the directories of the
+                watched files if None.
+        """
+        self.get_file_names = get_file_names
+        self.get_directories = get_directories if get_directories is not None else self._get_file_directories
+        self.on_change = on_change
+        self._stopped = threading.Event()
+        self._thread = None
+        self._signature = self._get_signature()
+
+    def start(self):
+        """Starts watching the files on a background thread."""
+        libc = _load_inotify()
+        fd = libc.inotify_init1(_IN_CLOEXEC | _IN_NONBLOCK) if libc is not None else -1
+        if fd >= 0 and not self._add_inotify_watches(libc, fd):
+            os.close(fd)
+            fd = -1
+
+        if fd >= 0:
+            self._thread = threading.Thread(target=self._watch_inotify, args=(libc, fd), name="config-watcher", daemon=True)
+        else:
+            print("inotify not available, polling the config files for changes")
+            self._thread = threading.Thread(target=self._watch_polling, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching the files."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _get_file_directories(self):
+        return sorted(set(os.path.dirname(os.path.abspath(x)) for x in self.get_file_names()))
+
+    def _get_signature(self):
+        signature = []
+        for file_name in self.get_file_names():
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                return None
+            signature.append((file_name, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return signature
+
+    def _check(self):
+        # A file may be missing for a moment while an editor replaces it, wait for the new one
+        signature = self._get_signature()
+        if signature is not None and signature != self._signature:
+            # Keep the signature the files had before the reload, so that a write landing while reloading is noticed
+            self._signature = signature
+            self.on_change()
+            # The change may have added or removed included files
+            if [x[0] for x in signature] != self.get_file_names():
+                self._signature = self._get_signature()
+
+    def _watch_polling(self):
+        while not self._stopped.wait(ConfigWatcher.poll_interval):
+            self._check()
+
+    def _add_inotify_watches(self, libc, fd):
+        # Watching a directory twice is harmless, so the watches can be added again whenever the directories may have changed
+        added = False
+        for directory in self.get_directories():
+            if libc.inotify_add_watch(fd, directory.encode(), _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) >= 0:
+                added = True
+        return added
+
+    def _watch_inotify(self, libc, fd):
+        try:
+            while not self._stopped.is_set():
+                if not select.select([fd], [], [], ConfigWatcher.poll_interval)[0]:
+                    continue
+                # Wait for the writes to settle, swallowing the events they cause.
+                # Events about other files (caches, editor backups) are filtered out by comparing the signatures.
+                self._read_inotify_events(fd)
+                while select.select([fd], [], [], ConfigWatcher.settle_time)[0]:
+                    self._read_inotify_events(fd)
+                self._check()
+                self._add_inotify_watches(libc, fd)
+        finally:
+            os.close(fd)
+
+    def _read_inotify_events(self, fd):
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            pass
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+# A pure python stand-in for flicd, for benchmarks and tests without Bluetooth hardware.
+#
+# It speaks the protocol described by FlicClient._EVENTS and FlicClient._COMMANDS, answers get info,
+# connection channel, button uuid and ping commands, and can send scripted click streams at a given rate
+# or replay a session captured with flicrecorder.py.
+#
+# Examples:
+# python3 fakeflicd.py --nb-buttons 12 --clicks 1000 --rate 20
+# python3 fakeflicd.py --replay session.flicrec --speed 0
+
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import flicrecorder
+from fliclib import FlicClient, ClickType, CreateConnectionChannelError, ConnectionStatus, RemovedReason, BluetoothControllerState, BdAddrType, ScanWizardResult
+
+_EVENT_OPCODES = dict((x[0], i) for i, x in enumerate(FlicClient._EVENTS))
+_EVENT_FIELDS = list(map(lambda x: x[2].split(), FlicClient._EVENTS))
+
+# The events flicd sends on every channel for each kind of click, in order.
+# flicd delays the single click events until the double click window has passed, which is not modelled here.
+CLICK_SEQUENCES = {
+	"single": [
+		("EvtButtonUpOrDown", ClickType.ButtonDown),
+		("EvtButtonUpOrDown", ClickType.ButtonUp),
+		("EvtButtonClickOrHold", ClickType.ButtonClick),
+		("EvtButtonSingleOrDoubleClick", ClickType.ButtonSingleClick),
+		("EvtButtonSingleOrDoubleClickOrHold", ClickType.ButtonSingleClick)
+	],
+	"double": [
+		("EvtButtonUpOrDown", ClickType.ButtonDown),
+		("EvtButtonUpOrDown", ClickType.ButtonUp),
+		("EvtButtonClickOrHold", ClickType.ButtonClick),
+		("EvtButtonUpOrDown", ClickType.ButtonDown),
+		("EvtButtonUpOrDown", ClickType.ButtonUp),
+		("EvtButtonClickOrHold", ClickType.ButtonClick),
+		("EvtButtonSingleOrDoubleClick", ClickType.ButtonDoubleClick),
+		("EvtButtonSingleOrDoubleClickOrHold", ClickType.ButtonDoubleClick)
+	],
+	"hold": [
+		("EvtButtonUpOrDown", ClickType.ButtonDown),
+		("EvtButtonClickOrHold", ClickType.ButtonHold),
+		("EvtButtonSingleOrDoubleClickOrHold", ClickType.ButtonHold),
+		("EvtButtonUpOrDown", ClickType.ButtonUp)
+	]
+}
+
+# Events that carry a conn_id, which has to be translated when replaying a recording to another client
+_CONNECTION_EVENTS = set(_EVENT_OPCODES[x] for x in [
+	"EvtConnectionStatusChanged",
+	"EvtButtonUpOrDown",
+	"EvtButtonClickOrHold",
+	"EvtButtonSingleOrDoubleClick",
+	"EvtButtonSingleOrDoubleClickOrHold"
+])
+
+def pack_event(name, **items):
+	"""Packs an event as a frame (length prefix included), the way flicd sends it."""
+	opcode = _EVENT_OPCODES[name]
+	for key, value in items.items():
+		if hasattr(value, "value"):
+			items[key] = value.value
+	if "bd_addr" in items:
+		items["bd_addr"] = FlicClient._bdaddr_string_to_bytes(items["bd_addr"])
+	if "my_bd_addr" in items:
+		items["my_bd_addr"] = FlicClient._bdaddr_string_to_bytes(items["my_bd_addr"])
+	if "name" in items:
+		items["name"] = items["name"].encode("utf-8")
+
+	packet = bytes([opcode]) + FlicClient._EVENT_STRUCTS[opcode].pack(*[items[x] for x in _EVENT_FIELDS[opcode]])
+	return struct.pack("<H", len(packet)) + packet
+
+def unpack_command(packet):
+	"""Unpacks a command packet into (command name, dict of items)."""
+	opcode = packet[0]
+	name, fmt, fields = FlicClient._COMMANDS[opcode]
+	values = FlicClient._COMMAND_STRUCTS[opcode].unpack_from(packet, 1)
+	items = dict(zip(fields.split(), values))
+	if "bd_addr" in items:
+		items["bd_addr"] = FlicClient._bdaddr_bytes_to_string(items["bd_addr"])
+	return name, items
+
+class _Session(socketserver.BaseRequestHandler):
+	"""One client connection to the fake server."""
+
+	def setup(self):
+		self.fake = self.server.fake
+		self.channels = {} # conn_id -> bd_addr
+		self._send_lock = threading.Lock()
+		self.fake._add_session(self)
+
+	def finish(self):
+		self.fake._remove_session(self)
+
+	def send(self, data):
+		with self._send_lock:
+			try:
+				self.request.sendall(data)
+			except OSError:
+				pass
+
+	def handle(self):
+		buffer = bytearray()
+		while True:
+			try:
+				data = self.request.recv(65536)
+			except OSError:
+				return
+			if len(data) == 0:
+				return
+
+			buffer += data
+			start = 0
+			while len(buffer) - start >= 2:
+				packet_len = buffer[start] | (buffer[start + 1] << 8)
+				if len(buffer) - start - 2 < packet_len:
+					break
+				self._handle_command(bytes(buffer[start + 2 : start + 2 + packet_len]))
+				start += 2 + packet_len
+			del buffer[:start]
+
+	def _handle_command(self, packet):
+		name, items = unpack_command(packet)
+		fake = self.fake
+
+		if name == "CmdGetInfo":
+			addresses = b"".join(map(FlicClient._bdaddr_string_to_bytes, fake.buttons))
+			self.send_info(addresses)
+		elif name == "CmdCreateConnectionChannel":
+			with fake._lock:
+				self.channels[items["conn_id"]] = items["bd_addr"]
+				fake._lock.notify_all()
+			self.send(pack_event("EvtCreateConnectionChannelResponse", conn_id=items["conn_id"], error=CreateConnectionChannelError.NoError, connection_status=ConnectionStatus.Ready))
+		elif name == "CmdRemoveConnectionChannel":
+			with fake._lock:
+				self.channels.pop(items["conn_id"], None)
+			self.send(pack_event("EvtConnectionChannelRemoved", conn_id=items["conn_id"], removed_reason=RemovedReason.RemovedByThisClient))
+		elif name == "CmdForceDisconnect":
+			with fake._lock:
+				removed = [x for x, bd_addr in self.channels.items() if bd_addr == items["bd_addr"]]
+				for conn_id in removed:
+					del self.channels[conn_id]
+			self.send(b"".join(pack_event("EvtConnectionChannelRemoved", conn_id=x, removed_reason=RemovedReason.ForceDisconnectedByThisClient) for x in removed))
+		elif name == "CmdPing":
+			self.send(pack_event("EvtPingResponse", ping_id=items["ping_id"]))
+		elif name == "CmdGetButtonUUID":
+			uuid = bytes(16)
+			if items["bd_addr"] in fake.buttons:
+				uuid = FlicClient._bdaddr_string_to_bytes(items["bd_addr"]) * 2 + bytes(4)
+			self.send(pack_event("EvtGetButtonUUIDResponse", bd_addr=items["bd_addr"], uuid=uuid))
+		elif name == "CmdCreateScanWizard":
+			self.send(pack_event("EvtScanWizardCompleted", scan_wizard_id=items["scan_wizard_id"], result=ScanWizardResult.WizardFailedTimeout))
+		# Scanners, scan wizard cancellation and mode parameter changes are accepted without any event
+
+	def send_info(self, addresses):
+		nb_buttons = len(addresses) // 6
+		packet = bytes([_EVENT_OPCODES["EvtGetInfoResponse"]]) + FlicClient._EVENT_STRUCTS[_EVENT_OPCODES["EvtGetInfoResponse"]].pack(
+			BluetoothControllerState.Attached.value, bytes(6), BdAddrType.PublicBdAddrType.value, 3, 64, 0, 0, nb_buttons) + addresses
+		self.send(struct.pack("<H", len(packet)) + packet)
+
+class _Server(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+class FakeFlicd:
+	"""FakeFlicd class.
+
+	Usage:
+	fake = FakeFlicd("localhost", 0, ["80:e4:da:00:00:01"])
+	fake.start()
+	client = fliclib.FlicClient(*fake.server_address)
+	...
+	fake.wait_for_channels(1)
+	fake.click("80:e4:da:00:00:01")
+	fake.stop()
+	"""
+
+	def __init__(self, host = "localhost", port = 5551, buttons = ()):
+		self.buttons = list(buttons)
+		self._lock = threading.Condition()
+		self._sessions = []
+		self._thread = None
+
+		self._server = _Server((host, port), _Session)
+		self._server.fake = self
+
+	@property
+	def server_address(self):
+		"""The (host, port) the server listens on."""
+		return self._server.server_address[:2]
+
+	def start(self):
+		"""Start serving clients on a background thread."""
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		"""Stop serving and disconnect all clients."""
+		self._server.shutdown()
+		self._server.server_close()
+		with self._lock:
+			sessions = list(self._sessions)
+		for session in sessions:
+			try:
+				session.request.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def wait_for_channels(self, nb_buttons = None, timeout = None):
+		"""Wait until connection channels to nb_buttons distinct buttons (default: all buttons) have been created.
+
+		Returns False if the timeout expired first.
+		"""
+		if nb_buttons is None:
+			nb_buttons = len(self.buttons)
+		with self._lock:
+			return self._lock.wait_for(lambda: len(self._connected_buttons()) >= nb_buttons, timeout)
+
+	def click(self, bd_addr, click_type = "single", was_queued = False, time_diff = 0):
+		"""Send the events of one click of a button to every channel of that button."""
+		sequence = CLICK_SEQUENCES[click_type]
+		for session, conn_ids in self._channels_of(bd_addr):
+			session.send(b"".join(pack_event(name, conn_id=conn_id, click_type=x, was_queued=int(was_queued), time_diff=time_diff) for conn_id in conn_ids for name, x in sequence))
+
+	def run_clicks(self, nb_clicks, rate = 0, click_type = "single", buttons = None, was_queued = False):
+		"""Click the buttons in turn nb_clicks times.
+
+		rate is the number of clicks per second, 0 sends them as fast as possible.
+		"""
+		buttons = list(buttons if buttons is not None else self.buttons)
+		interval = 1.0 / rate if rate > 0 else 0
+		next_time = time.monotonic()
+		for i in range(nb_clicks):
+			if interval > 0:
+				delay = next_time - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+				next_time += interval
+			self.click(buttons[i % len(buttons)], click_type, was_queued)
+
+	def replay(self, records, speed = 1.0):
+		"""Replay the flicd events of a recording to every connected client.
+
+		records is the result of flicrecorder.read_recording(). Connection and button events are sent to the
+		channels the clients have created for the same buttons, other events are answered live instead.
+		speed 1.0 keeps the original timing, 0 sends everything as fast as possible.
+		"""
+		recorded_channels = {}
+		for delay, direction, packet in records:
+			if direction == flicrecorder.COMMAND and packet[0] == FlicClient._COMMAND_NAME_TO_OPCODE["CmdCreateConnectionChannel"]:
+				name, items = unpack_command(packet)
+				recorded_channels[items["conn_id"]] = items["bd_addr"]
+
+		pending_delay = 0
+		for delay, direction, packet in records:
+			pending_delay += delay
+			if direction != flicrecorder.EVENT or packet[0] not in _CONNECTION_EVENTS:
+				continue
+			bd_addr = recorded_channels.get(struct.unpack_from("<I", packet, 1)[0])
+			if bd_addr is None:
+				continue
+
+			if speed > 0 and pending_delay > 0:
+				time.sleep(pending_delay / speed)
+			pending_delay = 0
+
+			for session, conn_ids in self._channels_of(bd_addr):
+				session.send(b"".join(struct.pack("<HBI", len(packet), packet[0], conn_id) + packet[5:] for conn_id in conn_ids))
+
+	def _connected_buttons(self):
+		# Must be called with the lock held
+		return set(bd_addr for session in self._sessions for bd_addr in session.channels.values())
+
+	def _channels_of(self, bd_addr):
+		with self._lock:
+			result = []
+			for session in self._sessions:
+				conn_ids = [conn_id for conn_id, x in session.channels.items() if x == bd_addr]
+				if len(conn_ids) > 0:
+					result.append((session, conn_ids))
+			return result
+
+	def _add_session(self, session):
+		with self._lock:
+			self._sessions.append(session)
+
+	def _remove_session(self, session):
+		with self._lock:
+			self._sessions.remove(session)
+			self._lock.notify_all()
+
+def recorded_buttons(records):
+	"""Returns the addresses of the buttons that had connection channels in a recording."""
+	buttons = []
+	for delay, direction, packet in records:
+		if direction == flicrecorder.COMMAND and packet[0] == FlicClient._COMMAND_NAME_TO_OPCODE["CmdCreateConnectionChannel"]:
+			bd_addr = unpack_command(packet)[1]["bd_addr"]
+			if bd_addr not in buttons:
+				buttons.append(bd_addr)
+	return buttons
+
+def main():
+	parser = argparse.ArgumentParser(description="Fake flicd server for benchmarks and tests")
+	parser.add_argument("--host", default="localhost", help="address to listen on")
+	parser.add_argument("--port", type=int, default=5551, help="port to listen on")
+	parser.add_argument("--buttons", help="comma separated bd addrs of the verified buttons")
+	parser.add_argument("--nb-buttons", type=int, default=1, help="number of generated verified buttons, if --buttons is not given")
+	parser.add_argument("--clicks", type=int, default=0, help="number of clicks to send once the buttons are connected")
+	parser.add_argument("--rate", type=float, default=1, help="clicks per second, 0 for as fast as possible")
+	parser.add_argument("--click-type", choices=sorted(CLICK_SEQUENCES), default="single")
+	parser.add_argument("--replay", help="recording from flicrecorder.py to replay once the buttons are connected")
+	parser.add_argument("--speed", type=float, default=1, help="replay speed, 1 for the original timing, 0 for as fast as possible")
+	args = parser.parse_args()
+
+	records = None
+	if args.replay is not None:
+		records = flicrecorder.read_recording(args.replay)
+		buttons = recorded_buttons(records)
+	elif args.buttons is not None:
+		buttons = [x.strip() for x in args.buttons.split(",")]
+	else:
+		buttons = ["80:e4:da:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(args.nb_buttons)]
+
+	fake = FakeFlicd(args.host, args.port, buttons)
+	fake.start()
+	print("Fake flicd listening on %s:%d with %d button(s)" % (fake.server_address[0], fake.server_address[1], len(buttons)))
+
+	try:
+		if records is not None or args.clicks > 0:
+			fake.wait_for_channels()
+			if records is not None:
+				fake.replay(records, args.speed)
+				print("Replay finished")
+			else:
+				fake.run_clicks(args.clicks, args.rate, args.click_type)
+				print("Sent %d clicks" % args.clicks)
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		fake.stop()
+
+if __name__ == "__main__":
+	main()
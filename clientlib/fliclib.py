@@ -1,6 +1,6 @@
 """Flic client library for python
 
-Requires python 3.3 or higher.
+Requires python 3.4 or higher.
 
 For detailed documentation, see the protocol documentation.
 
@@ -15,9 +15,11 @@ from enum import Enum
 from collections import namedtuple
 import time
 import socket
-import select
+import selectors
 import struct
 import itertools
+import functools
+import heapq
 import queue
 import threading
 
@@ -79,6 +81,185 @@ class ScanWizardResult(Enum):
 	WizardInternetBackendError = 5
 	WizardInvalidData = 6
 
+class GetInfoResponse:
+	"""GetInfoResponse class.
+	
+	The info passed to the FlicClient.get_info() callback. Fields can be read as attributes or, as with a dictionary,
+	with info["field_name"].
+	"""
+	
+	__slots__ = (
+		"bluetooth_controller_state",
+		"my_bd_addr",
+		"my_bd_addr_type",
+		"max_pending_connections",
+		"max_concurrently_connected_buttons",
+		"current_pending_connections",
+		"currently_no_space_for_new_connection",
+		"nb_verified_buttons",
+		"bd_addr_of_verified_buttons"
+	)
+	
+	def __init__(self, bluetooth_controller_state, my_bd_addr, my_bd_addr_type, max_pending_connections, max_concurrently_connected_buttons,
+			current_pending_connections, currently_no_space_for_new_connection, nb_verified_buttons, bd_addr_of_verified_buttons):
+		self.bluetooth_controller_state = bluetooth_controller_state
+		self.my_bd_addr = my_bd_addr
+		self.my_bd_addr_type = my_bd_addr_type
+		self.max_pending_connections = max_pending_connections
+		self.max_concurrently_connected_buttons = max_concurrently_connected_buttons
+		self.current_pending_connections = current_pending_connections
+		self.currently_no_space_for_new_connection = currently_no_space_for_new_connection
+		self.nb_verified_buttons = nb_verified_buttons
+		self.bd_addr_of_verified_buttons = bd_addr_of_verified_buttons
+	
+	def __getitem__(self, key):
+		if key not in GetInfoResponse.__slots__:
+			raise KeyError(key)
+		return getattr(self, key)
+	
+	def __contains__(self, key):
+		return key in GetInfoResponse.__slots__
+	
+	def get(self, key, default = None):
+		return getattr(self, key) if key in GetInfoResponse.__slots__ else default
+	
+	def keys(self):
+		return GetInfoResponse.__slots__
+	
+	def items(self):
+		return [(x, getattr(self, x)) for x in GetInfoResponse.__slots__]
+	
+	def __repr__(self):
+		return "GetInfoResponse(%s)" % ", ".join("%s=%r" % (x, getattr(self, x)) for x in GetInfoResponse.__slots__)
+
+class _EnumTable(dict):
+	"""Maps the raw protocol values to the members of an enum.
+	
+	An unknown value raises ValueError, as enum_class(value) does.
+	"""
+	
+	def __init__(self, enum_class):
+		super().__init__((x.value, x) for x in enum_class)
+		self._enum_class = enum_class
+	
+	def __missing__(self, value):
+		return self._enum_class(value)
+
+_CREATE_CONNECTION_CHANNEL_ERRORS = _EnumTable(CreateConnectionChannelError)
+_CONNECTION_STATUSES = _EnumTable(ConnectionStatus)
+_DISCONNECT_REASONS = _EnumTable(DisconnectReason)
+_REMOVED_REASONS = _EnumTable(RemovedReason)
+_CLICK_TYPES = _EnumTable(ClickType)
+_BD_ADDR_TYPES = _EnumTable(BdAddrType)
+_BLUETOOTH_CONTROLLER_STATES = _EnumTable(BluetoothControllerState)
+_SCAN_WIZARD_RESULTS = _EnumTable(ScanWizardResult)
+
+# Event decoder factories.
+# Each factory takes the struct of an event and returns a function that decodes a raw packet
+# (opcode included) into the tuple of arguments passed to the event handler.
+
+def _advertisement_packet_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		scan_id, bd_addr, name, rssi, is_private, already_verified = unpack_from(data, 1)
+		return (scan_id, FlicClient._bdaddr_bytes_to_string(bd_addr), FlicClient._decode_name(name), rssi, is_private, already_verified)
+	return decode
+
+def _create_connection_channel_response_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		conn_id, error, connection_status = unpack_from(data, 1)
+		return (conn_id, _CREATE_CONNECTION_CHANNEL_ERRORS[error], _CONNECTION_STATUSES[connection_status])
+	return decode
+
+def _connection_status_changed_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		conn_id, connection_status, disconnect_reason = unpack_from(data, 1)
+		return (conn_id, _CONNECTION_STATUSES[connection_status], _DISCONNECT_REASONS[disconnect_reason])
+	return decode
+
+def _connection_channel_removed_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		conn_id, removed_reason = unpack_from(data, 1)
+		return (conn_id, _REMOVED_REASONS[removed_reason])
+	return decode
+
+def _button_event_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		conn_id, click_type, was_queued, time_diff = unpack_from(data, 1)
+		return (conn_id, _CLICK_TYPES[click_type], was_queued, time_diff)
+	return decode
+
+def _bd_addr_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		return (FlicClient._bdaddr_bytes_to_string(unpack_from(data, 1)[0]),)
+	return decode
+
+def _single_value_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		return unpack_from(data, 1)
+	return decode
+
+def _get_info_response_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	size = event_struct.size
+	def decode(data):
+		(bluetooth_controller_state, my_bd_addr, my_bd_addr_type, max_pending_connections, max_concurrently_connected_buttons,
+			current_pending_connections, currently_no_space_for_new_connection, nb_verified_buttons) = unpack_from(data, 1)
+		
+		# Copy the whole address list out of the packet at once, then convert each 6 byte slice
+		pos = 1 + size
+		addresses = bytes(data[pos : pos + 6 * nb_verified_buttons])
+		to_string = FlicClient._bdaddr_bytes_to_string
+		bd_addr_of_verified_buttons = [to_string(addresses[i : i + 6]) for i in range(0, len(addresses), 6)]
+		
+		return (GetInfoResponse(
+			_BLUETOOTH_CONTROLLER_STATES[bluetooth_controller_state],
+			to_string(my_bd_addr),
+			_BD_ADDR_TYPES[my_bd_addr_type],
+			max_pending_connections,
+			max_concurrently_connected_buttons,
+			current_pending_connections,
+			currently_no_space_for_new_connection,
+			nb_verified_buttons,
+			bd_addr_of_verified_buttons),)
+	return decode
+
+def _bluetooth_controller_state_change_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		return (_BLUETOOTH_CONTROLLER_STATES[unpack_from(data, 1)[0]],)
+	return decode
+
+def _get_button_uuid_response_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		bd_addr, uuid = unpack_from(data, 1)
+		uuid = "".join(map(lambda x: "%02x" % x, uuid))
+		if uuid == "00000000000000000000000000000000":
+			uuid = None
+		return (FlicClient._bdaddr_bytes_to_string(bd_addr), uuid)
+	return decode
+
+def _scan_wizard_found_public_button_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		scan_wizard_id, bd_addr, name = unpack_from(data, 1)
+		return (scan_wizard_id, FlicClient._bdaddr_bytes_to_string(bd_addr), FlicClient._decode_name(name))
+	return decode
+
+def _scan_wizard_completed_decoder(event_struct):
+	unpack_from = event_struct.unpack_from
+	def decode(data):
+		scan_wizard_id, result = unpack_from(data, 1)
+		return (scan_wizard_id, _SCAN_WIZARD_RESULTS[result])
+	return decode
+
 class ButtonScanner:
 	"""ButtonScanner class.
 	
@@ -143,6 +324,7 @@ class ButtonConnectionChannel:
 		self._latency_mode = latency_mode
 		self._auto_disconnect_time = auto_disconnect_time
 		self._client = None
+		self._create_command = None
 		
 		self.on_create_connection_channel_response = lambda channel, error, connection_status: None
 		self.on_removed = lambda channel, removed_reason: None
@@ -164,10 +346,12 @@ class ButtonConnectionChannel:
 	def latency_mode(self, latency_mode):
 		if self._client is None:
 			self._latency_mode = latency_mode
+			self._create_command = None
 			return
 		
 		with self._client._lock:
 			self._latency_mode = latency_mode
+			self._create_command = None
 			if not self._client._closed:
 				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time})
 	
@@ -179,12 +363,51 @@ class ButtonConnectionChannel:
 	def auto_disconnect_time(self, auto_disconnect_time):
 		if self._client is None:
 			self._auto_disconnect_time = auto_disconnect_time
+			self._create_command = None
 			return
 		
 		with self._client._lock:
 			self._auto_disconnect_time = auto_disconnect_time
+			self._create_command = None
 			if not self._client._closed:
 				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time})
+	
+	def _create_connection_channel_command(self):
+		# Packed once and reused every time the channel is added again, e.g. after it has been removed
+		if self._create_command is None:
+			self._create_command = bytes(FlicClient._pack_command("CmdCreateConnectionChannel", {"conn_id": self._conn_id, "bd_addr": self._bd_addr, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time}))
+		return self._create_command
+
+class Timer:
+	"""Timer class.
+	
+	Returned by FlicClient.set_timer(). Call cancel() to prevent the callback from running.
+	Cancelling a timer that has already run, or has already been cancelled, has no effect.
+	"""
+	
+	def __init__(self, client, point_in_time, callback):
+		self._client = client
+		self._point_in_time = point_in_time
+		self._callback = callback
+		self._scheduled = True
+	
+	@property
+	def point_in_time(self):
+		"""The time.monotonic() value at which the callback runs."""
+		return self._point_in_time
+	
+	def cancel(self):
+		client = self._client
+		with client._timer_lock:
+			if self._callback is None:
+				return
+			self._callback = None
+			if self._scheduled:
+				# Cancelled entries stay in the heap and are skipped when they reach the top,
+				# unless they make up most of it
+				client._cancelled_timers += 1
+				if client._cancelled_timers > FlicClient._TIMER_COMPACT_THRESHOLD and client._cancelled_timers * 2 > len(client._timers):
+					client._compact_timers()
 
 class FlicClient:
 	"""FlicClient class.
@@ -232,6 +455,29 @@ class FlicClient:
 	_EVENT_STRUCTS = list(map(lambda x: None if x == None else struct.Struct(x[1]), _EVENTS))
 	_EVENT_NAMED_TUPLES = list(map(lambda x: None if x == None else namedtuple(x[0], x[2]), _EVENTS))
 	
+	# Indexed by opcode, in the same order as _EVENTS. Each decoder maps a raw packet to the handler arguments.
+	_EVENT_DECODERS = list(map(lambda x: x[0](x[1]), zip([
+		_advertisement_packet_decoder,
+		_create_connection_channel_response_decoder,
+		_connection_status_changed_decoder,
+		_connection_channel_removed_decoder,
+		_button_event_decoder,
+		_button_event_decoder,
+		_button_event_decoder,
+		_button_event_decoder,
+		_bd_addr_decoder,
+		_get_info_response_decoder,
+		_single_value_decoder,
+		_single_value_decoder,
+		_bluetooth_controller_state_change_decoder,
+		_single_value_decoder,
+		_get_button_uuid_response_decoder,
+		_single_value_decoder,
+		_scan_wizard_found_public_button_decoder,
+		_single_value_decoder,
+		_scan_wizard_completed_decoder
+	], _EVENT_STRUCTS)))
+	
 	_COMMANDS = [
 		("CmdGetInfo", "", ""),
 		("CmdCreateScanner", "<I", "scan_id"),
@@ -250,21 +496,51 @@ class FlicClient:
 	_COMMAND_NAMED_TUPLES = list(map(lambda x: namedtuple(x[0], x[2]), _COMMANDS))
 	_COMMAND_NAME_TO_OPCODE = dict((x[0], i) for i, x in enumerate(_COMMANDS))
 	
+	# Large enough to hold a maximum sized frame (2 byte length prefix and up to 65535 bytes of packet) plus the next read
+	_RECV_BUFFER_SIZE = 1 << 17
+	
+	# Minimum number of cancelled timers before the timer heap is rebuilt without them
+	_TIMER_COMPACT_THRESHOLD = 64
+	
+	# The same few button addresses repeat in every event, so conversions in both directions are cached.
+	# The cache also makes all events of a button share one bd addr string object.
+	
+	@functools.lru_cache(maxsize = 256)
 	def _bdaddr_bytes_to_string(bdaddr_bytes):
-		return ":".join(map(lambda x: "%02x" % x, reversed(bdaddr_bytes)))
+		b = bdaddr_bytes
+		return "%02x:%02x:%02x:%02x:%02x:%02x" % (b[5], b[4], b[3], b[2], b[1], b[0])
 	
+	@functools.lru_cache(maxsize = 256)
 	def _bdaddr_string_to_bytes(bdaddr_string):
-		return bytearray.fromhex("".join(reversed(bdaddr_string.split(":"))))
+		return bytes.fromhex("".join(reversed(bdaddr_string.split(":"))))
+	
+	@functools.lru_cache(maxsize = 256)
+	def _decode_name(name_bytes):
+		return name_bytes.decode("utf-8")
 	
 	def __init__(self, host, port = 5551):
 		self._sock = socket.create_connection((host, port), None)
 		self._lock = threading.RLock()
+		self._wakeup_recv, self._wakeup_send = socket.socketpair()
+		self._wakeup_recv.setblocking(False)
+		self._wakeup_send.setblocking(False)
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(self._sock, selectors.EVENT_READ)
+		self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
 		self._scanners = {}
 		self._scan_wizards = {}
 		self._connection_channels = {}
 		self._get_info_response_queue = queue.Queue()
 		self._get_button_uuid_queue = queue.Queue()
-		self._timers = queue.PriorityQueue()
+		self._timers = [] # heap of (point_in_time, sequence number, Timer)
+		self._timer_lock = threading.Lock()
+		self._timer_sequence = itertools.count()
+		self._cancelled_timers = 0
+		self._recv_buffer = bytearray(FlicClient._RECV_BUFFER_SIZE)
+		self._recv_view = memoryview(self._recv_buffer)
+		self._recv_start = 0
+		self._recv_end = 0
+		self._send_buffer = bytearray()
 		self._handle_event_thread_ident = None
 		self._closed = False
 		
@@ -279,10 +555,10 @@ class FlicClient:
 			if self._closed:
 				return
 			
-			if threading.get_ident() != self._handle_event_thread_ident:
-				self._send_command("CmdPing", {"ping_id": 0}) # To unblock socket select
-			
 			self._closed = True
+			
+			if threading.get_ident() != self._handle_event_thread_ident:
+				self._wakeup()
 	
 	def add_scanner(self, scanner):
 		"""Add a ButtonScanner object.
@@ -350,7 +626,24 @@ class FlicClient:
 			channel._client = self
 			
 			self._connection_channels[channel._conn_id] = channel
-			self._send_command("CmdCreateConnectionChannel", {"conn_id": channel._conn_id, "bd_addr": channel.bd_addr, "latency_mode": channel._latency_mode, "auto_disconnect_time": channel._auto_disconnect_time})
+			self._queue_command(channel._create_connection_channel_command())
+	
+	def add_connection_channels(self, channels):
+		"""Adds several connection channels at once.
+		
+		Same as calling add_connection_channel for each channel, but all the commands are sent in a single write.
+		"""
+		with self._lock:
+			data = bytearray()
+			for channel in channels:
+				if channel._conn_id in self._connection_channels:
+					continue
+				
+				channel._client = self
+				
+				self._connection_channels[channel._conn_id] = channel
+				data += channel._create_connection_channel_command()
+			self._queue_command(data)
 	
 	def remove_connection_channel(self, channel):
 		"""Remove a connection channel.
@@ -375,7 +668,7 @@ class FlicClient:
 		"""Get info about the current state of the server.
 		
 		The server will send back its information directly and the callback will be called once the response arrives.
-		The callback takes only one parameter: info. This info parameter is a dictionary with the following objects:
+		The callback takes only one parameter: info. This info parameter is a GetInfoResponse record, which can be indexed like a dictionary, with the following objects:
 		bluetooth_controller_state, my_bd_addr, my_bd_addr_type, max_pending_connections, max_concurrently_connected_buttons,
 		current_pending_connections, currently_no_space_for_new_connection, bd_addr_of_verified_buttons (a list of bd addresses).
 		"""
@@ -400,12 +693,17 @@ class FlicClient:
 		"""Set a timer
 		
 		This timer callback will run after the specified timeout_millis on the thread that handles the events.
+		Timers with the same point in time run in the order they were set.
+		Returns a Timer object that can be used to cancel the timer.
 		"""
 		point_in_time = time.monotonic() + timeout_millis / 1000.0
-		self._timers.put((point_in_time, callback))
+		timer = Timer(self, point_in_time, callback)
+		with self._timer_lock:
+			heapq.heappush(self._timers, (point_in_time, next(self._timer_sequence), timer))
 		
 		if threading.get_ident() != self._handle_event_thread_ident:
-			self._send_command("CmdPing", {"ping_id": 0}) # To unblock socket select
+			self._wakeup()
+		return timer
 	
 	def run_on_handle_events_thread(self, callback):
 		"""Run a function on the thread that handles the events."""
@@ -414,7 +712,50 @@ class FlicClient:
 		else:
 			self.set_timer(0, callback)
 	
-	def _send_command(self, name, items):
+	def _compact_timers(self):
+		# Must be called with the timer lock held
+		self._timers = [x for x in self._timers if x[2]._callback is not None]
+		heapq.heapify(self._timers)
+		self._cancelled_timers = 0
+	
+	def _pop_expired_timers(self):
+		"""Removes all timers that have expired from the heap.
+		
+		Returns the expired timers in firing order and the number of seconds until the next timer expires (None if there is none).
+		"""
+		now = time.monotonic()
+		expired = []
+		with self._timer_lock:
+			timers = self._timers
+			while len(timers) > 0:
+				point_in_time, sequence, timer = timers[0]
+				if timer._callback is not None and point_in_time > now:
+					return expired, point_in_time - now
+				
+				heapq.heappop(timers)
+				timer._scheduled = False
+				if timer._callback is None:
+					self._cancelled_timers -= 1
+				else:
+					expired.append(timer)
+		return expired, None
+	
+	def _wakeup(self):
+		# Unblocks the select in handle_events() from another thread, without any traffic to flicd
+		try:
+			self._wakeup_send.send(b"\0")
+		except OSError:
+			# The socket buffer is full (a wakeup is already pending) or the client has been closed
+			pass
+	
+	def _drain_wakeups(self):
+		try:
+			while self._wakeup_recv.recv(4096):
+				pass
+		except OSError:
+			pass
+	
+	def _pack_command(name, items):
 		for key, value in items.items():
 			if isinstance(value, Enum):
 				items[key] = value.value
@@ -429,169 +770,193 @@ class FlicClient:
 		bytes[1] = (len(data_bytes) + 1) >> 8
 		bytes[2] = opcode
 		bytes += data_bytes
+		return bytes
+	
+	def _send_command(self, name, items):
+		self._queue_command(FlicClient._pack_command(name, items))
+	
+	def _queue_command(self, data):
+		# Commands are appended to the send buffer and written by the thread that handles the events,
+		# once per iteration of its loop
+		if len(data) == 0:
+			return
 		with self._lock:
-			if not self._closed:
-				self._sock.sendall(bytes)
+			if self._closed:
+				return
+			wakeup = len(self._send_buffer) == 0 and threading.get_ident() != self._handle_event_thread_ident
+			self._send_buffer += data
+		if wakeup:
+			self._wakeup()
+	
+	def _flush_commands(self):
+		with self._lock:
+			if len(self._send_buffer) == 0:
+				return
+			data = self._send_buffer
+			self._send_buffer = bytearray()
+		self._sock.sendall(data)
+	
+	def _handle_advertisement_packet(self, scan_id, bd_addr, name, rssi, is_private, already_verified):
+		scanner = self._scanners.get(scan_id)
+		if scanner is not None:
+			scanner.on_advertisement_packet(scanner, bd_addr, name, rssi, is_private, already_verified)
+	
+	def _handle_create_connection_channel_response(self, conn_id, error, connection_status):
+		channel = self._connection_channels[conn_id]
+		if error != CreateConnectionChannelError.NoError:
+			del self._connection_channels[conn_id]
+		channel.on_create_connection_channel_response(channel, error, connection_status)
+	
+	def _handle_connection_status_changed(self, conn_id, connection_status, disconnect_reason):
+		channel = self._connection_channels[conn_id]
+		channel.on_connection_status_changed(channel, connection_status, disconnect_reason)
+	
+	def _handle_connection_channel_removed(self, conn_id, removed_reason):
+		channel = self._connection_channels[conn_id]
+		del self._connection_channels[conn_id]
+		channel.on_removed(channel, removed_reason)
+	
+	def _handle_button_up_or_down(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_up_or_down(channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_click_or_hold(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_click_or_hold(channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_single_or_double_click(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_single_or_double_click(channel, click_type, was_queued, time_diff)
+	
+	def _handle_button_single_or_double_click_or_hold(self, conn_id, click_type, was_queued, time_diff):
+		channel = self._connection_channels[conn_id]
+		channel.on_button_single_or_double_click_or_hold(channel, click_type, was_queued, time_diff)
+	
+	def _handle_new_verified_button(self, bd_addr):
+		self.on_new_verified_button(bd_addr)
+	
+	def _handle_get_info_response(self, items):
+		self._get_info_response_queue.get()(items)
+	
+	def _handle_no_space_for_new_connection(self, max_concurrently_connected_buttons):
+		self.on_no_space_for_new_connection(max_concurrently_connected_buttons)
+	
+	def _handle_got_space_for_new_connection(self, max_concurrently_connected_buttons):
+		self.on_got_space_for_new_connection(max_concurrently_connected_buttons)
+	
+	def _handle_bluetooth_controller_state_change(self, state):
+		self.on_bluetooth_controller_state_change(state)
+	
+	def _handle_ping_response(self, ping_id):
+		pass
+	
+	def _handle_get_button_uuid_response(self, bd_addr, uuid):
+		self._get_button_uuid_queue.get()(bd_addr, uuid)
+	
+	def _handle_scan_wizard_found_private_button(self, scan_wizard_id):
+		scan_wizard = self._scan_wizards[scan_wizard_id]
+		scan_wizard.on_found_private_button(scan_wizard)
+	
+	def _handle_scan_wizard_found_public_button(self, scan_wizard_id, bd_addr, name):
+		scan_wizard = self._scan_wizards[scan_wizard_id]
+		scan_wizard._bd_addr = bd_addr
+		scan_wizard._name = name
+		scan_wizard.on_found_public_button(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
+	
+	def _handle_scan_wizard_button_connected(self, scan_wizard_id):
+		scan_wizard = self._scan_wizards[scan_wizard_id]
+		scan_wizard.on_button_connected(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
+	
+	def _handle_scan_wizard_completed(self, scan_wizard_id, result):
+		scan_wizard = self._scan_wizards[scan_wizard_id]
+		del self._scan_wizards[scan_wizard_id]
+		scan_wizard.on_completed(scan_wizard, result, scan_wizard._bd_addr, scan_wizard._name)
+	
+	# Indexed by opcode, in the same order as _EVENTS
+	_EVENT_HANDLERS = [
+		_handle_advertisement_packet,
+		_handle_create_connection_channel_response,
+		_handle_connection_status_changed,
+		_handle_connection_channel_removed,
+		_handle_button_up_or_down,
+		_handle_button_click_or_hold,
+		_handle_button_single_or_double_click,
+		_handle_button_single_or_double_click_or_hold,
+		_handle_new_verified_button,
+		_handle_get_info_response,
+		_handle_no_space_for_new_connection,
+		_handle_got_space_for_new_connection,
+		_handle_bluetooth_controller_state_change,
+		_handle_ping_response,
+		_handle_get_button_uuid_response,
+		_handle_scan_wizard_found_private_button,
+		_handle_scan_wizard_found_public_button,
+		_handle_scan_wizard_button_connected,
+		_handle_scan_wizard_completed
+	]
+	_EVENT_DISPATCH = list(zip(_EVENT_DECODERS, _EVENT_HANDLERS))
 	
 	def _dispatch_event(self, data):
 		if len(data) == 0:
 			return
 		opcode = data[0]
 		
-		if opcode >= len(FlicClient._EVENTS) or FlicClient._EVENTS[opcode] == None:
+		if opcode >= len(FlicClient._EVENT_DISPATCH):
 			return
 		
-		event_name = FlicClient._EVENTS[opcode][0]
-		data_tuple = FlicClient._EVENT_STRUCTS[opcode].unpack(data[1 : 1 + FlicClient._EVENT_STRUCTS[opcode].size])
-		items = FlicClient._EVENT_NAMED_TUPLES[opcode]._make(data_tuple)._asdict()
-		
-		# Process some kind of items whose data type is not supported by struct
-		if "bd_addr" in items:
-			items["bd_addr"] = FlicClient._bdaddr_bytes_to_string(items["bd_addr"])
-		
-		if "name" in items:
-			items["name"] = items["name"].decode("utf-8")
-		
-		if event_name == "EvtCreateConnectionChannelResponse":
-			items["error"] = CreateConnectionChannelError(items["error"])
-			items["connection_status"] = ConnectionStatus(items["connection_status"])
-		
-		if event_name == "EvtConnectionStatusChanged":
-			items["connection_status"] = ConnectionStatus(items["connection_status"])
-			items["disconnect_reason"] = DisconnectReason(items["disconnect_reason"])
-		
-		if event_name == "EvtConnectionChannelRemoved":
-			items["removed_reason"] = RemovedReason(items["removed_reason"])
-		
-		if event_name.startswith("EvtButton"):
-			items["click_type"] = ClickType(items["click_type"])
-		
-		if event_name == "EvtGetInfoResponse":
-			items["bluetooth_controller_state"] = BluetoothControllerState(items["bluetooth_controller_state"])
-			items["my_bd_addr"] = FlicClient._bdaddr_bytes_to_string(items["my_bd_addr"])
-			items["my_bd_addr_type"] = BdAddrType(items["my_bd_addr_type"])
-			items["bd_addr_of_verified_buttons"] = []
-			
-			pos = FlicClient._EVENT_STRUCTS[opcode].size
-			for i in range(items["nb_verified_buttons"]):
-				items["bd_addr_of_verified_buttons"].append(FlicClient._bdaddr_bytes_to_string(data[1 + pos : 1 + pos + 6]))
-				pos += 6
-		
-		if event_name == "EvtBluetoothControllerStateChange":
-			items["state"] = BluetoothControllerState(items["state"])
-		
-		if event_name == "EvtGetButtonUUIDResponse":
-			items["uuid"] = "".join(map(lambda x: "%02x" % x, items["uuid"]))
-			if items["uuid"] == "00000000000000000000000000000000":
-				items["uuid"] = None
-		
-		if event_name == "EvtScanWizardCompleted":
-			items["result"] = ScanWizardResult(items["result"])
-		
-		# Process event
-		if event_name == "EvtAdvertisementPacket":
-			scanner = self._scanners.get(items["scan_id"])
-			if scanner is not None:
-				scanner.on_advertisement_packet(scanner, items["bd_addr"], items["name"], items["rssi"], items["is_private"], items["already_verified"])
-		
-		if event_name == "EvtCreateConnectionChannelResponse":
-			channel = self._connection_channels[items["conn_id"]]
-			if items["error"] != CreateConnectionChannelError.NoError:
-				del self._connection_channels[items["conn_id"]]
-			channel.on_create_connection_channel_response(channel, items["error"], items["connection_status"])
-		
-		if event_name == "EvtConnectionStatusChanged":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_connection_status_changed(channel, items["connection_status"], items["disconnect_reason"])
-		
-		if event_name == "EvtConnectionChannelRemoved":
-			channel = self._connection_channels[items["conn_id"]]
-			del self._connection_channels[items["conn_id"]]
-			channel.on_removed(channel, items["removed_reason"])
-		
-		if event_name == "EvtButtonUpOrDown":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_up_or_down(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonClickOrHold":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_click_or_hold(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonSingleOrDoubleClick":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_single_or_double_click(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonSingleOrDoubleClickOrHold":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_single_or_double_click_or_hold(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		
-		if event_name == "EvtNewVerifiedButton":
-			self.on_new_verified_button(items["bd_addr"])
-		
-		if event_name == "EvtGetInfoResponse":
-			self._get_info_response_queue.get()(items)
-		
-		if event_name == "EvtNoSpaceForNewConnection":
-			self.on_no_space_for_new_connection(items["max_concurrently_connected_buttons"])
-		
-		if event_name == "EvtGotSpaceForNewConnection":
-			self.on_got_space_for_new_connection(items["max_concurrently_connected_buttons"])
-		
-		if event_name == "EvtBluetoothControllerStateChange":
-			self.on_bluetooth_controller_state_change(items["state"])
-		
-		if event_name == "EvtGetButtonUUIDResponse":
-			self._get_button_uuid_queue.get()(items["bd_addr"], items["uuid"])
-		
-		if event_name == "EvtScanWizardFoundPrivateButton":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_found_private_button(scan_wizard)
-		
-		if event_name == "EvtScanWizardFoundPublicButton":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard._bd_addr = items["bd_addr"]
-			scan_wizard._name = items["name"]
-			scan_wizard.on_found_public_button(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
-		
-		if event_name == "EvtScanWizardButtonConnected":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_button_connected(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
-		
-		if event_name == "EvtScanWizardCompleted":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			del self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_completed(scan_wizard, items["result"], scan_wizard._bd_addr, scan_wizard._name)
+		decoder, handler = FlicClient._EVENT_DISPATCH[opcode]
+		handler(self, *decoder(data))
 	
 	def _handle_one_event(self):
-		if len(self._timers.queue) > 0:
-			current_timer = self._timers.queue[0]
-			timeout = max(current_timer[0] - time.monotonic(), 0)
-			if timeout == 0:
-				self._timers.get()[1]()
-				return True
-			if len(select.select([self._sock], [], [], timeout)[0]) == 0:
-				return True
-		
-		len_arr = bytearray(2)
-		view = memoryview(len_arr)
-		
-		toread = 2
-		while toread > 0:
-			nbytes = self._sock.recv_into(view, toread)
-			if nbytes == 0:
+		self._flush_commands()
+		
+		expired, timeout = self._pop_expired_timers()
+		if len(expired) > 0:
+			# Timers that expired together fire as one batch. One of them may still cancel a later one in the batch.
+			for timer in expired:
+				with self._timer_lock:
+					callback = timer._callback
+					timer._callback = None
+				if callback is not None:
+					callback()
+			return True
+		
+		for key, mask in self._selector.select(timeout):
+			if key.fileobj is self._wakeup_recv:
+				self._drain_wakeups()
+			elif not self._read_events():
 				return False
-			view = view[nbytes:]
-			toread -= nbytes
-		
-		packet_len = len_arr[0] | (len_arr[1] << 8)
-		data = bytearray(packet_len)
-		view = memoryview(data)
-		toread = packet_len
-		while toread > 0:
-			nbytes = self._sock.recv_into(view, toread)
-			if nbytes == 0:
-				return False
-			view = view[nbytes:]
-			toread -= nbytes
+		return True
+	
+	def _read_events(self):
+		# Read as much as is available in one syscall, then dispatch every complete frame in the buffer.
+		# A trailing partial frame is moved to the start of the buffer and completed by the next read.
+		view = self._recv_view
+		start = self._recv_start
+		end = self._recv_end
+		if start > 0:
+			# Copy the partial frame out first, the source and destination regions of the buffer can overlap
+			self._recv_buffer[0 : end - start] = bytes(view[start : end])
+			end -= start
+			start = 0
+		
+		nbytes = self._sock.recv_into(view[end:])
+		if nbytes == 0:
+			return False
+		end += nbytes
+		
+		while end - start >= 2:
+			packet_len = view[start] | (view[start + 1] << 8)
+			if end - start - 2 < packet_len:
+				break
+			start += 2
+			self._dispatch_event(view[start : start + packet_len])
+			start += packet_len
+			if self._closed:
+				break
 		
-		self._dispatch_event(data)
+		self._recv_start = start
+		self._recv_end = end
 		return True
 		
 	def handle_events(self):
@@ -604,4 +969,11 @@ class FlicClient:
 		while not self._closed:
 			if not self._handle_one_event():
 				break
+		try:
+			self._flush_commands()
+		except OSError:
+			pass
+		self._selector.close()
+		self._wakeup_recv.close()
+		self._wakeup_send.close()
 		self._sock.close()
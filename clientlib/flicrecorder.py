@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Records the traffic between a Flic client and flicd to a compact binary file.
+#
+# The recorder is a proxy: it listens where clients expect flicd (localhost:5551 by default) and forwards
+# everything to a real flicd started on another port, e.g. "sudo ./flicd -f flic.sqlite3 -p 5552".
+# Every frame in both directions is written to the recording, which fakeflicd.py can replay.
+#
+# File format:
+# 8 byte magic "FLICREC\x01", followed by one record per frame:
+# uint32 microseconds since the previous record, uint8 direction (0 = command from the client, 1 = event from flicd),
+# then the frame exactly as sent on the wire (uint16 length followed by the packet).
+
+import argparse
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b"FLICREC\x01"
+
+COMMAND = 0
+EVENT = 1
+
+_RECORD_HEADER = struct.Struct("<IB")
+_MAX_DELTA = 0xffffffff
+
+class RecordingWriter:
+	"""Writes frames to a recording file. Safe to use from several threads."""
+
+	def __init__(self, file_name):
+		self._file = open(file_name, "wb")
+		self._file.write(MAGIC)
+		self._lock = threading.Lock()
+		self._last_time = None
+
+	def write(self, direction, frame):
+		"""Appends one frame (length prefix included) to the recording."""
+		with self._lock:
+			now = time.monotonic()
+			delta = 0 if self._last_time is None else min(int((now - self._last_time) * 1000000), _MAX_DELTA)
+			self._last_time = now
+			self._file.write(_RECORD_HEADER.pack(delta, direction))
+			self._file.write(frame)
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+def read_recording(file_name):
+	"""Reads a recording file.
+
+	Returns a list of (seconds since the previous record, direction, packet) tuples,
+	where packet is the frame without its length prefix.
+	"""
+	with open(file_name, "rb") as f:
+		data = f.read()
+
+	if data[:len(MAGIC)] != MAGIC:
+		raise ValueError("%s is not a flic recording" % file_name)
+
+	records = []
+	pos = len(MAGIC)
+	while pos + _RECORD_HEADER.size + 2 <= len(data):
+		delta, direction = _RECORD_HEADER.unpack_from(data, pos)
+		pos += _RECORD_HEADER.size
+		packet_len = data[pos] | (data[pos + 1] << 8)
+		pos += 2
+		if pos + packet_len > len(data):
+			break
+		records.append((delta / 1000000.0, direction, data[pos : pos + packet_len]))
+		pos += packet_len
+	return records
+
+def _pump(source, destination, direction, writer):
+	"""Forwards data from source to destination, recording each complete frame."""
+	buffer = bytearray()
+	try:
+		while True:
+			data = source.recv(65536)
+			if len(data) == 0:
+				break
+			destination.sendall(data)
+
+			buffer += data
+			start = 0
+			while len(buffer) - start >= 2:
+				frame_len = 2 + (buffer[start] | (buffer[start + 1] << 8))
+				if len(buffer) - start < frame_len:
+					break
+				writer.write(direction, bytes(buffer[start : start + frame_len]))
+				start += frame_len
+			del buffer[:start]
+	except OSError:
+		pass
+	finally:
+		for s in (source, destination):
+			try:
+				s.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+def _proxy_connection(client_sock, flicd_address, writer):
+	try:
+		flicd_sock = socket.create_connection(flicd_address)
+	except OSError as e:
+		print("Could not connect to flicd at %s:%d: %s" % (flicd_address[0], flicd_address[1], e))
+		client_sock.close()
+		return
+
+	commands = threading.Thread(target=_pump, args=(client_sock, flicd_sock, COMMAND, writer), daemon=True)
+	commands.start()
+	_pump(flicd_sock, client_sock, EVENT, writer)
+	commands.join()
+	client_sock.close()
+	flicd_sock.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Record the traffic between Flic clients and flicd")
+	parser.add_argument("file_name", help="recording file to write")
+	parser.add_argument("--listen-host", default="localhost", help="address to accept clients on")
+	parser.add_argument("--listen-port", type=int, default=5551, help="port to accept clients on")
+	parser.add_argument("--flicd-host", default="localhost", help="address of the real flicd")
+	parser.add_argument("--flicd-port", type=int, default=5552, help="port of the real flicd")
+	args = parser.parse_args()
+
+	writer = RecordingWriter(args.file_name)
+	listener = socket.socket()
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind((args.listen_host, args.listen_port))
+	listener.listen(5)
+	print("Recording to %s, waiting for clients on %s:%d..." % (args.file_name, args.listen_host, args.listen_port))
+
+	try:
+		while True:
+			client_sock = listener.accept()[0]
+			threading.Thread(target=_proxy_connection, args=(client_sock, (args.flicd_host, args.flicd_port), writer), daemon=True).start()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		listener.close()
+		writer.close()
+
+if __name__ == "__main__":
+	main()
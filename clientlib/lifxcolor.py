@@ -0,0 +1,102 @@
+import colorsys
+
+# Hue and saturation of the color names the LIFX Api accepts
+NAMED_COLORS = {
+    'white': { 'saturation': 0.0 },
+    'red': { 'hue': 0.0, 'saturation': 1.0 },
+    'orange': { 'hue': 36.0, 'saturation': 1.0 },
+    'yellow': { 'hue': 60.0, 'saturation': 1.0 },
+    'cyan': { 'hue': 180.0, 'saturation': 1.0 },
+    'green': { 'hue': 120.0, 'saturation': 1.0 },
+    'blue': { 'hue': 250.0, 'saturation': 1.0 },
+    'purple': { 'hue': 280.0, 'saturation': 1.0 },
+    'pink': { 'hue': 325.0, 'saturation': 1.0 },
+}
+
+MIN_KELVIN = 1500
+MAX_KELVIN = 9000
+
+def _parse_number(name, value, minimum, maximum):
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("%s %s is not a number" % (name, value))
+    if number < minimum or number > maximum:
+        raise ValueError("%s %s is not between %s and %s" % (name, value, minimum, maximum))
+    return number
+
+def _parse_rgb(red, green, blue):
+    hue, saturation, brightness = colorsys.rgb_to_hsv(red / 255.0, green / 255.0, blue / 255.0)
+    return { 'hue': hue * 360.0, 'saturation': saturation, 'brightness': brightness }
+
+def parse_color(color):
+    """Parses a color string of the LIFX Api.
+
+    Args:
+        color: space separated parts, each one a color name such as "red", "hue:120", "saturation:1",
+            "brightness:0.5", "kelvin:2700", "#ff8800" or "rgb:255,136,0".
+
+    Returns:
+        A dictionary holding the hue in degrees, the saturation and brightness between 0 and 1, and the kelvin, for
+        the components the color sets.
+
+    Raises:
+        ValueError: the color is not a valid color string.
+    """
+    components = {}
+    explicit_saturation = False
+    for part in color.lower().split():
+        if part in NAMED_COLORS:
+            components.update(NAMED_COLORS[part])
+        elif part.startswith('#'):
+            if len(part) != 7:
+                raise ValueError("%s is not a #rrggbb color" % part)
+            try:
+                components.update(_parse_rgb(int(part[1:3], 16), int(part[3:5], 16), int(part[5:7], 16)))
+            except ValueError:
+                raise ValueError("%s is not a #rrggbb color" % part)
+        elif part.startswith('rgb:'):
+            values = part[len('rgb:'):].split(',')
+            if len(values) != 3:
+                raise ValueError("%s is not a rgb:r,g,b color" % part)
+            components.update(_parse_rgb(*[_parse_number('rgb', x, 0, 255) for x in values]))
+        elif part.startswith('hue:'):
+            components['hue'] = _parse_number('hue', part[len('hue:'):], 0, 360)
+        elif part.startswith('saturation:'):
+            components['saturation'] = _parse_number('saturation', part[len('saturation:'):], 0, 1)
+            explicit_saturation = True
+        elif part.startswith('brightness:'):
+            components['brightness'] = _parse_number('brightness', part[len('brightness:'):], 0, 1)
+        elif part.startswith('kelvin:'):
+            components['kelvin'] = _parse_number('kelvin', part[len('kelvin:'):], MIN_KELVIN, MAX_KELVIN)
+        else:
+            raise ValueError("%s is not a color" % part)
+
+    # A white temperature means no saturation unless the color says otherwise, as with the LIFX Api
+    if 'kelvin' in components and not explicit_saturation:
+        components['saturation'] = 0.0
+    return components
+
+def parse_brightness(brightness):
+    """Returns a brightness between 0 and 1 from the config as a number, raising ValueError if it is not one."""
+    return _parse_number('brightness', brightness, 0, 1)
+
+def to_hsbk(components):
+    """Returns the (hue, saturation, brightness, kelvin) 16 bits values the LAN protocol uses for parsed color components.
+
+    Args:
+        components: a dictionary from parse_color.
+
+    Returns:
+        A tuple of the hue, saturation and brightness between 0 and 65535 and of the kelvin, None for the components
+        that are not set.
+    """
+    def scale(name, maximum):
+        value = components.get(name)
+        return int(round(value / maximum * 65535)) if value is not None else None
+
+    kelvin = components.get('kelvin')
+    # A hue of 360 degrees is a hue of 0
+    hue = scale('hue', 360.0)
+    return (hue % 65535 if hue is not None else None, scale('saturation', 1.0), scale('brightness', 1.0),
+        int(round(kelvin)) if kelvin is not None else None)
@@ -0,0 +1,105 @@
+import json
+import os
+
+class LIFXDeviceCache(object):
+    """Keeps the LIFX devices found on the LAN in a JSON file, so that they can be used as soon as the client starts.
+
+    Every device is stored as a dictionary keyed by its MAC address, with the address it answered from and the names
+    it reported:
+        {
+            'mac': 'd0:73:d5:01:02:03',
+            'ip': '192.168.1.20',
+            'port': 56700,
+            'label': 'Kitchen Front',
+            'group': {'id': '...', 'name': 'Kitchen'},
+            'location': {'id': '...', 'name': 'Home'},
+            'missed': 0
+        }
+    'missed' counts the discoveries in a row that did not find the device.
+
+    Attributes:
+        max_missed: number of discoveries in a row a device can be missing from before it is removed, a discovery
+            broadcast can easily miss a device that is busy or on a weak wifi signal.
+    """
+
+    max_missed = 3
+
+    def __init__(self, file_name):
+        """Inits LIFXDeviceCache. Call load() to read the file.
+
+        Args:
+            file_name: name of the JSON file holding the devices.
+        """
+        self.file_name = file_name
+        self.entries = {}
+
+    def load(self):
+        """Reads the devices from the file, starting empty if it is missing or unreadable.
+
+        Returns:
+            The dictionary of devices keyed by MAC address.
+        """
+        try:
+            with open(self.file_name) as f:
+                entries = json.load(f)
+            self.entries = dict((x['mac'], x) for x in entries)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("Ignoring the LIFX device cache %s: %s" % (self.file_name, e))
+            self.entries = {}
+        return self.entries
+
+    def save(self):
+        """Writes the devices to the file."""
+        # Write to a temporary file first so that a crash never leaves a truncated cache behind
+        tmp_file_name = self.file_name + ".tmp"
+        try:
+            with open(tmp_file_name, "w") as f:
+                json.dump(sorted(self.entries.values(), key=lambda x: x['mac']), f, indent=2)
+            os.replace(tmp_file_name, self.file_name)
+        except OSError as e:
+            print("Could not write the LIFX device cache %s: %s" % (self.file_name, e))
+
+    def reconcile(self, discovered):
+        """Merges the result of a discovery into the devices.
+
+        Args:
+            discovered: list of device dictionaries found by the discovery. The names of a device that did not answer
+                when asked for them can be left out, the cached ones are kept. A discovery that found no device at all
+                is ignored: it says more about the network than about the devices.
+
+        Returns:
+            The MAC addresses of the devices added, removed and whose address changed, as three lists.
+        """
+        if not discovered:
+            return [], [], []
+
+        added = []
+        removed = []
+        moved = []
+        entries = {}
+        for entry in discovered:
+            previous = self.entries.get(entry['mac'])
+            if previous is None:
+                added.append(entry['mac'])
+                merged = {}
+            else:
+                if (previous['ip'], previous['port']) != (entry['ip'], entry['port']):
+                    moved.append(entry['mac'])
+                merged = dict(previous)
+            merged.update(entry)
+            merged['missed'] = 0
+            entries[entry['mac']] = merged
+
+        for mac, previous in self.entries.items():
+            if mac in entries:
+                continue
+            missed = previous.get('missed', 0) + 1
+            if missed >= LIFXDeviceCache.max_missed:
+                removed.append(mac)
+            else:
+                entries[mac] = dict(previous, missed=missed)
+
+        self.entries = entries
+        return added, removed, moved
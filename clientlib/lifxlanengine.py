@@ -0,0 +1,405 @@
+import collections
+import ipaddress
+import random
+import selectors
+import socket
+import threading
+import time
+
+try:
+    import ifaddr
+except ImportError:
+    # Without it the networks are unknown, the devices are discovered on 255.255.255.255 and never sent broadcasts
+    ifaddr = None
+
+import lifxpackets
+
+LIFX_PORT = 56700
+
+def get_networks():
+    """Returns the IPv4 networks of the network interfaces of this computer, none if ifaddr is not installed."""
+    networks = []
+    if ifaddr is None:
+        return networks
+    for adapter in ifaddr.get_adapters():
+        for ip in adapter.ips:
+            if ip.is_IPv4:
+                networks.append(ipaddress.ip_network("%s/%d" % (ip.ip, ip.network_prefix), strict=False))
+    return networks
+
+class LIFXDevice(object):
+    """A LIFX device on the LAN.
+
+    Attributes:
+        mac_addr: MAC address of the device, such as 'd0:73:d5:01:02:03'.
+        ip_addr: IP address the device answers from.
+        port: UDP port the device listens on.
+        label: label of the device, None until it is known.
+        target: target field of the messages to the device.
+    """
+
+    __slots__ = ('mac_addr', 'ip_addr', 'port', 'label', 'target')
+
+    def __init__(self, mac_addr, ip_addr, port=LIFX_PORT, label=None):
+        self.mac_addr = mac_addr
+        self.ip_addr = ip_addr
+        self.port = port
+        self.label = label
+        self.target = lifxpackets.mac_to_target(mac_addr)
+
+    def __repr__(self):
+        return "LIFXDevice(%s, %s:%d, %s)" % (self.mac_addr, self.ip_addr, self.port, self.label)
+
+class _Transaction(object):
+    """Requests submitted together by a caller, which waits for all of them to finish."""
+
+    __slots__ = ('results', 'nb_requests', 'done', 'macs', 'deadline')
+
+    def __init__(self, nb_requests, deadline, macs=None):
+        self.results = {}
+        self.nb_requests = nb_requests
+        self.done = threading.Event()
+        # Time after which wait gives up on the engine, should it not finish the requests
+        self.deadline = deadline
+        # MAC addresses to report in the results even if they did not answer, None to report the answers only
+        self.macs = macs
+
+    def request_finished(self):
+        self.nb_requests -= 1
+        if self.nb_requests == 0:
+            self.done.set()
+
+    def fail(self):
+        """Finishes the transaction without any answer, for the requests the engine will never finish."""
+        self.results = {}
+        self.done.set()
+
+    def wait(self):
+        """Waits for all the requests to finish and returns the results, see LIFXLanEngine.request."""
+        self.done.wait(max(0, self.deadline - time.monotonic()))
+        results = dict(self.results)
+        if self.macs is None:
+            return results
+        return dict((x, results.get(x)) for x in self.macs)
+
+class _Request(object):
+    """A message sent until the devices expected to answer it all did, or until its deadline."""
+
+    __slots__ = ('transaction', 'key', 'message', 'addresses', 'response_type', 'expected', 'start', 'deadline', 'next_send')
+
+    def __init__(self, transaction, key, message, addresses, response_type, expected, start, deadline):
+        self.transaction = transaction
+        self.key = key
+        self.message = message
+        self.addresses = addresses
+        self.response_type = response_type
+        # MAC addresses of the devices still expected to answer, None to collect every answer until the deadline
+        self.expected = expected
+        self.start = start
+        self.deadline = deadline
+        self.next_send = start
+
+class LIFXLanEngine(object):
+    """Sends LIFX LAN messages and matches their answers on a single non-blocking UDP socket.
+
+    Callers on any thread submit a batch of messages and wait for all the answers, while the engine thread sends the
+    messages of every caller, matches the answers to the messages by source and sequence number, resends the messages
+    that were not answered every retry_interval seconds and gives up on them at their deadline. Many batches can be
+    in flight at the same time.
+
+    The header of the messages to every device is packed once per message type and kept, every message only patches
+    the sequence number in and appends the payload.
+
+    Attributes:
+        latency_samples: number of recent answer times kept for every device.
+        wait_margin: seconds a caller waits for the engine past the timeout of its messages, before giving up on it.
+    """
+
+    latency_samples = 64
+    wait_margin = 1.0
+
+    def __init__(self, timeout=1.0, retry_interval=0.25):
+        """Inits LIFXLanEngine and starts its thread.
+
+        Args:
+            timeout: default seconds a device has to answer a message, resends included.
+            retry_interval: seconds after which a message that was not answered is sent again.
+        """
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.networks = get_networks()
+        # Unicast and broadcast messages come from two sources, the sequence numbers of broadcasts are not per device
+        self._source = random.randrange(2, 1 << 31)
+        self._broadcast_source = self._source + 1
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._socket.bind(("", 0))
+        self._socket.setblocking(False)
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+        # Only used on the engine thread
+        self._pending = {}
+        self._headers = {}
+        self._sequences = collections.defaultdict(int)
+        self._broadcast_sequence = 0
+
+        self._submitted = collections.deque()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=LIFXLanEngine.latency_samples))
+        self._timeouts = collections.Counter()
+
+        self._thread = threading.Thread(target=self._run, name="lifx-lan-engine", daemon=True)
+        self._thread.start()
+
+    def request(self, devices, message_type, payload=b'', response_type=lifxpackets.ACKNOWLEDGEMENT, timeout=None):
+        """Sends a message to devices and waits for their answers.
+
+        start_request does the same without waiting, so that several messages can be in flight together.
+
+        Args:
+            devices: the LIFXDevices to send the message to.
+            message_type: one of the lifxpackets message type constants.
+            payload: the packed payload of the message.
+            response_type: the message type of the expected answers, ACKNOWLEDGEMENT to ask for acknowledgements.
+            timeout: seconds the devices have to answer, the engine timeout if None.
+
+        Returns:
+            A dictionary from the MAC address of every device to a (seconds to answer, answer payload, answer address)
+            tuple, or to None if the device did not answer.
+        """
+        return self.start_request(devices, message_type, payload, response_type, timeout).wait()
+
+    def start_request(self, devices, message_type, payload=b'', response_type=lifxpackets.ACKNOWLEDGEMENT, timeout=None):
+        """Sends a message to devices without waiting for their answers.
+
+        Returns:
+            An object whose wait() method waits for the answers and returns them like request does.
+        """
+        specs = [(x.mac_addr, x.target, [(x.ip_addr, x.port)], set([x.mac_addr])) for x in devices]
+        return self._submit(specs, message_type, payload, response_type, timeout, [x.mac_addr for x in devices])
+
+    def broadcast(self, addresses, message_type, payload=b'', response_type=lifxpackets.ACKNOWLEDGEMENT, macs=None, timeout=None):
+        """Broadcasts a message to every device of subnets and waits for their answers.
+
+        A broadcast message is tagged, every device of the subnets applies it, including the devices the client does
+        not know about.
+
+        Args:
+            addresses: list of (broadcast address, port) to send the message to.
+            macs: MAC addresses of the devices expected to answer, or None to collect the answers of any device until
+                the timeout.
+            See request for the other arguments.
+
+        Returns:
+            A dictionary from the MAC address of every device that answered to a (seconds to answer, answer payload,
+            answer address) tuple.
+        """
+        return self.start_broadcast(addresses, message_type, payload, response_type, macs, timeout).wait()
+
+    def start_broadcast(self, addresses, message_type, payload=b'', response_type=lifxpackets.ACKNOWLEDGEMENT, macs=None, timeout=None):
+        """Broadcasts a message without waiting for the answers.
+
+        Returns:
+            An object whose wait() method waits for the answers and returns them like broadcast does.
+        """
+        return self._submit([(None, lifxpackets.BROADCAST_TARGET, addresses, set(macs) if macs is not None else None)], message_type, payload, response_type, timeout)
+
+    def get_network(self, ip_addr):
+        """Returns the network of an IPv4 address among the networks of this computer, or None if it is on none of them."""
+        address = ipaddress.ip_address(ip_addr)
+        for network in self.networks:
+            if address in network:
+                return network
+        return None
+
+    def get_discovery_addresses(self):
+        """Returns the (broadcast address, port) of every network except the loopback one, to discover the devices.
+
+        Falls back to the limited broadcast address 255.255.255.255 when the networks are unknown.
+        """
+        addresses = [(str(x.broadcast_address), LIFX_PORT) for x in self.networks if not x.is_loopback]
+        return addresses if len(addresses) > 0 else [("255.255.255.255", LIFX_PORT)]
+
+    def get_metrics(self):
+        """Returns the median and maximum answer times (in milliseconds) and the number of messages left unanswered of every device.
+
+        Returns:
+            A dictionary from MAC addresses to dictionaries with the p50_ms, max_ms and timeouts keys, the devices with
+            the slowest median first.
+        """
+        with self._lock:
+            metrics = {}
+            for mac in set(self._latencies) | set(self._timeouts):
+                latencies = sorted(self._latencies.get(mac, []))
+                metrics[mac] = {
+                    'p50_ms': latencies[len(latencies) // 2] * 1000.0 if latencies else None,
+                    'max_ms': latencies[-1] * 1000.0 if latencies else None,
+                    'timeouts': self._timeouts[mac]
+                }
+        return collections.OrderedDict(sorted(metrics.items(), key=lambda x: -(x[1]['p50_ms'] or float('inf'))))
+
+    def stop(self):
+        """Stops the engine thread, the messages in flight are finished without any answer."""
+        self._stopped = True
+        self._wakeup()
+        self._thread.join()
+        self._fail_all()
+
+    def _submit(self, specs, message_type, payload, response_type, timeout, macs=None):
+        timeout = timeout if timeout is not None else self.timeout
+        transaction = _Transaction(len(specs), time.monotonic() + timeout + LIFXLanEngine.wait_margin, macs)
+        if len(specs) == 0:
+            transaction.done.set()
+            return transaction
+        self._submitted.append((transaction, specs, message_type, payload, response_type, timeout))
+        self._wakeup()
+        # The engine thread may have ended before it could see the messages
+        if not self._thread.is_alive():
+            self._fail_all()
+        return transaction
+
+    def _fail_all(self):
+        # Only called once the engine thread has ended
+        for request in list(self._pending.values()):
+            request.transaction.fail()
+        self._pending.clear()
+        while len(self._submitted) > 0:
+            try:
+                self._submitted.popleft()[0].fail()
+            except IndexError:
+                break
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                # A failure must not end the thread, every caller would then wait for it in vain
+                try:
+                    self._run_once()
+                except Exception as e:
+                    print("LIFX LAN engine error: %s" % e)
+        finally:
+            self._selector.close()
+            self._socket.close()
+            self._fail_all()
+
+    def _run_once(self):
+        now = time.monotonic()
+        timeout = None
+        if len(self._pending) > 0:
+            timeout = max(0, min(min(x.deadline, x.next_send) for x in self._pending.values()) - now)
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._socket:
+                self._receive()
+            else:
+                try:
+                    self._wakeup_recv.recv(1024)
+                except BlockingIOError:
+                    pass
+        while len(self._submitted) > 0:
+            submitted = self._submitted.popleft()
+            try:
+                self._start(*submitted)
+            except Exception:
+                submitted[0].fail()
+                raise
+        self._resend()
+
+    def _start(self, transaction, specs, message_type, payload, response_type, timeout):
+        start = time.monotonic()
+        for mac, target, addresses, expected in specs:
+            if mac is None:
+                self._broadcast_sequence = (self._broadcast_sequence + 1) % 256
+                source, sequence = self._broadcast_source, self._broadcast_sequence
+            else:
+                # Skip the sequence numbers still waiting for an answer from the device
+                sequence = self._sequences[mac]
+                for _ in range(256):
+                    sequence = (sequence + 1) % 256
+                    if (mac, sequence) not in self._pending:
+                        break
+                self._sequences[mac] = sequence
+                source = self._source
+            message = lifxpackets.pack_with_header(self._get_header(source, target, message_type, len(payload), response_type), payload, sequence)
+            request = _Request(transaction, (mac, sequence), message, addresses, response_type, expected, start, start + timeout)
+            self._pending[request.key] = request
+
+    def _get_header(self, source, target, message_type, payload_size, response_type):
+        key = (target, message_type, payload_size, response_type)
+        header = self._headers.get(key)
+        if header is None:
+            ack_required = response_type == lifxpackets.ACKNOWLEDGEMENT
+            header = lifxpackets.pack_header(message_type, payload_size, source, target, ack_required, not ack_required)
+            self._headers[key] = header
+        return header
+
+    def _resend(self):
+        now = time.monotonic()
+        for request in list(self._pending.values()):
+            if now >= request.deadline:
+                self._finish(request)
+            elif now >= request.next_send:
+                request.next_send = now + self.retry_interval
+                for address in request.addresses:
+                    try:
+                        self._socket.sendto(request.message, address)
+                    except OSError as e:
+                        print("Could not send to %s:%d: %s" % (address[0], address[1], e))
+
+    def _receive(self):
+        while True:
+            try:
+                data, address = self._socket.recvfrom(4096)
+            except BlockingIOError:
+                return
+            header = lifxpackets.unpack_header(data)
+            if header is None:
+                continue
+            message_type, source, mac, sequence = header
+            if source == self._source:
+                request = self._pending.get((mac, sequence))
+            elif source == self._broadcast_source:
+                request = self._pending.get((None, sequence))
+            else:
+                continue
+            if request is None or message_type != request.response_type:
+                continue
+            if request.expected is not None and mac not in request.expected:
+                continue
+
+            payload = data[lifxpackets.HEADER.size:]
+            # A device answers GetService once per service it offers, only the UDP one is the address to use
+            if message_type == lifxpackets.STATE_SERVICE and (len(payload) < lifxpackets.STATE_SERVICE_PAYLOAD.size
+                    or lifxpackets.unpack_state_service(payload)[0] != lifxpackets.SERVICE_UDP):
+                continue
+
+            results = request.transaction.results
+            if mac not in results:
+                results[mac] = (time.monotonic() - request.start, payload, address)
+            if request.expected is not None:
+                request.expected.discard(mac)
+                if len(request.expected) == 0:
+                    self._finish(request)
+
+    def _finish(self, request):
+        del self._pending[request.key]
+        results = request.transaction.results
+        with self._lock:
+            for mac in request.expected if request.expected is not None else []:
+                self._timeouts[mac] += 1
+            for mac, result in results.items():
+                if request.key[0] in (None, mac):
+                    self._latencies[mac].append(result[0])
+        request.transaction.request_finished()
@@ -0,0 +1,142 @@
+import struct
+
+# Message types of the LIFX LAN protocol, see https://lan.developer.lifx.com/docs/packet-contents
+GET_SERVICE = 2
+STATE_SERVICE = 3
+GET_LABEL = 23
+STATE_LABEL = 25
+ACKNOWLEDGEMENT = 45
+GET_LOCATION = 48
+STATE_LOCATION = 50
+GET_GROUP = 51
+STATE_GROUP = 53
+LIGHT_GET = 101
+LIGHT_SET_COLOR = 102
+LIGHT_STATE = 107
+LIGHT_SET_POWER = 117
+LIGHT_SET_WAVEFORM_OPTIONAL = 119
+
+# size, protocol and flags, source, target, reserved, response flags, sequence, reserved, type, reserved
+HEADER = struct.Struct("<HHI8s6sBBQHH")
+SEQUENCE_OFFSET = 23
+SET_POWER = struct.Struct("<HI")
+SET_COLOR = struct.Struct("<BHHHHI")
+# reserved, transient, hue, saturation, brightness, kelvin, period, cycles, skew ratio, waveform, set hue, set saturation,
+# set brightness, set kelvin
+SET_WAVEFORM_OPTIONAL = struct.Struct("<BBHHHHIfhBBBBB")
+STATE_SERVICE_PAYLOAD = struct.Struct("<BI")
+# hue, saturation, brightness, kelvin, reserved, power, label, reserved
+LIGHT_STATE_PAYLOAD = struct.Struct("<HHHHhH32sQ")
+# id, label, updated at, for both StateGroup and StateLocation
+STATE_COLLECTION_PAYLOAD = struct.Struct("<16s32sQ")
+
+# Service of the devices answering on UDP in StateService
+SERVICE_UDP = 1
+
+_PROTOCOL = 1024
+_ADDRESSABLE = 0x1000
+_TAGGED = 0x2000
+_ACK_REQUIRED = 0x02
+_RES_REQUIRED = 0x01
+
+BROADCAST_TARGET = bytes(8)
+
+def mac_to_target(mac):
+    """Returns the 8 bytes target field addressing the light with a MAC address such as 'd0:73:d5:01:02:03'."""
+    return bytes.fromhex(mac.replace(':', '')) + bytes(2)
+
+def target_to_mac(target):
+    """Returns the MAC address in a target field."""
+    return ':'.join('%02x' % x for x in target[:6])
+
+def pack(message_type, payload, source, target=BROADCAST_TARGET, sequence=0, ack_required=False, res_required=False):
+    """Packs a message.
+
+    Args:
+        message_type: one of the message type constants.
+        payload: the packed payload of the message.
+        source: 32 bits number identifying the client, the lights answer to the address the message came from if it
+            is not 0.
+        target: target field of the light to send the message to, BROADCAST_TARGET for all the lights.
+        sequence: 8 bits sequence number, copied in the answers.
+        ack_required: whether the light must answer with an ACKNOWLEDGEMENT.
+        res_required: whether the light must answer with the state it is in.
+
+    Returns:
+        The message as bytes.
+    """
+    flags = _PROTOCOL | _ADDRESSABLE | (_TAGGED if target == BROADCAST_TARGET else 0)
+    response_flags = (_ACK_REQUIRED if ack_required else 0) | (_RES_REQUIRED if res_required else 0)
+    return HEADER.pack(HEADER.size + len(payload), flags, source, target, bytes(6), response_flags, sequence, 0, message_type, 0) + payload
+
+def pack_header(message_type, payload_size, source, target=BROADCAST_TARGET, ack_required=False, res_required=False):
+    """Packs the header of a message once, so that it can be sent many times with pack_with_header.
+
+    Args:
+        payload_size: size in bytes of the payloads the header will be sent with.
+        See pack for the other arguments.
+    """
+    return pack(message_type, bytes(payload_size), source, target, 0, ack_required, res_required)[:HEADER.size]
+
+def pack_with_header(header, payload, sequence):
+    """Returns a message made of a header from pack_header, patched with a sequence number, and of a payload."""
+    message = bytearray(header)
+    message[SEQUENCE_OFFSET] = sequence
+    message += payload
+    return message
+
+def unpack_header(data):
+    """Unpacks the header of a message.
+
+    Returns:
+        (message type, source, MAC address of the target, sequence), or None if data is not a LIFX message.
+    """
+    if len(data) < HEADER.size:
+        return None
+    size, flags, source, target, _, _, sequence, _, message_type, _ = HEADER.unpack_from(data)
+    if size != len(data) or flags & 0xfff != _PROTOCOL:
+        return None
+    return message_type, source, target_to_mac(target), sequence
+
+def set_power_payload(power, duration):
+    """Returns the payload of a LIGHT_SET_POWER message.
+
+    Args:
+        power: 0 for off, 65535 for on.
+        duration: transition time in milliseconds.
+    """
+    return SET_POWER.pack(power, duration)
+
+def set_color_payload(hue, saturation, brightness, kelvin, duration):
+    """Returns the payload of a LIGHT_SET_COLOR message, every color component being a 16 bits number and duration in milliseconds."""
+    return SET_COLOR.pack(0, hue, saturation, brightness, kelvin, duration)
+
+def set_color_components_payload(hue, saturation, brightness, kelvin, duration):
+    """Returns the payload of a LIGHT_SET_WAVEFORM_OPTIONAL message changing only some color components of a light.
+
+    A single non transient saw tooth cycle lasting duration milliseconds moves the light to the new color and leaves it
+    there, like LIGHT_SET_COLOR does, except that the components that are None keep their current value.
+    """
+    return SET_WAVEFORM_OPTIONAL.pack(0, 0, hue or 0, saturation or 0, brightness or 0, kelvin or 0, duration, 1.0, 0, 0,
+        hue is not None, saturation is not None, brightness is not None, kelvin is not None)
+
+def _unpack_label(label):
+    return label.rstrip(b'\0').decode('utf-8', 'replace')
+
+def unpack_state_service(payload):
+    """Returns the service and port of a STATE_SERVICE payload."""
+    return STATE_SERVICE_PAYLOAD.unpack_from(payload)
+
+def unpack_light_state(payload):
+    """Returns the (hue, saturation, brightness, kelvin) color, power and label of a LIGHT_STATE payload."""
+    hue, saturation, brightness, kelvin, _, power, label, _ = LIGHT_STATE_PAYLOAD.unpack_from(payload)
+    return (hue, saturation, brightness, kelvin), power, _unpack_label(label)
+
+def unpack_state_label(payload):
+    """Returns the label of a STATE_LABEL payload."""
+    return _unpack_label(payload[:32])
+
+def unpack_state_collection(payload):
+    """Returns the id, as hexadecimal, and the label of a STATE_GROUP or STATE_LOCATION payload."""
+    collection_id, label, _ = STATE_COLLECTION_PAYLOAD.unpack_from(payload)
+    return collection_id.hex(), _unpack_label(label)
@@ -0,0 +1,116 @@
+import threading
+from config_file_parser import Selector
+
+def parse_selector(selector):
+    """Splits a selector from the config into the kinds of lights it selects.
+
+    Args:
+        selector: a LIFX Api selector such as "all", "label:Kitchen" or "group:Upstairs, id:d073d5001122".
+
+    Returns:
+        A list of (Selector, value) tuples, one per comma separated part, value being None for Selector.All.
+
+    Raises:
+        ValueError: a part of the selector is not a light selector.
+    """
+    parsed = []
+    for part in selector.split(','):
+        part = part.strip()
+        if part == Selector.All.value:
+            parsed.append((Selector.All, None))
+            continue
+        for kind in [Selector.Label, Selector.ID, Selector.GroupID, Selector.Group, Selector.LocationID, Selector.Location]:
+            if part.startswith(kind.value):
+                value = part[len(kind.value):].strip()
+                if kind in [Selector.ID, Selector.GroupID, Selector.LocationID]:
+                    # Ids are lower case hexadecimal, the MAC address of the light for its id
+                    value = value.lower().replace(':', '')
+                parsed.append((kind, value))
+                break
+        else:
+            raise ValueError("%s is not a light selector" % part)
+    return parsed
+
+class LIFXSelectorIndex(object):
+    """Resolves selectors to the LIFX lights found on the LAN.
+
+    The lights are indexed by label, id, group and location every time the inventory changes, and every selector is
+    resolved once per inventory, so that resolving the selector of a button action is a dictionary lookup.
+
+    resolve can be called from any thread while update is called from the discovery thread.
+    """
+
+    def __init__(self):
+        """Inits LIFXSelectorIndex without any light."""
+        self.version = 0
+        # selector -> parsed selector, kept across inventories
+        self._parsed = {}
+        # (Selector, value) -> lights of the current inventory
+        self._index = {}
+        # selector -> tuple of lights, the selectors resolved against the current inventory
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def update(self, entries, lights_by_mac):
+        """Indexes a new inventory of lights and forgets the selectors resolved against the previous one.
+
+        Args:
+            entries: the device cache entries of the lights, see LIFXDeviceCache.
+            lights_by_mac: dictionary from the MAC addresses of the lights to the objects resolve returns for them.
+        """
+        index = {}
+        def add(kind, value, mac):
+            if value is not None:
+                index.setdefault((kind, value), []).append(lights_by_mac[mac])
+
+        for entry in sorted(entries, key=lambda x: x['mac']):
+            mac = entry['mac']
+            index.setdefault((Selector.All, None), []).append(lights_by_mac[mac])
+            add(Selector.Label, entry.get('label'), mac)
+            add(Selector.ID, mac.replace(':', ''), mac)
+            group = entry.get('group', {})
+            add(Selector.Group, group.get('name'), mac)
+            add(Selector.GroupID, group.get('id'), mac)
+            location = entry.get('location', {})
+            add(Selector.Location, location.get('name'), mac)
+            add(Selector.LocationID, location.get('id'), mac)
+
+        with self._lock:
+            self._index = index
+            self._resolved = {}
+            self.version += 1
+
+    def resolve(self, selector):
+        """Returns the lights matching a selector, as a tuple.
+
+        Args:
+            selector: a LIFX Api selector, see parse_selector. A selector that does not parse matches no light.
+        """
+        resolved = self._resolved.get(selector)
+        if resolved is not None:
+            return resolved
+
+        parsed = self.parse(selector)
+        with self._lock:
+            lights = []
+            seen = set()
+            for key in parsed:
+                for light in self._index.get(key, []):
+                    if id(light) not in seen:
+                        seen.add(id(light))
+                        lights.append(light)
+            resolved = tuple(lights)
+            self._resolved[selector] = resolved
+        return resolved
+
+    def parse(self, selector):
+        """Returns parse_selector(selector), or an empty list after printing why the selector does not parse, parsing each selector only once."""
+        parsed = self._parsed.get(selector)
+        if parsed is None:
+            try:
+                parsed = parse_selector(selector)
+            except ValueError as e:
+                print("Ignoring selector %s: %s" % (selector, e))
+                parsed = []
+            self._parsed[selector] = parsed
+        return parsed
@@ -0,0 +1,76 @@
+import threading
+import time
+
+class LIFXStateCache(object):
+    """Keeps the last known label, group, power and color of every LIFX light in memory.
+
+    The names come from the discoveries and do not expire. The power and color are updated from the State responses
+    of the lights and from the changes the client makes itself, and are stale ttl seconds after their last update,
+    since the lights can also be changed by other apps or switched off at the wall.
+
+    All methods can be called from any thread.
+    """
+
+    def __init__(self, ttl=60):
+        """Inits LIFXStateCache.
+
+        Args:
+            ttl: seconds after which a power or color is too old to be trusted.
+        """
+        self.ttl = ttl
+        # MAC address -> dictionary of the known values and of the time the power and color were last updated
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def update(self, mac, **values):
+        """Records the values reported by a light or set on it.
+
+        Args:
+            mac: MAC address of the light.
+            **values: any of label, group, power (0 or 65535) and color (hue, saturation, brightness, kelvin tuple).
+        """
+        with self._lock:
+            state = self._states.setdefault(mac, {})
+            state.update(values)
+            if 'power' in values or 'color' in values:
+                state['updated'] = time.monotonic()
+
+    def get(self, mac):
+        """Returns a copy of the values known about a light, without the power and color if they are stale, or None if the light is unknown."""
+        with self._lock:
+            state = self._states.get(mac)
+            if state is None:
+                return None
+            state = dict(state)
+        if time.monotonic() - state.pop('updated', float('-inf')) > self.ttl:
+            state.pop('power', None)
+            state.pop('color', None)
+        return state
+
+    def get_label(self, mac):
+        """Returns the label of a light, or None if it is unknown."""
+        with self._lock:
+            return self._states.get(mac, {}).get('label')
+
+    def get_power(self, mac):
+        """Returns the power of a light, or None if it is unknown or stale."""
+        state = self.get(mac)
+        return state.get('power') if state is not None else None
+
+    def invalidate(self, mac):
+        """Forgets the power and color of a light, for instance after a change it did not acknowledge."""
+        with self._lock:
+            state = self._states.get(mac)
+            if state is not None:
+                state.pop('updated', None)
+
+    def remove(self, mac):
+        """Forgets everything about a light."""
+        with self._lock:
+            self._states.pop(mac, None)
+
+    def get_stale(self, macs):
+        """Returns the MAC addresses among macs whose power or color is unknown or stale."""
+        now = time.monotonic()
+        with self._lock:
+            return [x for x in macs if now - self._states.get(x, {}).get('updated', float('-inf')) > self.ttl]
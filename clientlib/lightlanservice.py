@@ -1,14 +1,70 @@
 import requests
 import os
 import json
+import threading
+from time import monotonic
 import stringformatter
-from lifxlan import *
+import lifxdevicecache
+import lifxstatecache
+import lifxselector
+import lifxpackets
+import lifxlanengine
+import lifxcolor
 from enum import Enum
 
-token = os.environ['TOKEN']
+# The LIFX Api token is only needed for the scenes, the lights are controlled on the LAN
+token = os.environ.get('TOKEN')
 headers = {
     "Authorization": "Bearer %s" % token,
-}
+} if token is not None else {}
+
+def _to_milliseconds(duration):
+    """Returns a duration in seconds from the config, or None, in milliseconds."""
+    try:
+        return int(float(duration) * 1000) if duration is not None else 0
+    except ValueError:
+        raise ValueError("duration %s is not a number" % duration)
+
+def _compile_state(state, default=None):
+    """Turns the power, color, brightness and duration of a State into LAN messages.
+
+    Args:
+        state: the State to set.
+        default: State whose values are used for the values state does not set, or None.
+
+    Returns:
+        A list of (message type, payload, effect) tuples, the color change first so that a light being switched on
+        comes on in its new color. effect is ('power', power) or ('color', (hue, saturation, brightness, kelvin)),
+        with None for the color components the message leaves unchanged.
+
+    Raises:
+        ValueError: a value of the state is not valid.
+    """
+    def value(name):
+        state_value = getattr(state, name)
+        if state_value is None and default is not None:
+            return getattr(default, name)
+        return state_value
+
+    duration = _to_milliseconds(value('duration'))
+    components = lifxcolor.parse_color(value('color')) if value('color') is not None else {}
+    if value('brightness') is not None:
+        components['brightness'] = lifxcolor.parse_brightness(value('brightness'))
+
+    messages = []
+    if len(components) > 0:
+        hsbk = lifxcolor.to_hsbk(components)
+        if None in hsbk:
+            messages.append((lifxpackets.LIGHT_SET_WAVEFORM_OPTIONAL, lifxpackets.set_color_components_payload(*hsbk, duration), ('color', hsbk)))
+        else:
+            messages.append((lifxpackets.LIGHT_SET_COLOR, lifxpackets.set_color_payload(*hsbk, duration), ('color', hsbk)))
+    power = value('power')
+    if power is not None:
+        if power not in ['on', 'off']:
+            raise ValueError("power %s is neither on nor off" % power)
+        power = 65535 if power == 'on' else 0
+        messages.append((lifxpackets.LIGHT_SET_POWER, lifxpackets.set_power_payload(power, duration), ('power', power)))
+    return messages
 
 class LIFXGroup(object):
     """Representation of a location for LIFX groups.
@@ -51,32 +107,236 @@ class LIFXLightLanService(object):
     """Service to handle all LIFX Api requests.
 
     Attributes:
-        all_lights_suffix: url suffix to get all lights
         scenes_suffix: url suffix to get scenes
+        min_broadcast_lights: number of lights from which a change to every known light of a subnet is broadcast.
     """
 
-    all_lights_suffix = "lights/all"
     scenes_suffix = "scenes"
+    min_broadcast_lights = 2
 
-    def __init__(self, endpoint_base_url):
+    def __init__(self, endpoint_base_url, device_cache_file_name="lifx_devices.json", rediscovery_interval=300, state_ttl=60):
         """Initializes the LIFXLightService by setting the endpoint_base_url.
 
+        The lights found last time are loaded from the device cache so that they can be used straight away, while a
+        background thread discovers the lights on the LAN and keeps the cache up to date. The same thread keeps the
+        power and color of the lights fresh in the state cache, so that actions do not have to ask the lights first.
+
         Args:
             endpoint_base_url: Base url for LIFX Api to base all requests off.
+            device_cache_file_name: name of the file the discovered lights are kept in between two runs.
+            rediscovery_interval: seconds between two discoveries of the lights on the LAN.
+            state_ttl: seconds after which the cached power and color of a light are asked again.
         """
         self.endpoint_base_url = endpoint_base_url
+        self.rediscovery_interval = rediscovery_interval
+        self.state_cache = lifxstatecache.LIFXStateCache(state_ttl)
+        self.engine = lifxlanengine.LIFXLanEngine()
+        self.selector_index = lifxselector.LIFXSelectorIndex()
+        # network -> MAC addresses of the known lights on the network
+        self._macs_by_network = {}
+
+        self.device_cache = lifxdevicecache.LIFXDeviceCache(device_cache_file_name)
+        self._lights_by_mac = {}
+        self.devices = self._update_devices(self.device_cache.load().values())
+        if len(self.devices) > 0:
+            print("Loaded {} light(s) from {}, discovering lights in the background...".format(len(self.devices), device_cache_file_name))
+        else:
+            print("Discovering lights in the background...")
 
-        num_lights = 5
+        self._stopped = threading.Event()
+        # Set once the first discovery is over, whether it found lights or not
+        self._discovered = threading.Event()
+        self._discovery_thread = threading.Thread(target=self._run_discovery, name="lifx-discovery", daemon=True)
+        self._discovery_thread.start()
 
-        print("Discovering lights...")
-        self.lifx = LifxLAN(num_lights)
+    def discover_devices(self):
+        """Discovers the lights on the LAN and reconciles them with the device cache.
 
-        # get devices
-        self.devices = self.lifx.get_lights()
-        print("\nFound {} light(s):\n".format(len(self.devices)))
+        Lights that were not known are added, lights that moved to a new address are re-addressed, and lights that
+        have not been found for a few discoveries in a row are removed. Runs on the discovery thread, the lights
+        in use are swapped in one go so that actions running meanwhile are not interrupted.
+        """
+        discovered = {}
+        for mac, (_, payload, address) in self.engine.broadcast(self.engine.get_discovery_addresses(), lifxpackets.GET_SERVICE, response_type=lifxpackets.STATE_SERVICE).items():
+            service, port = lifxpackets.unpack_state_service(payload)
+            if service == lifxpackets.SERVICE_UDP:
+                discovered[mac] = { 'mac': mac, 'ip': address[0], 'port': port }
+
+        # The names of the lights that do not answer are kept from the cache, they will be asked again next time.
+        # The states, which hold the labels, the groups and the locations are asked all at once.
+        lights = [lifxlanengine.LIFXDevice(x['mac'], x['ip'], x['port']) for x in discovered.values()]
+        states = self.engine.start_request(lights, lifxpackets.LIGHT_GET, response_type=lifxpackets.LIGHT_STATE)
+        groups = self.engine.start_request(lights, lifxpackets.GET_GROUP, response_type=lifxpackets.STATE_GROUP)
+        locations = self.engine.start_request(lights, lifxpackets.GET_LOCATION, response_type=lifxpackets.STATE_LOCATION)
+        self._record_states(lights, states.wait())
+        groups = groups.wait()
+        locations = locations.wait()
+        for light in lights:
+            entry = discovered[light.mac_addr]
+            if light.label is not None:
+                entry['label'] = light.label
+            if groups[light.mac_addr] is not None:
+                group_id, group_name = lifxpackets.unpack_state_collection(groups[light.mac_addr][1])
+                entry['group'] = { 'id': group_id, 'name': group_name }
+            if locations[light.mac_addr] is not None:
+                location_id, location_name = lifxpackets.unpack_state_collection(locations[light.mac_addr][1])
+                entry['location'] = { 'id': location_id, 'name': location_name }
+
+        added, removed, moved = self.device_cache.reconcile(list(discovered.values()))
+        self.devices = self._update_devices(self.device_cache.entries.values())
+        self.device_cache.save()
+        if len(added) > 0 or len(removed) > 0 or len(moved) > 0:
+            print("Discovered {} light(s): {} new, {} removed, {} with a new address".format(len(self.devices), len(added), len(removed), len(moved)))
+
+    def stop(self):
+        """Stops the background discovery and the LAN engine."""
+        self._stopped.set()
+        self.engine.stop()
+
+    def refresh_states(self):
+        """Asks the lights whose cached power and color are stale for their current state."""
+        stale = set(self.state_cache.get_stale(x.mac_addr for x in self.devices))
+        self._refresh_states([x for x in self.devices if x.mac_addr in stale])
+
+    def get_light_latencies(self):
+        """Returns how long every light takes to answer, see LIFXLanEngine.get_metrics."""
+        return self.engine.get_metrics()
+
+    def _run_discovery(self):
+        # Refresh the states a bit before they go stale
+        refresh_interval = min(self.state_cache.ttl / 2.0, self.rediscovery_interval)
+        next_discovery = monotonic()
+        while True:
+            try:
+                if monotonic() >= next_discovery:
+                    next_discovery = monotonic() + self.rediscovery_interval
+                    self.discover_devices()
+                else:
+                    self.refresh_states()
+            except Exception as e:
+                print("Light discovery failed: {}".format(e))
+            self._discovered.set()
+            if self._stopped.wait(refresh_interval):
+                return
+
+    def _refresh_states(self, lights):
+        self._record_states(lights, self.engine.request(lights, lifxpackets.LIGHT_GET, response_type=lifxpackets.LIGHT_STATE))
+
+    def _record_states(self, lights, results):
+        # LightState holds the label as well as the power and color
+        for mac, result in results.items():
+            if result is not None:
+                color, power, label = lifxpackets.unpack_light_state(result[1])
+                self.state_cache.update(mac, label=label, power=power, color=color)
+        for light in lights:
+            label = self.state_cache.get_label(light.mac_addr)
+            if label is not None:
+                light.label = label
+
+    def _get_powers(self, lights):
+        # Only ask the lights whose cached power is stale
+        stale = set(self.state_cache.get_stale(x.mac_addr for x in lights))
+        self._refresh_states([x for x in lights if x.mac_addr in stale])
+        return [self.state_cache.get_power(x.mac_addr) for x in lights]
+
+    def _start_broadcast(self, lights, message_type, payload):
+        # Broadcasts a message to the subnets where it goes to every known light, returns the transaction and the
+        # lights it targets, or None and no light
+        macs = set(x.mac_addr for x in lights)
+        networks = [x for x, network_macs in self._macs_by_network.items() if len(network_macs) >= LIFXLightLanService.min_broadcast_lights and network_macs <= macs]
+        if len(networks) == 0:
+            return None, set()
+        targets = set(x for network in networks for x in self._macs_by_network[network])
+        ports = set(x.port for x in lights if x.mac_addr in targets)
+        # Leave the lights that do not acknowledge the broadcast quickly to the unicast requests
+        return self.engine.start_broadcast([(str(x.broadcast_address), port) for x in networks for port in ports], message_type, payload, macs=targets, timeout=self.engine.retry_interval), targets
+
+    def _send_messages(self, messages):
+        """Sends messages to lights all at once and records their effect in the state cache.
+
+        Every message is broadcast when possible and sent to its other lights one by one, all the messages being in
+        flight together, then the lights that did not acknowledge a broadcast are sent it one by one.
+
+        Args:
+            messages: list of (lights, message type, payload, effect) tuples, see _compile_state for effect.
+        """
+        sent = []
+        for lights, message_type, payload, effect in messages:
+            broadcast, targets = self._start_broadcast(lights, message_type, payload)
+            unicast = self.engine.start_request([x for x in lights if x.mac_addr not in targets], message_type, payload)
+            sent.append((lights, message_type, payload, effect, broadcast, targets, unicast))
+
+        retries = []
+        for lights, message_type, payload, effect, broadcast, targets, unicast in sent:
+            results = {}
+            if broadcast is not None:
+                acknowledged = broadcast.wait()
+                results.update(acknowledged)
+                retry = self.engine.start_request([x for x in lights if x.mac_addr in targets and x.mac_addr not in acknowledged], message_type, payload)
+                retries.append((lights, effect, results, [unicast, retry]))
+            else:
+                retries.append((lights, effect, results, [unicast]))
+
+        for lights, effect, results, transactions in retries:
+            for transaction in transactions:
+                results.update(transaction.wait())
+            for light in lights:
+                if results.get(light.mac_addr) is None:
+                    # Ask the light for its state next time rather than trusting the cache
+                    self.state_cache.invalidate(light.mac_addr)
+                    print("Light {} ({}) did not acknowledge the {} change".format(light.label, light.mac_addr, effect[0]))
+                else:
+                    self._apply_effect(light.mac_addr, effect)
+
+    def _apply_effect(self, mac, effect):
+        kind, value = effect
+        if kind == 'power':
+            self.state_cache.update(mac, power=value)
+        elif None not in value:
+            self.state_cache.update(mac, color=value)
+        else:
+            # Only some components changed, the others are still the ones in the cache if it knows them
+            state = self.state_cache.get(mac)
+            color = state.get('color') if state is not None else None
+            if color is None:
+                self.state_cache.invalidate(mac)
+            else:
+                self.state_cache.update(mac, color=tuple(x if x is not None else y for x, y in zip(value, color)))
+
+    def _set_power(self, lights, power, duration):
+        self._send_messages([(lights, lifxpackets.LIGHT_SET_POWER, lifxpackets.set_power_payload(power, _to_milliseconds(duration)), ('power', power))])
+
+    def _update_devices(self, entries):
+        # Reuse the LIFXDevice of every known light, so that the requests running on it are not disturbed
+        lights_by_mac = {}
+        for entry in entries:
+            light = self._lights_by_mac.get(entry['mac'])
+            if light is None:
+                light = lifxlanengine.LIFXDevice(entry['mac'], entry['ip'], entry['port'])
+            else:
+                light.ip_addr = entry['ip']
+                light.port = entry['port']
+            light.label = entry.get('label')
+            self.state_cache.update(entry['mac'], label=light.label, group=entry.get('group', {}).get('name'))
+            lights_by_mac[entry['mac']] = light
+        for mac in self._lights_by_mac:
+            if mac not in lights_by_mac:
+                self.state_cache.remove(mac)
+        self.selector_index.update(entries, lights_by_mac)
+        macs_by_network = {}
+        for mac, light in lights_by_mac.items():
+            network = self.engine.get_network(light.ip_addr)
+            if network is not None:
+                macs_by_network.setdefault(network, set()).add(mac)
+        self._macs_by_network = macs_by_network
+        self._lights_by_mac = lights_by_mac
+        return list(lights_by_mac.values())
 
     def refresh_light_data(self, is_config_mode):
-        """Gets all lights, groups, locations and scenes from the LIFX Api.
+        """Gets all lights, groups and locations from the LAN, and the scenes from the LIFX Api if a TOKEN is set.
+
+        Waits for the first discovery of the lights when none were loaded from the device cache, and always in config
+        mode so that the lights printed are the ones on the LAN right now.
 
         Args:
             is_config_mode: if True, will print all information to console to help with writing the config file.
@@ -91,6 +351,9 @@ class LIFXLightLanService(object):
                'scenes': {SceneData}
             }
         """
+        if is_config_mode or len(self.devices) == 0:
+            self._discovered.wait()
+
         light_info = self.get_light_data()
         lights = light_info['lights']
         groups = light_info['groups']
@@ -112,7 +375,7 @@ class LIFXLightLanService(object):
 
 
     def get_light_data(self):
-        """Sends a request to the LIFX Api to get all light data.
+        """Builds the light data from the lights discovered on the LAN.
 
         Returns:
             A dictionary of Lights, Groups, and Locations.
@@ -122,43 +385,42 @@ class LIFXLightLanService(object):
                'groups': {GroupData},
                'locations': {Locations}
             }
-            Lifx api doesn't give an easy way to get group
-            information like it does for scenes so we need
-            to get group information from light information.
+            Every light is a dictionary shaped like the lights of the LIFX Api, with its id, label, connected, power,
+            color, brightness, group and location. The power, color and brightness are left out while unknown, and
+            the group and location of a light that never reported them too.
         """
-        response = requests.get(self.endpoint_base_url + LIFXLightLanService.all_lights_suffix, headers=headers)
-        lights = json.loads(response.text)
-
-        # Init the groups and locations dictionaries
+        lights = []
         groups = {}
         locations = {}
-        for light in lights:
+        for entry in sorted(self.device_cache.entries.values(), key=lambda x: x['mac']):
+            light = {
+                'id': entry['mac'].replace(':', ''),
+                'label': entry.get('label', entry['mac']),
+                'connected': entry.get('missed', 0) == 0,
+            }
+            state = self.state_cache.get(entry['mac']) or {}
+            if state.get('power') is not None:
+                light['power'] = 'on' if state['power'] > 0 else 'off'
+            if state.get('color') is not None:
+                hue, saturation, brightness, kelvin = state['color']
+                light['color'] = { 'hue': hue * 360.0 / 65535, 'saturation': saturation / 65535.0, 'kelvin': kelvin }
+                light['brightness'] = brightness / 65535.0
+            lights.append(light)
 
             # Get group information
-            group_info = light["group"]
-            group_id = group_info["id"]
-            group_name = group_info["name"]
-
-            # If group exists already, add the light to it
-            if group_id in groups:
-                groups[group_id].add_light(light)
-            # Else if the group doesn't exist yet, create it and add the light to it
-            else:
-                groups[group_id] = LIFXGroup(group_id, group_name)
+            if 'group' in entry:
+                light['group'] = dict(entry['group'])
+                group_id = entry['group']['id']
+                if group_id not in groups:
+                    groups[group_id] = LIFXGroup(group_id, entry['group']['name'])
                 groups[group_id].add_light(light)
 
-
             # Get location information
-            location_info = light["location"]
-            location_id = location_info["id"]
-            location_name = location_info["name"]
-
-            # If location exists already, add the light to it
-            if location_id in locations:
-                locations[location_id].add_light(light)
-            # Else if the location doesn't exist yet, create it and add the light to it
-            else:
-                locations[location_id] = LIFXLocation(location_id, location_name)
+            if 'location' in entry:
+                light['location'] = dict(entry['location'])
+                location_id = entry['location']['id']
+                if location_id not in locations:
+                    locations[location_id] = LIFXLocation(location_id, entry['location']['name'])
                 locations[location_id].add_light(light)
 
         return { 'lights': lights, 'groups': groups, 'locations': locations }
@@ -167,62 +429,95 @@ class LIFXLightLanService(object):
         """Sends a request to the LIFX Api to get all scenes.
 
         Returns:
-            A list of scenes.
+            A list of scenes, empty if no TOKEN is set.
         """
+        if token is None:
+            print("No TOKEN set, the scenes of the LIFX Api are not available")
+            return []
         response = requests.get(self.endpoint_base_url + LIFXLightLanService.scenes_suffix, headers=headers)
         scenes = json.loads(response.text)
         return scenes
 
     def toggle(self, selector, duration):
-        """Sends a request to the LIFX Api to toggle all matches for the selector.
+        """Toggles all matches for the selector: switches them all off if any of them is on, all on otherwise.
+
+        The power of the lights comes from the state cache, only the lights whose cached power is stale are asked for it.
         """
-        for d in self.devices:
-            if (str(d.get_label(), 'utf-8') in ['Kitchen Front', 'Kitchen Back']):
-                d.set_power(65535 - d.get_power())
+        lights = self.selector_index.resolve(selector)
+        power = 0 if any(self._get_powers(lights)) else 65535
+        self._set_power(lights, power, duration)
 
     def set_state(self, state, selector):
-        """Sends a request to the LIFX Api to set a state matching a selector.
+        """Sets the power, color, brightness of a state on the lights matching a selector.
         """
-        for d in self.devices:
-            if ((str(d.get_label(), 'utf-8') != 'Upstairs Landing') and (d.get_power() == 65535)):
-                d.set_power("off")
+        self.compile_set_state(state, selector)()
 
+    def compile_set_state(self, state, selector):
+        """Prepares the LAN messages setting a state matching a selector once, so that they can be sent on every button press.
+
+        Args:
+            state: the State to set.
+            selector: selector of the lights to set the state of.
+
+        Returns:
+            A function sending the messages.
+
+        Raises:
+            ValueError: a value of the state is not valid.
+        """
+        if selector is None:
+            selector = state.selector if state.selector is not None else lifxselector.Selector.All.value
+        return self._compile_messages([(selector, _compile_state(state))])
 
     def set_states(self, states, default):
-        """Sends a request to the LIFX Api to set multiple states matching selectors.
+        """Sets multiple states matching selectors on the lights.
+        """
+        self.compile_set_states(states, default)()
+
+    def compile_set_states(self, states, default):
+        """Prepares the LAN messages setting multiple states matching selectors once, so that they can be sent on every button press.
+
+        The messages of all the states are sent together rather than one state after the other.
+
+        Args:
+            states: list of States to set.
+            default: State holding the default values for the states, or None.
+
+        Returns:
+            A function sending the messages.
+
+        Raises:
+            ValueError: a value of a state is not valid.
         """
-        states_to_send = []
+        compiled = []
         for state in states:
-            state_to_send = {}
-            if state.power is not None:
-                state_to_send['power'] = state.power
-            if state.color is not None:
-                state_to_send['color'] = state.color
-            if state.brightness is not None:
-                state_to_send['brightness'] = state.brightness
-            if state.duration is not None:
-                state_to_send['duration'] = state.duration
-            if state.selector is not None:
-                state_to_send['selector'] = state.selector
-            states_to_send.append(state_to_send)
-
-        defaults = {}
-        if default is not None:
-            if default.power is not None:
-                defaults['power'] = default.power
-            if default.color is not None:
-                defaults['color'] = default.color
-            if default.brightness is not None:
-                defaults['brightness'] = default.brightness
-            if default.duration is not None:
-                defaults['duration'] = default.duration
-        body = { "states": states_to_send, "defaults": defaults}
-        response = requests.put(self.endpoint_base_url + 'lights/states', data=json.dumps(body), headers=headers)
+            selector = state.selector
+            if selector is None:
+                selector = default.selector if default is not None and default.selector is not None else lifxselector.Selector.All.value
+            compiled.append((selector, _compile_state(state, default)))
+        return self._compile_messages(compiled)
+
+    def _compile_messages(self, compiled):
+        # Report a selector that does not parse when the config is loaded rather than on the first click
+        for selector, _ in compiled:
+            self.selector_index.parse(selector)
+
+        def send():
+            messages = []
+            for selector, state_messages in compiled:
+                lights = self.selector_index.resolve(selector)
+                if len(lights) > 0:
+                    messages.extend((lights, message_type, payload, effect) for message_type, payload, effect in state_messages)
+            self._send_messages(messages)
+        return send
 
 
     def activate_scene(self, uuid, duration):
         """Sends a request to the LIFX Api to activate the scene identified by the uuid. Optional duration to activate over time.
         """
+        if token is None:
+            print("No TOKEN set, can't activate scene %s" % uuid)
+            return
         if duration is None:
             response = requests.put(self.endpoint_base_url + 'scenes/scene_id:%s/activate' % uuid, headers=headers)
         else:
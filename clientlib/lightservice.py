@@ -1,6 +1,7 @@
 import requests
 import os
 import json
+import urllib.parse
 import stringformatter
 from enum import Enum
 
@@ -9,6 +10,19 @@ headers = {
     "Authorization": "Bearer %s" % token,
 }    
 
+def _state_to_dict(state):
+    """Returns the power, color, brightness and duration values set in a State as a dictionary."""
+    values = {}
+    if state.power is not None:
+        values['power'] = state.power
+    if state.color is not None:
+        values['color'] = state.color
+    if state.brightness is not None:
+        values['brightness'] = state.brightness
+    if state.duration is not None:
+        values['duration'] = state.duration
+    return values
+
 class LIFXGroup(object):
     """Representation of a location for LIFX groups.
     """
@@ -175,47 +189,60 @@ class LIFXLightService(object):
     def set_state(self, state, selector):
         """Sends a request to the LIFX Api to set a state matching a selector.
         """
-        body = {}
-        if state.power is not None:
-            body['power'] = state.power
-        if state.color is not None:
-            body['color'] = state.color
-        if state.brightness is not None:
-            body['brightness'] = state.brightness
-        if state.duration is not None:
-            body['duration'] = state.duration
-        response = requests.put(self.endpoint_base_url + '/lights/' + selector + '/state', data=body, headers=headers)
+        self.compile_set_state(state, selector)()
+        
+    def compile_set_state(self, state, selector):
+        """Serializes the request to set a state matching a selector once, so that it can be sent on every button press.
+        
+        Args:
+            state: the State to set.
+            selector: selector of the lights to set the state of.
+        
+        Returns:
+            A function sending the request.
+        
+        Raises:
+            ValueError: neither the action nor the state has a selector.
+        """
+        if selector is None:
+            selector = state.selector
+        if selector is None:
+            raise ValueError("state %s has no selector" % state.state_name)
+        url = self.endpoint_base_url + '/lights/' + selector + '/state'
+        data = urllib.parse.urlencode(_state_to_dict(state))
+        form_headers = dict(headers)
+        form_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return lambda: requests.put(url, data=data, headers=form_headers)
         
     def set_states(self, states, default):
         """Sends a request to the LIFX Api to set multiple states matching selectors.
         """
+        self.compile_set_states(states, default)()
+        
+    def compile_set_states(self, states, default):
+        """Serializes the request to set multiple states matching selectors once, so that it can be sent on every button press.
+        
+        Args:
+            states: list of States to set.
+            default: State holding the default values for the states, or None.
+        
+        Returns:
+            A function sending the request.
+        """
         states_to_send = []
         for state in states:
-            state_to_send = {}
-            if state.power is not None:
-                state_to_send['power'] = state.power
-            if state.color is not None:
-                state_to_send['color'] = state.color
-            if state.brightness is not None:
-                state_to_send['brightness'] = state.brightness
-            if state.duration is not None:
-                state_to_send['duration'] = state.duration
+            state_to_send = _state_to_dict(state)
             if state.selector is not None:
                 state_to_send['selector'] = state.selector
             states_to_send.append(state_to_send)
         
         defaults = {}
         if default is not None:
-            if default.power is not None:
-                defaults['power'] = default.power
-            if default.color is not None:
-                defaults['color'] = default.color
-            if default.brightness is not None:
-                defaults['brightness'] = default.brightness
-            if default.duration is not None:
-                defaults['duration'] = default.duration
+            defaults = _state_to_dict(default)
         body = { "states": states_to_send, "defaults": defaults}
-        response = requests.put(self.endpoint_base_url + 'lights/states', data=json.dumps(body), headers=headers)
+        url = self.endpoint_base_url + 'lights/states'
+        data = json.dumps(body)
+        return lambda: requests.put(url, data=data, headers=headers)
         
         
     def activate_scene(self, uuid, duration):
@@ -0,0 +1,69 @@
+import collections
+
+class QueuedEventPolicy(object):
+    """Decides what to do with the clicks a button queued while it was disconnected from flicd.
+
+    When a button reconnects it flushes its queued clicks in a burst, each with its age in seconds (time_diff).
+    Clicks older than max_age are stale and dropped. The others are collected for burst_window seconds after the first
+    one arrives, then folded down to their net effect in a single pass through the action coalescer, so that a burst
+    of toggles does not make the lights flicker and a burst of state changes only sets the last state.
+
+    All methods must be called from the thread that handles the flicd events, which also runs the burst timer.
+    """
+
+    def __init__(self, client, action_coalescer, max_age=10, burst_window=0.1):
+        """Inits QueuedEventPolicy.
+
+        Args:
+            client: FlicClient whose timer ends the bursts.
+            action_coalescer: ActionCoalescer to fold the bursts with.
+            max_age: seconds after which a queued click is too old to be replayed, 0 to drop every queued click.
+            burst_window: seconds during which the queued clicks are collected into one burst.
+        """
+        self.client = client
+        self.action_coalescer = action_coalescer
+        self.max_age = max_age
+        self.burst_window = burst_window
+        self._burst = None
+        self._burst_timer = None
+        self.counters = collections.Counter()
+
+    def add(self, action, time_diff):
+        """Replays a queued click with the next ones of its burst, or drops it if it is stale.
+
+        Args:
+            action: the CompiledAction of the click.
+            time_diff: seconds since the click happened.
+        """
+        if time_diff >= self.max_age:
+            self.counters['stale'] += 1
+            return
+
+        if self._burst is None:
+            self._burst = []
+            self._burst_timer = self.client.set_timer(self.burst_window * 1000, self._end_burst)
+        self._burst.append(action)
+
+    def flush(self):
+        """Replays the burst being collected now rather than when its window ends.
+
+        Must be called before a live click runs, otherwise the older queued clicks would run after it and override it.
+        """
+        if self._burst is None:
+            return
+        self._burst_timer.cancel()
+        self._end_burst()
+
+    def get_metrics(self):
+        """Returns the number of queued clicks replayed and dropped as stale, and the number of bursts, as a dictionary."""
+        metrics = dict.fromkeys(['replayed', 'stale', 'bursts'], 0)
+        metrics.update(self.counters)
+        return metrics
+
+    def _end_burst(self):
+        burst = self._burst
+        self._burst = None
+        self._burst_timer = None
+        self.counters['bursts'] += 1
+        self.counters['replayed'] += len(burst)
+        self.action_coalescer.submit_burst(burst)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# The client modules import each other as top level modules, the way client.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'clientlib'))
+
+
+class FakeTimer(object):
+    def __init__(self, timeout_millis, callback):
+        self.timeout_millis = timeout_millis
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeClient(object):
+    """Stands in for FlicClient: timers only run when the test fires them."""
+
+    def __init__(self):
+        self.timers = []
+
+    def set_timer(self, timeout_millis, callback):
+        timer = FakeTimer(timeout_millis, callback)
+        self.timers.append(timer)
+        return timer
+
+    def fire_timers(self):
+        """Runs the timers set so far that were not cancelled, including the ones they set."""
+        while self.timers:
+            timer = self.timers.pop(0)
+            if not timer.cancelled:
+                timer.callback()
+
+
+class RecordingExecutor(object):
+    """Stands in for ActionExecutor: records the calls queued on it instead of running them."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, key, function, *args):
+        self.submitted.append((key, function, args))
+        return True
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient()
+
+
+@pytest.fixture
+def recording_executor():
+    return RecordingExecutor()
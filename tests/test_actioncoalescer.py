@@ -0,0 +1,84 @@
+import actioncoalescer
+from buttonhandler import CompiledAction
+
+
+def toggle(key='group:Kitchen', duration=None):
+    return CompiledAction('Toggle ' + key, 'Toggle', key, 'toggle', (key, duration))
+
+
+def set_state(name, key='group:Kitchen'):
+    return CompiledAction('Set ' + name, 'SetState', key, 'set_state', (name,))
+
+
+def activate_scene(uuid):
+    return CompiledAction('Scene ' + uuid, 'ActivateScene', 'scene:' + uuid, 'activate_scene', (uuid,))
+
+
+def submitted_args(executor):
+    return [args for _, _, args in executor.submitted]
+
+
+def test_first_action_passes_straight_through(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    coalescer.submit(toggle())
+    assert submitted_args(recording_executor) == [('group:Kitchen', None)]
+    assert coalescer.get_metrics()['passed'] == 1
+
+
+def test_pair_of_toggles_cancels_out(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    for _ in range(3):
+        coalescer.submit(toggle())
+    fake_client.fire_timers()
+    assert len(recording_executor.submitted) == 1
+    assert coalescer.get_metrics()['toggles_cancelled'] == 2
+
+
+def test_toggles_with_different_durations_are_kept(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    coalescer.submit(toggle())
+    coalescer.submit(toggle(duration=1.0))
+    coalescer.submit(toggle(duration=2.0))
+    fake_client.fire_timers()
+    assert submitted_args(recording_executor) == [('group:Kitchen', None), ('group:Kitchen', 1.0), ('group:Kitchen', 2.0)]
+
+
+def test_last_state_replaces_pending_states(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    for name in ['Red', 'Green', 'Blue']:
+        coalescer.submit(set_state(name))
+    fake_client.fire_timers()
+    assert submitted_args(recording_executor) == [('Red',), ('Blue',)]
+    assert coalescer.get_metrics()['states_replaced'] == 1
+
+
+def test_scene_drops_pending_states_of_every_selector(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    coalescer.submit(set_state('Red', 'group:Kitchen'))
+    coalescer.submit(set_state('Green', 'group:Kitchen'))
+    coalescer.submit(activate_scene('1234'))
+    fake_client.fire_timers()
+    assert submitted_args(recording_executor) == [('Red',), ('1234',)]
+    assert coalescer.get_metrics()['superseded_by_scene'] == 1
+
+
+def test_different_selectors_are_not_folded(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    coalescer.submit(toggle('group:Kitchen'))
+    coalescer.submit(toggle('group:Bedroom'))
+    assert [key for key, _, _ in recording_executor.submitted] == ['group:Kitchen', 'group:Bedroom']
+
+
+def test_no_window_queues_every_action(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor, window=0)
+    coalescer.submit(toggle())
+    coalescer.submit(toggle())
+    assert len(recording_executor.submitted) == 2
+    assert fake_client.timers == []
+
+
+def test_burst_folds_to_net_effect_in_order(fake_client, recording_executor):
+    coalescer = actioncoalescer.ActionCoalescer(fake_client, recording_executor)
+    kitchen = toggle('group:Kitchen')
+    coalescer.submit_burst([kitchen, set_state('Red', 'group:Bedroom'), kitchen, set_state('Blue', 'group:Bedroom'), toggle('group:Hall')])
+    assert submitted_args(recording_executor) == [('Blue',), ('group:Hall', None)]
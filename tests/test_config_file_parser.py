@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+import config_file_parser
+from config_file_parser import ConfigError, ConfigFileParser
+
+MAIN_CONFIG = """
+[INCLUDE]
+Files: rooms/*.cfg
+
+[BUTTON 80:e4:da:00:00:01]
+SingleClick: Toggle Kitchen
+Hold: Evening
+
+[ACTION Toggle Kitchen]
+Toggle: group:Kitchen
+Duration: 1.5
+"""
+
+BEDROOM_CONFIG = """
+[ACTION Evening]
+Set states: Dim, Off
+Default: Dim
+
+[STATE Dim]
+power: on
+brightness: 0.2
+
+[STATE Off]
+power: off
+"""
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return str(path)
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    write(tmp_path / 'rooms' / 'bedroom.cfg', BEDROOM_CONFIG)
+    return tmp_path
+
+
+def test_included_files_are_merged(config_dir):
+    parser = ConfigFileParser(write(config_dir / 'button_actions.cfg', MAIN_CONFIG))
+    config = parser.parse_config()
+    assert set(config['actions']) == set(['Toggle Kitchen', 'Evening'])
+    assert set(config['states']) == set(['Dim', 'Off'])
+    assert config['actions']['Toggle Kitchen'].duration == '1.5'
+    assert config['actions']['Evening'].states == ['Dim', 'Off']
+    assert parser.get_config_files() == [str(config_dir / 'button_actions.cfg'), str(config_dir / 'rooms' / 'bedroom.cfg')]
+
+
+def test_missing_included_file_is_an_error(tmp_path):
+    parser = ConfigFileParser(write(tmp_path / 'button_actions.cfg', MAIN_CONFIG.replace('rooms/*.cfg', 'kitchen.cfg')))
+    with pytest.raises(ConfigError):
+        parser.parse_config()
+
+
+def test_sections_defined_twice_are_an_error(config_dir):
+    write(config_dir / 'rooms' / 'other.cfg', "[STATE Dim]\npower: off\n")
+    parser = ConfigFileParser(write(config_dir / 'button_actions.cfg', MAIN_CONFIG))
+    with pytest.raises(ConfigError) as e:
+        parser.parse_config()
+    assert 'STATE Dim' in str(e.value)
+
+
+def test_index_finds_buttons_through_states(config_dir):
+    parser = ConfigFileParser(write(config_dir / 'button_actions.cfg', MAIN_CONFIG))
+    parser.parse_config()
+    index = parser.index
+    assert index.sources[('STATE', 'Dim')] == str(config_dir / 'rooms' / 'bedroom.cfg')
+    assert index.buttons_using([], ['Off']) == set(['80:e4:da:00:00:01'])
+    assert index.buttons_using(['Toggle Kitchen'], []) == set(['80:e4:da:00:00:01'])
+    assert index.buttons_using(['Unused'], ['Unused']) == set()
+
+
+def test_unchanged_files_keep_their_objects(config_dir):
+    parser = ConfigFileParser(write(config_dir / 'button_actions.cfg', MAIN_CONFIG))
+    first = parser.parse_config()
+    write(config_dir / 'rooms' / 'bedroom.cfg', BEDROOM_CONFIG.replace('0.2', '0.3'))
+    second = parser.parse_config()
+    assert second['actions']['Toggle Kitchen'] is first['actions']['Toggle Kitchen']
+    assert second['states']['Dim'] is not first['states']['Dim']
+    assert second['states']['Dim'].brightness == '0.3'
+
+
+def test_cache_is_used_by_a_new_parser(config_dir, monkeypatch):
+    file_name = write(config_dir / 'button_actions.cfg', MAIN_CONFIG)
+    ConfigFileParser(file_name).parse_config()
+    assert os.path.exists(file_name + ConfigFileParser.cache_suffix)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the config should have been loaded from the cache")
+    monkeypatch.setattr(ConfigFileParser, '_parse_content', fail)
+    config = ConfigFileParser(file_name).parse_config()
+    action = config['actions']['Evening']
+    assert isinstance(action, config_file_parser.Action)
+    assert (action.action_type, action.states, action.default) == ('SetStates', ['Dim', 'Off'], 'Dim')
+
+
+def test_stale_cache_is_ignored(config_dir):
+    file_name = write(config_dir / 'button_actions.cfg', MAIN_CONFIG)
+    ConfigFileParser(file_name).parse_config()
+    write(config_dir / 'button_actions.cfg', MAIN_CONFIG.replace('1.5', '2.5'))
+    config = ConfigFileParser(file_name).parse_config()
+    assert config['actions']['Toggle Kitchen'].duration == '2.5'
+
+
+def test_corrupt_cache_is_ignored(config_dir):
+    file_name = write(config_dir / 'button_actions.cfg', MAIN_CONFIG)
+    write(config_dir / ('button_actions.cfg' + ConfigFileParser.cache_suffix), '{not json')
+    config = ConfigFileParser(file_name).parse_config()
+    assert 'Toggle Kitchen' in config['actions']
@@ -0,0 +1,110 @@
+import random
+import socket
+import threading
+import time
+
+import pytest
+
+import fliclib
+from fakeflicd import pack_event
+
+
+@pytest.fixture
+def connection():
+    """A FlicClient and the server side socket it is connected to, with handle_events running on a thread."""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = fliclib.FlicClient(*server.getsockname())
+    sock, _ = server.accept()
+    server.close()
+    thread = threading.Thread(target=client.handle_events, daemon=True)
+    yield client, sock, thread
+    client.close()
+    sock.close()
+    thread.join(5)
+
+
+def bd_addr(i):
+    return '80:e4:da:%02x:%02x:%02x' % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+
+
+def receive_verified_buttons(connection, chunks):
+    client, sock, thread = connection
+    received = []
+    client.on_new_verified_button = received.append
+    thread.start()
+    for chunk in chunks:
+        sock.sendall(chunk)
+        time.sleep(0.001)
+    sock.shutdown(socket.SHUT_WR)
+    thread.join(10)
+    assert not thread.is_alive()
+    return received
+
+
+def test_frames_split_anywhere(connection):
+    data = b''.join(pack_event('EvtNewVerifiedButton', bd_addr=bd_addr(i)) for i in range(3))
+    # Split inside the length prefix, inside a payload and right on a frame boundary
+    chunks = [data[0:1], data[1:5], data[5:9], data[9:10], data[10:]]
+    assert receive_verified_buttons(connection, chunks) == [bd_addr(i) for i in range(3)]
+
+
+def test_more_frames_than_the_receive_buffer(connection):
+    nb_frames = fliclib.FlicClient._RECV_BUFFER_SIZE // 9 + 1000
+    data = b''.join(pack_event('EvtNewVerifiedButton', bd_addr=bd_addr(i)) for i in range(nb_frames))
+    rng = random.Random(0)
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = start + rng.randint(1, 50000)
+        chunks.append(data[start:end])
+        start = end
+    assert receive_verified_buttons(connection, chunks) == [bd_addr(i) for i in range(nb_frames)]
+
+
+def run_timers(client, thread, last_timeout_millis):
+    client.set_timer(last_timeout_millis, client.close)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_timers_run_in_time_then_set_order(connection):
+    client, _, thread = connection
+    fired = []
+    for name, timeout_millis in [('c', 30), ('a', 10), ('b', 20), ('a2', 10)]:
+        client.set_timer(timeout_millis, lambda name=name: fired.append(name))
+    run_timers(client, thread, 50)
+    assert fired == ['a', 'a2', 'b', 'c']
+
+
+def test_cancelled_timers_do_not_run(connection):
+    client, _, thread = connection
+    fired = []
+    timers = [client.set_timer(10, lambda i=i: fired.append(i)) for i in range(200)]
+    for timer in timers[:150]:
+        timer.cancel()
+    # Cancelling again, or cancelling a timer that has run, has no effect
+    timers[0].cancel()
+    assert len(client._timers) < 200
+    run_timers(client, thread, 30)
+    timers[199].cancel()
+    assert fired == list(range(150, 200))
+
+
+def test_timer_cancelled_by_a_timer_of_the_same_batch(connection):
+    client, _, thread = connection
+    fired = []
+    later = []
+    client.set_timer(10, lambda: (fired.append('first'), later[0].cancel()))
+    later.append(client.set_timer(10, lambda: fired.append('second')))
+    time.sleep(0.02)
+    run_timers(client, thread, 10)
+    assert fired == ['first']
+
+
+def test_unknown_enum_value_raises_value_error():
+    assert fliclib._CLICK_TYPES[fliclib.ClickType.ButtonHold.value] is fliclib.ClickType.ButtonHold
+    with pytest.raises(ValueError):
+        fliclib._CLICK_TYPES[200]
@@ -0,0 +1,43 @@
+import pytest
+
+import lifxcolor
+
+
+def test_named_color():
+    assert lifxcolor.parse_color('red') == {'hue': 0.0, 'saturation': 1.0}
+
+
+def test_parts_are_combined():
+    assert lifxcolor.parse_color('Blue brightness:0.5') == {'hue': 250.0, 'saturation': 1.0, 'brightness': 0.5}
+
+
+def test_kelvin_removes_saturation_unless_given():
+    assert lifxcolor.parse_color('kelvin:2700') == {'kelvin': 2700.0, 'saturation': 0.0}
+    assert lifxcolor.parse_color('kelvin:2700 saturation:0.5') == {'kelvin': 2700.0, 'saturation': 0.5}
+
+
+@pytest.mark.parametrize('color', ['#ff8800', 'rgb:255,136,0'])
+def test_rgb_colors(color):
+    components = lifxcolor.parse_color(color)
+    assert components['hue'] == pytest.approx(32.0)
+    assert components['saturation'] == pytest.approx(1.0)
+    assert components['brightness'] == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('color', ['mauve', 'hue:361', 'hue:abc', 'kelvin:1000', '#ff88', '#gg8800', 'rgb:1,2', 'rgb:256,0,0'])
+def test_invalid_colors(color):
+    with pytest.raises(ValueError):
+        lifxcolor.parse_color(color)
+
+
+def test_parse_brightness():
+    assert lifxcolor.parse_brightness('0.25') == 0.25
+    with pytest.raises(ValueError):
+        lifxcolor.parse_brightness('1.5')
+    with pytest.raises(ValueError):
+        lifxcolor.parse_brightness('bright')
+
+
+def test_to_hsbk():
+    assert lifxcolor.to_hsbk({'hue': 360.0, 'saturation': 1.0, 'brightness': 0.5}) == (0, 65535, 32768, None)
+    assert lifxcolor.to_hsbk({'kelvin': 2700.0, 'saturation': 0.0}) == (None, 0, None, 2700)
@@ -0,0 +1,55 @@
+from lifxdevicecache import LIFXDeviceCache
+
+
+def device(mac, ip='192.168.1.20', **names):
+    return dict(mac=mac, ip=ip, port=56700, **names)
+
+
+def test_reconcile_adds_moves_and_keeps_names():
+    cache = LIFXDeviceCache('unused.json')
+    assert cache.reconcile([device('a', label='Kitchen'), device('b')]) == (['a', 'b'], [], [])
+    # A device that didn't answer with its label keeps the cached one
+    assert cache.reconcile([device('a', ip='192.168.1.21'), device('b')]) == ([], [], ['a'])
+    assert cache.entries['a']['label'] == 'Kitchen'
+    assert cache.entries['a']['ip'] == '192.168.1.21'
+
+
+def test_device_is_removed_after_max_missed_discoveries():
+    cache = LIFXDeviceCache('unused.json')
+    cache.reconcile([device('a'), device('b')])
+    for _ in range(LIFXDeviceCache.max_missed - 1):
+        assert cache.reconcile([device('a')]) == ([], [], [])
+    assert cache.entries['b']['missed'] == LIFXDeviceCache.max_missed - 1
+    assert cache.reconcile([device('a')]) == ([], ['b'], [])
+    assert list(cache.entries) == ['a']
+
+
+def test_device_found_again_resets_missed():
+    cache = LIFXDeviceCache('unused.json')
+    cache.reconcile([device('a'), device('b')])
+    cache.reconcile([device('a')])
+    cache.reconcile([device('a'), device('b')])
+    assert cache.entries['b']['missed'] == 0
+
+
+def test_empty_discovery_keeps_every_device():
+    cache = LIFXDeviceCache('unused.json')
+    cache.reconcile([device('a')])
+    for _ in range(LIFXDeviceCache.max_missed + 1):
+        assert cache.reconcile([]) == ([], [], [])
+    assert cache.entries['a']['missed'] == 0
+
+
+def test_save_and_load(tmp_path):
+    file_name = str(tmp_path / 'lifx_devices.json')
+    cache = LIFXDeviceCache(file_name)
+    cache.reconcile([device('a', label='Kitchen')])
+    cache.save()
+    loaded = LIFXDeviceCache(file_name)
+    assert loaded.load() == cache.entries
+
+
+def test_unreadable_file_starts_empty(tmp_path):
+    file_name = tmp_path / 'lifx_devices.json'
+    file_name.write_text('[{"ip": "192.168.1.20"}]')
+    assert LIFXDeviceCache(str(file_name)).load() == {}
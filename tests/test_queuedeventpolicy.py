@@ -0,0 +1,52 @@
+import queuedeventpolicy
+
+
+class RecordingCoalescer(object):
+    def __init__(self):
+        self.bursts = []
+
+    def submit_burst(self, actions):
+        self.bursts.append(list(actions))
+
+
+def test_stale_clicks_are_dropped(fake_client):
+    coalescer = RecordingCoalescer()
+    policy = queuedeventpolicy.QueuedEventPolicy(fake_client, coalescer, max_age=10)
+    policy.add('old', 10)
+    fake_client.fire_timers()
+    assert coalescer.bursts == []
+    assert policy.get_metrics() == {'replayed': 0, 'stale': 1, 'bursts': 0}
+
+
+def test_clicks_are_replayed_as_one_burst(fake_client):
+    coalescer = RecordingCoalescer()
+    policy = queuedeventpolicy.QueuedEventPolicy(fake_client, coalescer, burst_window=0.1)
+    policy.add('first', 3)
+    policy.add('second', 2)
+    assert len(fake_client.timers) == 1
+    assert fake_client.timers[0].timeout_millis == 100
+    fake_client.fire_timers()
+    policy.add('third', 1)
+    fake_client.fire_timers()
+    assert coalescer.bursts == [['first', 'second'], ['third']]
+    assert policy.get_metrics() == {'replayed': 3, 'stale': 0, 'bursts': 2}
+
+
+def test_zero_max_age_drops_every_click(fake_client):
+    coalescer = RecordingCoalescer()
+    policy = queuedeventpolicy.QueuedEventPolicy(fake_client, coalescer, max_age=0)
+    policy.add('click', 0)
+    assert policy.get_metrics()['stale'] == 1
+
+
+def test_flush_replays_pending_burst_now(fake_client):
+    coalescer = RecordingCoalescer()
+    policy = queuedeventpolicy.QueuedEventPolicy(fake_client, coalescer)
+    policy.flush()
+    assert coalescer.bursts == []
+    policy.add('queued', 1)
+    policy.flush()
+    assert coalescer.bursts == [['queued']]
+    # The burst timer must not replay it a second time
+    fake_client.fire_timers()
+    assert coalescer.bursts == [['queued']]